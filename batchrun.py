@@ -0,0 +1,217 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+'''Runs a saved worksheet without a display and writes the results to a JSON file.
+
+    python batchrun.py [-o results.json] [-t seconds] worksheet.dat
+
+Equations are rebuilt from the file the way WorkSheet.loadWorksheet does it, parsed by the same
+parser and run by the same executor as in the GUI: global definitions first, then everything in
+screen order.  For each equation the output holds its result, error and run time.  The exit status
+is 1 if any equation failed.'''
+
+import os
+import sys
+import time
+import optparse
+import cPickle as pickle
+import json
+
+import scipy
+
+from keywords import Keyword
+import inputparser
+import executor
+
+
+#Characters that are only drawn, they are left out of the string fed to the parser. Same as the
+#symbol sets of Equation, which can not be imported without a display.
+drawn_only = set(['__squareroot__', '__integral_top__', '__integral_bottom__', '__summation__',
+                  '__product__', '__overline__', '__arrow__', '__programline__',
+                  '__leftparenthesis__', '__rightparenthesis__', '__rightsquarebracket__',
+                  '__leftsquarebracket__', '__floorleft__', '__floorright__', '__ceilleft__',
+                  '__ceilright__', '__verticalline__', '__norm__', '__leftbrace__', '__rightbrace__',
+                  '__divideline__',
+                  '__reserved__', '__transpose__', '__star__', '__hermitian__', '__dot__',
+                  '__calculusdee__', '__symbol__', '__real_symbol__', '__integer_symbol__',
+                  '__complex_symbol__', '__limit__', '__limitarrow__', '__equalsign__'])
+
+#Drawn in place of ':=' by a global definition
+global_definition_sign = u':\u2261'
+
+#Keywords making the GUI run an equation symbolically whatever it reads, see Equation.forceSymbolic
+symbolic_keywords = [Keyword.DEFINESYMBOLSTART, Keyword.DEFINEREALSTART, Keyword.DEFINEINTEGERSTART,
+                     Keyword.DEFINECOMPLEXSTART, Keyword.LIMITSTART, Keyword.INDEFINTEGRALSTART]
+
+
+class BatchEquation(object):
+    """What the GUI's Equation holds for running an equation, rebuilt from its saved dictionary"""
+
+    def __init__(self, index, eqn_dict):
+        self.index = index
+        self.x = eqn_dict['savex']
+        self.y = eqn_dict['savey']
+        self.isAssignment = eqn_dict.get('isAssignment', False)
+
+        characters = [d['ascii_value'] for d in eqn_dict['saveList']]
+        self.isIncomplete = '__reserved__' in characters
+        self.equationString = ''.join([c for c in characters if c not in drawn_only])
+
+        #Flags the GUI sets as the equation is typed in, they are not saved
+        self.isGlobalDefinition = False
+        for d in eqn_dict['saveList']:
+            if d['ascii_value'] == ':=' and d.get('value') == global_definition_sign:
+                self.isGlobalDefinition = True
+
+        self.hasProgram = Keyword.PROGRAMSTART in self.equationString
+        self.forceSymbolic = False
+        for keyword in symbolic_keywords:
+            if keyword in self.equationString:
+                self.forceSymbolic = True
+
+        self.program = None
+        self.inputVariables = set([])
+        self.inputFunctions = set([])
+        self.outputVariables = set([])
+        self.error = None
+
+    def parse(self, parser):
+        '''Returns the work item for the executor as built by Equation.tryToExecuteEquation, None if the
+        equation can not be run'''
+        if self.isIncomplete:
+            self.error = 'Equation is incomplete'
+            return None
+
+        parser.reset()
+        try:
+            parser.run(self.equationString)
+        except:
+            self.error = 'Parser: Syntax error in equation'
+            return None
+
+        self.inputVariables = parser.inputVariables
+        self.inputFunctions = parser.inputFunctions
+        self.outputVariables = parser.outputVariables
+        self.program = ''.join([parser.functions, parser.program])
+
+        has_result = not self.isAssignment and not self.hasProgram
+        return (self.program, self.inputVariables, self.inputFunctions, has_result, self.forceSymbolic,
+                self.outputVariables)
+
+
+def load_equations(name):
+    '''Equations saved in worksheet file name, in screen order'''
+    f = open(name, 'rb')
+    l = pickle.load(f)
+    f.close()
+
+    equations = [BatchEquation(i, d) for i, d in enumerate(l)]
+    equations.sort(key=lambda eqn: (eqn.y, eqn.x))
+    return equations
+
+
+def to_json(value):
+    '''Value as something json can write, falling back on its repr'''
+    if isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, complex):
+        return [value.real, value.imag]
+    if isinstance(value, scipy.ndarray) and not value.dtype.hasobject:
+        if value.dtype.kind == 'c':
+            return [scipy.real(value).tolist(), scipy.imag(value).tolist()]
+        return value.tolist()
+    if isinstance(value, scipy.generic):
+        return to_json(value.item())
+    if value is None:
+        return None
+    return repr(value)
+
+
+def run_worksheet(name, time_limit=0):
+    '''Run all equations of worksheet file name. Returns the report written by main().'''
+    equations = load_equations(name)
+
+    parser = inputparser.InputParser()
+    runner = executor.Executor()
+    runner.set_time_limit(time_limit)
+
+    #Perform two passes. First run through all global definitions then run all equations.
+    #Only the second run of an equation is reported.
+    work = [(eqn, None) for eqn in equations if eqn.isGlobalDefinition]
+    work.extend([(eqn, eqn) for eqn in equations])
+
+    records = {}
+    start_time = time.time()
+    for eqn, report in work:
+        q_item = eqn.parse(parser)
+        if q_item is None:
+            result, error, is_symbolic, run_time = None, eqn.error, False, 0.0
+        else:
+            t = time.time()
+            result, error, is_symbolic = runner.execute([q_item])[0]
+            run_time = time.time() - t
+
+        if report is not None:
+            record = {'index'       : eqn.index,
+                      'equation'    : eqn.equationString,
+                      'outputs'     : sorted(eqn.outputVariables),
+                      'result'      : to_json(result),
+                      'result_type' : type(result).__name__,
+                      'error'       : error,
+                      'is_symbolic' : bool(is_symbolic),
+                      'time'        : run_time}
+            records[eqn.index] = record
+
+    total_time = time.time() - start_time
+    runner.close()
+
+    return {'worksheet' : name,
+            'time'      : total_time,
+            'equations' : [records[eqn.index] for eqn in equations]}
+
+
+def main(args):
+    option_parser = optparse.OptionParser(usage='%prog [options] worksheet.dat')
+    option_parser.add_option('-o', '--output', dest='output',
+                             help='file to write the results to, default is the worksheet name with .json added')
+    option_parser.add_option('-t', '--time-limit', dest='time_limit', type='float', default=0,
+                             help='seconds each equation may run for, default is no limit')
+    options, names = option_parser.parse_args(args)
+    if len(names) != 1:
+        option_parser.error('give one worksheet file')
+
+    name = os.path.abspath(names[0])
+    output = os.path.abspath(options.output or name + '.json')
+
+    #Executor reads its init files from the program directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    report = run_worksheet(name, options.time_limit)
+
+    f = open(output, 'w')
+    json.dump(report, f, indent=1)
+    f.close()
+
+    failed = [record for record in report['equations'] if record['error'] is not None]
+    return int(bool(failed))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,531 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+'''Times each stage of getting a worksheet on screen, using synthetic worksheets of a chosen size.
+
+    python benchmark.py [-o benchmark.json] [-n size] [-m matrix size] [-r repeats] [-s shape,...]
+
+Shapes are: scalars (chains of assignments), matrices (large matrix results), hanging (hanging index
+loops), sums (sums and integrals), symbolic (chains of symbolic expressions) and plots.  For every
+shape the stages are timed separately:
+
+    parse       InputParser.run on every equation
+    execute     Executor.execute on every item, which is what ExecThread runs them with
+    layout      Layout.layoutEquationPart on every equation
+    results     Equation.show_result, which makes the result widgets in drawNumericalResult
+    render      the scene painted into an image
+
+The last three need PyQt4. They run in a child process on Qt's offscreen platform, so if there is no
+PyQt4 or no display they are only marked as skipped.  The JSON written holds the version being run
+along with the times, so runs of different versions can be compared.
+
+Before anything is timed, a few programs that look into functions and classes are run numerically and
+symbolically.  They fail if equations run in Python's restricted mode, which happens when a namespace
+gets a builtins dict of its own.  Failed checks are listed in the JSON and make the exit status 1.'''
+
+import os
+import sys
+import time
+import platform
+import optparse
+import tempfile
+import subprocess
+import json
+
+import numpy
+import scipy
+import sympy
+
+from keywords import Keyword
+import inputparser
+import executor
+import batchrun
+
+
+#Height given to each equation and plot on the synthetic worksheets
+line_height = 40
+plot_height = 340
+
+#Rendered images are scaled down to fit this many pixels
+render_limit = 4096
+
+core_stages = ['parse', 'execute']
+gui_stages = ['layout', 'results', 'render']
+
+
+#********************************************************************************
+#*Functions below build the saved form of equation widgets (see Equation.getDictionary),
+#*laid out the way the Equation.add... methods insert them
+#********************************************************************************
+def char(value, ascii_value=None):
+    if ascii_value is None:
+        ascii_value = value
+    return {'object_type': 'character', 'value': value, 'ascii_value': ascii_value}
+
+def keyword(value):
+    return {'object_type': 'keyword', 'value': value, 'ascii_value': value}
+
+def text(s):
+    '''Characters of s as typed in, ':=' and ';' are single widgets'''
+    l = []
+    i = 0
+    while i < len(s):
+        if s[i:i+2] == ':=':
+            l.append(char(':=', ':='))
+            i += 2
+            continue
+        elif s[i] == ';':
+            l.append(char(' ... ', ';'))
+        elif s[i] == '*':
+            l.append(char(u' \u00b7 ', '*'))
+        else:
+            l.append(char(s[i]))
+        i += 1
+    return l
+
+def paren(body):
+    return [keyword(Keyword.LEFTPAREN), char('(', '__leftparenthesis__'), keyword(Keyword.BODYSTART)] + \
+           body + [keyword(Keyword.BODYEND), char(')', '__rightparenthesis__'), keyword(Keyword.RIGHTPAREN)]
+
+def call(name, args):
+    return text(name) + paren(text(args))
+
+def power(base, exponent):
+    return base + [keyword(Keyword.POWERSTART)] + exponent + [keyword(Keyword.POWEREND)]
+
+def index(name, i):
+    return text(name) + [keyword(Keyword.INDEXSTART)] + text(i) + [keyword(Keyword.INDEXEND)]
+
+def summation(var, start, end, body):
+    return [keyword(Keyword.SUMSTART), char(u'\u2211', '__summation__'), keyword(Keyword.FROMSTART),
+            keyword(Keyword.SUMVARSTART)] + text(var) + [keyword(Keyword.SUMVAREND), char('=', ':='),
+            keyword(Keyword.SUMFROMVALSTART)] + text(start) + [keyword(Keyword.SUMFROMVALEND),
+            keyword(Keyword.FROMEND), keyword(Keyword.SUMTOSTART)] + text(end) + [keyword(Keyword.SUMTOEND),
+            keyword(Keyword.SUMBODYSTART)] + body + [keyword(Keyword.SUMBODYEND), char(' ', ''),
+            keyword(Keyword.SUMEND)]
+
+def integral(start, end, body, var):
+    return [keyword(Keyword.INTEGRALSTART), char(u'\u2320', '__integral_top__'),
+            char(u'\u2321', '__integral_bottom__'), keyword(Keyword.INTFROMSTART)] + text(start) + \
+           [keyword(Keyword.INTFROMEND), keyword(Keyword.INTTOSTART)] + text(end) + \
+           [keyword(Keyword.INTTOEND), keyword(Keyword.INTBODYSTART)] + body + \
+           [keyword(Keyword.INTBODYEND), char('d', '__calculusdee__'), keyword(Keyword.INTVARSTART)] + \
+           text(var) + [keyword(Keyword.INTVAREND), char(' ', ''), keyword(Keyword.INTEGRALEND)]
+
+def symbols(names):
+    return [keyword(Keyword.DEFINESYMBOLSTART), char('Symbols:  ', '__symbol__'),
+            keyword(Keyword.SYMBOLLISTSTART)] + text(names) + [keyword(Keyword.SYMBOLLISTEND),
+            keyword(Keyword.DEFINESYMBOLEND)]
+
+
+class SyntheticWorksheet(object):
+    """Equations and plots in the form WorkSheet.saveWorksheet writes them, top to bottom"""
+
+    def __init__(self):
+        self.items = []     # ('equation', eqn_dict) or ('plot', plot_dict)
+        self.y = 0
+
+    def equation(self, save_list, is_assignment=True):
+        d = {'savex': 0, 'savey': self.y, 'isAssignment': is_assignment, 'saveList': save_list}
+        self.items.append(('equation', d))
+        self.y += line_height
+
+    def display(self, save_list):
+        self.equation(save_list, False)
+
+    def plot(self, x_list, y_list):
+        d = {'savex': 0, 'savey': self.y, 'x': x_list, 'y': y_list}
+        self.items.append(('plot', d))
+        self.y += plot_height
+
+    def countEquations(self):
+        n = 0
+        for kind, d in self.items:
+            if kind == 'plot':
+                n += 1 + len(d['y'])
+            else:
+                n += 1
+        return n
+
+
+#********************************************************************************
+#*Worksheet shapes. Each fills in a worksheet with about size equations.
+#********************************************************************************
+def shape_scalars(sheet, size, matrix_size):
+    sheet.equation(text('a0:=1.5'))
+    for i in xrange(1, size):
+        sheet.equation(text('a%d:=a%d*2+%d' % (i, i-1, i)))
+        if i % 10 == 0:
+            sheet.display(text('a%d' % i))
+
+def shape_matrices(sheet, size, matrix_size):
+    for i in xrange(max(1, size/2)):
+        sheet.equation(text('m%d:=' % i) + call('ones', '%d,%d' % (matrix_size, matrix_size)) + text('*%d' % i))
+        sheet.display(text('m%d' % i))
+
+def shape_hanging(sheet, size, matrix_size):
+    sheet.equation(text('i:=0;%d' % (matrix_size - 1)))
+    for j in xrange(max(1, size/2)):
+        sheet.equation(index('x%d' % j, 'i') + text(':=i*%d+1' % j))
+        sheet.display(index('x%d' % j, '3'))
+
+def shape_sums(sheet, size, matrix_size):
+    for i in xrange(max(1, size/4)):
+        sheet.equation(text('q%d:=' % i) + summation('k', '1', '%d' % matrix_size, power(text('k'), text('2'))))
+        sheet.display(text('q%d' % i))
+        sheet.equation(text('r%d:=' % i) + integral('0', '%d' % (i+1), text('k*k'), 'k'))
+        sheet.display(text('r%d' % i))
+
+def shape_symbolic(sheet, size, matrix_size):
+    sheet.equation(symbols('s'))
+    sheet.equation(text('p0:=s+1'))
+    for i in xrange(1, size):
+        sheet.equation(text('p%d:=p%d+' % (i, i-1)) + power(text('s'), text('%d' % (i % 7 + 1))))
+        if i % 10 == 0:
+            sheet.display(call('expand', 'p%d' % i))
+
+def shape_plots(sheet, size, matrix_size):
+    for i in xrange(max(1, size/3)):
+        sheet.equation(text('t%d:=0;%d' % (i, matrix_size * 10 - 1)))
+        sheet.plot(text('t%d*0.01' % i), [call('sin', 't%d*0.01*%d' % (i, i+1)), call('cos', 't%d*0.01' % i)])
+
+shapes = [('scalars', shape_scalars),
+          ('matrices', shape_matrices),
+          ('hanging', shape_hanging),
+          ('sums', shape_sums),
+          ('symbolic', shape_symbolic),
+          ('plots', shape_plots)]
+
+
+def build_worksheet(shape, size, matrix_size):
+    sheet = SyntheticWorksheet()
+    dict(shapes)[shape](sheet, size, matrix_size)
+    return sheet
+
+
+def plot_equations(d):
+    '''BatchEquations for the x and y equations of a synthetic plot'''
+    l = [d['x']] + d['y']
+    return [batchrun.BatchEquation(i, {'savex': 0, 'savey': 0, 'saveList': save_list})
+            for i, save_list in enumerate(l)]
+
+
+def summary(times, count):
+    '''Statistics of the times taken by each repeat'''
+    return {'runs'          : times,
+            'min'           : min(times),
+            'mean'          : sum(times) / len(times),
+            'max'           : max(times),
+            'per_equation'  : min(times) / max(count, 1)}
+
+
+#********************************************************************************
+#*Checks run before timing
+#********************************************************************************
+#Programs that only work outside restricted mode. Each has to set __result to True.
+introspection_programs = ['__result = getattr(lambda x: x, "func_globals") is not None',
+                          'class __Probe:\n    pass\n__result = "__module__" in __Probe.__dict__']
+
+def run_checks():
+    '''Runs introspection_programs numerically and symbolically, returns a list of the failures'''
+    runner = executor.Executor()
+    failures = []
+    for program in introspection_programs:
+        for force_symbolic in (False, True):
+            [(result, error, is_symbolic)] = runner.execute([(program, [], [], True, force_symbolic, [])])
+            if result is not True:
+                failures.append('%r symbolic=%s: %s' % (program, force_symbolic, error))
+    runner.close()
+
+    return failures
+
+
+#********************************************************************************
+#*Stages that do not need a display
+#********************************************************************************
+def run_core_stages(sheet, repeats):
+    parser = inputparser.InputParser()
+    runner = executor.Executor()
+    count = sheet.countEquations()
+
+    times = dict([(stage, []) for stage in core_stages])
+    errors = 0
+    for r in xrange(repeats):
+        runner.reset()
+
+        #Parse everything before running any of it, so the two are timed apart
+        t = time.time()
+        q_items = []
+        for kind, d in sheet.items:
+            if kind == 'plot':
+                equations = plot_equations(d)
+            else:
+                equations = [batchrun.BatchEquation(0, d)]
+            q_items.append([eqn.parse(parser) for eqn in equations])
+        times['parse'].append(time.time() - t)
+
+        t = time.time()
+        errors = 0
+        for q_item in q_items:
+            if None in q_item:
+                errors += 1
+                continue
+            for result, error, is_symbolic in runner.execute(q_item):
+                if error is not None:
+                    errors += 1
+        times['execute'].append(time.time() - t)
+
+    runner.close()
+
+    stages = dict([(stage, summary(times[stage], count)) for stage in core_stages])
+    return stages, errors
+
+
+#********************************************************************************
+#*Stages that need Qt, run in a child process (see run_gui_child)
+#********************************************************************************
+def run_gui_stages(sheets, repeats):
+    '''Times layout, results and render for each worksheet in sheets, a list of (shape, sheet)'''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+    from PyQt4.QtCore import QPointF, QRectF, PYQT_VERSION_STR, QT_VERSION_STR
+    from PyQt4.QtGui import QApplication, QGraphicsScene, QImage, QPainter, QFont
+
+    app = QApplication.instance()
+    if app is None:
+        app = QApplication(['benchmark'])
+
+    import equation
+    import plot2d
+
+    font = QFont('Bitstream Vera Serif', 14)
+    runner = executor.Executor()
+
+    report = {'versions': {'pyqt': PYQT_VERSION_STR, 'qt': QT_VERSION_STR}, 'shapes': {}}
+    for shape, sheet in sheets:
+        count = sheet.countEquations()
+        times = dict([(stage, []) for stage in gui_stages])
+        try:
+            for r in xrange(repeats):
+                runner.reset()
+
+                #Build the worksheet the way loadWorksheet does and run it. None of this is timed.
+                scene = QGraphicsScene()
+                work = []
+                for kind, d in sheet.items:
+                    position = QPointF(d['savex'], d['savey'])
+                    if kind == 'plot':
+                        item = plot2d.Plot2d(None, position, font)
+                        scene.addItem(item)
+                        for eqn, save_list in zip([item.x_axis_equation] + item.y_axis_equations, [d['x']] + d['y']):
+                            eqn.equationList = []
+                            eqn.length = 0
+                            eqn.equationListIndex = 0
+                            eqn.restoreEquationList(save_list)
+                            eqn.layoutEquation()
+                            eqn.equationNeedsParsing = True
+                        equations = [item.x_axis_equation] + item.y_axis_equations
+                        q_item = item.tryToExecuteEquation()
+                        q_item.pop()
+                    else:
+                        item = equation.Equation(None, position, font)
+                        scene.addItem(item)
+                        item.setDictionary(d)
+                        item.forceSymbolic = batchrun.BatchEquation(0, d).forceSymbolic
+                        item.setSelected(False)
+                        item.cursor.hide()
+                        equations = [item]
+                        q_item = item.tryToExecuteEquation()
+                        q_item.pop()
+
+                    work.append((item, equations, runner.execute(q_item)))
+
+                t = time.time()
+                for item, equations, results in work:
+                    for eqn in equations:
+                        eqnlist = eqn.equationList
+                        eqn.layoutengine.layoutEquationPart(eqnlist, 0, len(eqnlist), eqn.font.pointSize())
+                times['layout'].append(time.time() - t)
+
+                t = time.time()
+                for item, equations, results in work:
+                    item.show_result(results)
+                times['results'].append(time.time() - t)
+
+                t = time.time()
+                rect = scene.itemsBoundingRect()
+                scale = min(1.0, render_limit / max(rect.width(), rect.height(), 1.0))
+                image = QImage(int(rect.width() * scale) + 1, int(rect.height() * scale) + 1, QImage.Format_ARGB32)
+                image.fill(0xffffffff)
+                painter = QPainter(image)
+                scene.render(painter, QRectF(image.rect()), rect)
+                painter.end()
+                times['render'].append(time.time() - t)
+
+                scene.clear()
+
+            report['shapes'][shape] = dict([(stage, summary(times[stage], count)) for stage in gui_stages])
+        except Exception, e:
+            report['shapes'][shape] = dict([(stage, {'error': repr(e)}) for stage in gui_stages])
+
+    runner.close()
+    return report
+
+
+def run_gui_child(options):
+    '''Run the GUI stages in a new process, so a missing display can not take down the benchmark.
+    Returns the child's report, or the reason it could not be had.'''
+    fd, name = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+
+    args = [sys.executable, os.path.abspath(__file__), '--gui-child', '-o', name,
+            '-n', str(options.size), '-m', str(options.matrix_size), '-r', str(options.repeat),
+            '-s', options.shapes]
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+    try:
+        child = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        out, err = child.communicate()
+        if child.returncode != 0:
+            lines = err.strip().splitlines() or ['exit status %d' % child.returncode]
+            return None, lines[-1]
+
+        f = open(name)
+        report = json.load(f)
+        f.close()
+        return report, None
+    finally:
+        os.remove(name)
+
+
+def version_info():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        child = subprocess.Popen(['git', 'describe', '--always', '--dirty'], cwd=directory,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = child.communicate()
+        revision = out.strip() or None
+    except OSError:
+        revision = None
+
+    return {'revision'  : revision,
+            'python'    : platform.python_version(),
+            'scipy'     : scipy.__version__,
+            'numpy'     : numpy.__version__,
+            'sympy'     : sympy.__version__,
+            'platform'  : platform.platform(),
+            'date'      : time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def main(args):
+    option_parser = optparse.OptionParser(usage='%prog [options]')
+    option_parser.add_option('-o', '--output', dest='output', default='benchmark.json',
+                             help='file to write the times to, default is benchmark.json')
+    option_parser.add_option('-n', '--size', dest='size', type='int', default=100,
+                             help='about how many equations each worksheet has, default is 100')
+    option_parser.add_option('-m', '--matrix-size', dest='matrix_size', type='int', default=100,
+                             help='rows and columns of matrix results, also sets the length of loops and plots')
+    option_parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+                             help='times each worksheet is run, default is 3')
+    option_parser.add_option('-s', '--shapes', dest='shapes', default=','.join([name for name, f in shapes]),
+                             help='comma separated shapes to run, default is all of them')
+    option_parser.add_option('--no-gui', dest='gui', action='store_false', default=True,
+                             help='skip the stages that need Qt')
+    option_parser.add_option('--gui-child', dest='gui_child', action='store_true', default=False,
+                             help=optparse.SUPPRESS_HELP)
+    options, names = option_parser.parse_args(args)
+    if names:
+        option_parser.error('no file names are taken')
+
+    shape_names = [s.strip() for s in options.shapes.split(',') if s.strip()]
+    for s in shape_names:
+        if s not in dict(shapes):
+            option_parser.error('unknown shape %s' % s)
+    if options.repeat < 1:
+        option_parser.error('repeat must be at least 1')
+
+    output = os.path.abspath(options.output)
+
+    #Executor reads its init files from the program directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    sheets = [(s, build_worksheet(s, options.size, options.matrix_size)) for s in shape_names]
+
+    if options.gui_child:
+        report = run_gui_stages(sheets, options.repeat)
+        f = open(output, 'w')
+        json.dump(report, f)
+        f.close()
+        return 0
+
+    failures = run_checks()
+    for failure in failures:
+        print >>sys.stderr, 'Check failed:', failure
+
+    report = {'versions'    : version_info(),
+              'parameters'  : {'size': options.size, 'matrix_size': options.matrix_size,
+                               'repeat': options.repeat, 'shapes': shape_names},
+              'checks'      : {'failed': failures},
+              'shapes'      : {}}
+
+    for s, sheet in sheets:
+        stages, errors = run_core_stages(sheet, options.repeat)
+        report['shapes'][s] = {'items': len(sheet.items), 'equations': sheet.countEquations(),
+                               'errors': errors, 'stages': stages}
+
+    if options.gui:
+        gui_report, reason = run_gui_child(options)
+    else:
+        gui_report, reason = None, 'not asked for'
+
+    if gui_report is not None:
+        report['versions'].update(gui_report['versions'])
+    for s, sheet in sheets:
+        stages = report['shapes'][s]['stages']
+        for stage in gui_stages:
+            if gui_report is None:
+                stages[stage] = {'skipped': reason}
+            else:
+                stages[stage] = gui_report['shapes'][s][stage]
+
+    f = open(output, 'w')
+    json.dump(report, f, indent=1, sort_keys=True)
+    f.close()
+
+    #Short table of the best times, in milliseconds
+    print '%-10s' % 'shape' + ''.join(['%10s' % stage for stage in core_stages + gui_stages])
+    for s in shape_names:
+        stages = report['shapes'][s]['stages']
+        cells = []
+        for stage in core_stages + gui_stages:
+            if 'min' in stages[stage]:
+                cells.append('%10.1f' % (stages[stage]['min'] * 1000))
+            else:
+                cells.append('%10s' % '-')
+        print '%-10s' % s + ''.join(cells)
+
+    if failures:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
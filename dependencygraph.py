@@ -0,0 +1,267 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+'''Works out which equations on a worksheet have to be re-run after an edit'''
+
+import itertools
+
+#IDs of equations/plots. id() can not be used, Python gives the id of a deleted equation to the next object
+#made, and the graph would take a new equation in its place for the deleted one.
+object_ids = itertools.count(1)
+
+
+def new_object_id():
+    '''Returns a number identifying an equation/plot, never handed out again'''
+    return object_ids.next()
+
+
+class DependencyGraph(object):
+    """Keeps track of the names read and written by each equation/plot sent to the execution thread.
+
+    Each run is described by the list of work items in execution order.  Equations whose program
+    changed since the last run are dirty.  Only the dirty equations and the equations downstream of
+    them (equations that read a name written by a re-run equation) are sent to the thread again, on
+    top of the namespace left behind by the previous run.  Whenever the old namespace can not be
+    trusted (equations deleted or moved, a name assigned in more than one place, etc) a full run
+    from an empty namespace is requested instead."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        '''Forget everything, the next call to schedule() will ask for a full run'''
+        self.last_sequence = None       # Object ids in execution order from the last run
+        self.last_signatures = {}       # object_id -> program signature, None if it did not parse
+        self.last_outputs = {}          # object_id -> set of names assigned
+
+    def invalidate(self, object_ids):
+        '''Make sure the given equations get run again, e.g. because they were stopped before finishing'''
+        for object_id in object_ids:
+            if object_id in self.last_signatures:
+                self.last_signatures[object_id] = ()
+
+    def needsFullRun(self, sequence):
+        '''True if a run of the object ids in sequence (execution order) is a full run whatever the
+        equations hold, i.e. schedule() will return full_run True'''
+        return self.last_sequence is None or self.matchSubsequence(self.last_sequence, sequence) is None
+
+    def describe(self, t):
+        '''Unpack a work item as returned by tryToExecuteEquation.
+        Format is: [(program, inputvars, inputfuncs, has_result, force_symbolic, outputvars), (...), object_id]'''
+        signature = []
+        inputs = set([])
+        outputs = set([])
+
+        for item in t[:-1]:
+            signature.append((item[0], item[3], item[4]))
+            inputs.update(item[1])
+            inputs.update(item[2])
+            if len(item) > 5:
+                outputs.update(item[5])
+
+        return tuple(signature), inputs, outputs
+
+    def schedule(self, work):
+        """work is a list of (object_id, t) tuples in execution order, t being the work item returned by
+        tryToExecuteEquation (None if the equation could not be parsed).
+        Returns a tuple (full_run, items). If full_run is True the namespace must be cleared before
+        the items are sent to the execution thread."""
+        sequence = []
+        signatures = {}
+        inputs = []
+        outputs = []
+        items = []
+
+        for object_id, t in work:
+            sequence.append(object_id)
+            items.append(t)
+            if t is None:
+                signatures[object_id] = None
+                inputs.append(set([]))
+                outputs.append(set([]))
+            else:
+                signature, i, o = self.describe(t)
+                signatures[object_id] = signature
+                inputs.append(i)
+                outputs.append(o)
+
+        run = self.findAffected(sequence, signatures, inputs, outputs)
+        full_run = run is None
+        if full_run:
+            run = [i for i, t in enumerate(items) if t is not None]
+
+        #Remember state for next time
+        self.last_sequence = sequence
+        self.last_signatures = signatures
+        self.last_outputs = dict(zip(sequence, outputs))
+
+        return full_run, [items[i] for i in run]
+
+    def findAffected(self, sequence, signatures, inputs, outputs):
+        '''Returns the positions (in execution order) that have to be re-run, or None if a full run is needed'''
+        if self.last_sequence is None:
+            return None
+
+        #Equations can be added, but if any were removed or re-ordered the namespace holds stale values
+        inserted = self.matchSubsequence(self.last_sequence, sequence)
+        if inserted is None:
+            return None
+
+        #Find the dirty equations
+        dirty = set([])
+        for i, object_id in enumerate(sequence):
+            old_signature = self.last_signatures.get(object_id)
+            new_signature = signatures[object_id]
+
+            if i in inserted:
+                dirty.add(object_id)
+
+            elif new_signature != old_signature:
+                #An equation that no longer parses leaves its old values in the namespace
+                if new_signature is None:
+                    return None
+
+                #So does an equation that no longer assigns a name it used to assign
+                if not self.last_outputs.get(object_id, set([])).issubset(outputs[i]):
+                    return None
+
+                dirty.add(object_id)
+
+        #Functions are looked up when they are called, so anything read by a function is also read by
+        #every equation that calls it. Variable names always start with '_', function names do not.
+        effective_inputs = self.expandFunctionInputs(inputs, outputs)
+
+        #Record where each name is assigned
+        definers = {}
+        for i, names in enumerate(outputs):
+            for name in names:
+                definers.setdefault(name, []).append(i)
+
+        #Walk through equations in execution order, propagating changes downstream
+        changed_names = set([])
+        run = []
+        for i, object_id in enumerate(sequence):
+            if signatures[object_id] is None:
+                continue
+
+            if object_id in dirty or effective_inputs[i] & changed_names:
+                run.append(i)
+                changed_names.update(outputs[i])
+
+        #The namespace holds the values assigned by the last equation to assign each name. Re-running part
+        #of the worksheet only gives the same answer as a full run if every name read by a re-run
+        #equation is assigned above it, and every name it assigns is not assigned again further down.
+        for i in run:
+            for name in effective_inputs[i]:
+                for j in definers.get(name, []):
+                    if j > i or (j == i and name.startswith('_')):
+                        return None
+
+            for name in outputs[i]:
+                for j in definers[name]:
+                    if j > i and sequence[j] != sequence[i]:
+                        return None
+
+        return run
+
+    def prioritize(self, items, visible):
+        '''Reorder the work items of a run so the items whose object id is in visible come first, together
+        with every earlier item they have to follow. That is any item writing a name they read or write,
+        reading a name they write, or an item whose effects are not known. The other items keep their
+        order and come after, running the result gives the same namespace as running items as given.'''
+        n = len(items)
+        inputs = []
+        outputs = []
+        barriers = []
+        for t in items:
+            signature, i, o = self.describe(t)
+            inputs.append(i)
+            outputs.append(o)
+
+            #Programs can assign anything, so can items that do not say what they assign
+            barrier = False
+            for item in t[:-1]:
+                if len(item) <= 5 or 'def __program_function' in item[0]:
+                    barrier = True
+            barriers.append(barrier)
+
+        effective_inputs = self.expandFunctionInputs(inputs, outputs)
+
+        #Walk up from the bottom, collecting what has to run before the items already picked
+        first = set([i for i, t in enumerate(items) if t[-1] in visible])
+        reads = set([])
+        writes = set([])
+        barrier = False
+        for i in xrange(n - 1, -1, -1):
+            if i not in first and (reads or writes or barrier):
+                if barrier or barriers[i] or outputs[i] & (reads | writes) or effective_inputs[i] & writes:
+                    first.add(i)
+
+            if i in first:
+                reads.update(effective_inputs[i])
+                writes.update(outputs[i])
+                barrier = barrier or barriers[i]
+
+        return [items[i] for i in xrange(n) if i in first] + [items[i] for i in xrange(n) if i not in first]
+
+    def expandFunctionInputs(self, inputs, outputs):
+        '''Add the names read by worksheet defined functions to the inputs of the equations calling them'''
+        function_inputs = {}
+        for i, names in enumerate(outputs):
+            for name in names:
+                if not name.startswith('_'):
+                    function_inputs.setdefault(name, set([])).update(inputs[i])
+
+        #Functions can call other functions, keep going until nothing new is found
+        changed = True
+        while changed:
+            changed = False
+            for name, names in function_inputs.iteritems():
+                n = len(names)
+                for other in list(names):
+                    if other in function_inputs and other != name:
+                        names.update(function_inputs[other])
+                if len(names) != n:
+                    changed = True
+
+        effective_inputs = []
+        for names in inputs:
+            expanded = set(names)
+            for name in names:
+                if name in function_inputs:
+                    expanded.update(function_inputs[name])
+            effective_inputs.append(expanded)
+
+        return effective_inputs
+
+    def matchSubsequence(self, old, new):
+        '''If old is a subsequence of new return the set of positions in new that were inserted, else None'''
+        inserted = set([])
+        j = 0
+        for i, object_id in enumerate(new):
+            if j < len(old) and old[j] == object_id:
+                j += 1
+            else:
+                inserted.add(i)
+
+        if j < len(old):
+            return None
+
+        return inserted
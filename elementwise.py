@@ -0,0 +1,354 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+
+'''Works out long elementwise array expressions a block at a time.
+
+Worked out the usual way, an expression such as a*sin(b)+c**2/d on arrays makes a new array for every
+operation, each of them written out to memory and read back for the next operation.  The optimizer (see
+programir.py) hands expressions like it to __elementwise with their text, the values of the names they
+read and a lambda working them out the usual way.  Long arrays are then worked out a block of elements at
+a time, small enough for the operands of a block to stay in the cache, into scratch arrays of one block
+each that are used again for every block.  Only the result is a whole array.  The blocks can be shared
+out between threads (see set_threads), numpy lets go of the interpreter lock while it works on them.
+
+Anything else is worked out by the lambda: short arrays, arrays of different shapes, matrices, symbolic
+values, functions defined on the worksheet, and results whose type is not the same for every block (e.g.
+the square root of an array holding negative numbers in some blocks only).'''
+
+import ast
+import sys
+import operator
+import threading
+import multiprocessing
+
+import scipy
+
+
+#Functions of the builtin layers that work element by element, by the names equations call them by.
+#Calls to them are only worked out a block at a time if they turn out to be a ufunc or one of the
+#functions the Evaluator is handed.
+functions = set(['sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'sinh', 'cosh', 'tanh', 'asinh', 'acosh',
+                 'atanh', 'exp', 'log', 'log10', '__sqrt', '__divide', '__absolute', '__conjugate'])
+
+#Operators as (Python operator, ufunc working it out into a scratch array). Division is classic division
+#as the equations are compiled without 'from __future__ import division', and powers are left to Python's
+#operator as numpy special cases some of them.
+binary_operators = {ast.Add  : (operator.add, scipy.add),
+                    ast.Sub  : (operator.sub, scipy.subtract),
+                    ast.Mult : (operator.mul, scipy.multiply),
+                    ast.Div  : (operator.div, scipy.divide),
+                    ast.Pow  : (operator.pow, None)}
+
+unary_operators = {ast.USub : (operator.neg, scipy.negative),
+                   ast.UAdd : (operator.pos, None)}
+
+#Elements in a block, and fewest elements worth splitting into blocks
+block_size = 16384
+min_size = 4 * block_size
+
+#Threads sharing out the blocks of an expression
+threads = 1
+max_auto_threads = 4
+
+#Values other than arrays an expression can be worked out a block at a time with
+scalar_types = (bool, int, long, float, complex, scipy.generic)
+
+#Errors the usual way of working out an expression raises too, see Kernel.run
+expression_errors = (TypeError, ValueError, IndexError, ArithmeticError, AttributeError)
+
+
+def set_threads(n):
+    '''Number of threads sharing out the blocks of long expressions, 0 for one per core'''
+    global threads
+    if not n:
+        try:
+            n = min(max_auto_threads, multiprocessing.cpu_count())
+        except NotImplementedError:
+            n = 1
+    threads = n
+
+
+def fusible(node):
+    '''True if the expression under node only applies the operators and functions above to names and numbers'''
+    if isinstance(node, (ast.Name, ast.Num)):
+        return True
+    if isinstance(node, ast.BinOp):
+        return node.op.__class__ in binary_operators and fusible(node.left) and fusible(node.right)
+    if isinstance(node, ast.UnaryOp):
+        return node.op.__class__ in unary_operators and fusible(node.operand)
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in functions or not node.args:
+            return False
+        if node.keywords or node.starargs is not None or node.kwargs is not None:
+            return False
+        return not [arg for arg in node.args if not fusible(arg)]
+    return False
+
+
+def operations(node):
+    '''Number of operators and function calls in the expression under node'''
+    return len([child for child in ast.walk(node) if isinstance(child, (ast.BinOp, ast.UnaryOp, ast.Call))])
+
+
+def leaves(node):
+    '''Names read by the expression under node, functions included, left to right the way Python reads
+    them. Their values are handed to __elementwise in this order, so the first name that is not defined
+    raises the same NameError as working out the expression does.'''
+    names = []
+    stack = [node]
+    while stack:
+        child = stack.pop()
+        if isinstance(child, ast.Name):
+            if child.id not in names:
+                names.append(child.id)
+        else:
+            stack.extend(reversed(list(ast.iter_child_nodes(child))))
+    return names
+
+
+class Mismatch(Exception):
+    '''Raised when a block does not give what the first block did'''
+
+
+class Kernel(object):
+    """An elementwise expression read from its text, as a list of steps each working out one name, number,
+    operator or function call.  Steps are (kind, ...) tuples:
+
+        ('name', i)                                 value i handed to __elementwise
+        ('number', n)
+        ('operator', python operator, ufunc, [argument steps])
+        ('call', function step, [argument steps])
+
+    Steps only come after the steps they read."""
+
+    def __init__(self, text):
+        tree = ast.parse(text, mode='eval').body
+        self.names = leaves(tree)
+        self.steps = [('name', i) for i in xrange(len(self.names))]
+        self.root = self.add(tree)
+
+    def add(self, node):
+        if isinstance(node, ast.Name):
+            return self.names.index(node.id)
+        if isinstance(node, ast.Num):
+            step = ('number', node.n)
+        elif isinstance(node, ast.BinOp):
+            python_operator, ufunc = binary_operators[node.op.__class__]
+            step = ('operator', python_operator, ufunc, [self.add(node.left), self.add(node.right)])
+        elif isinstance(node, ast.UnaryOp):
+            python_operator, ufunc = unary_operators[node.op.__class__]
+            step = ('operator', python_operator, ufunc, [self.add(node.operand)])
+        else:
+            step = ('call', self.add(node.func), [self.add(arg) for arg in node.args])
+
+        self.steps.append(step)
+        return len(self.steps) - 1
+
+    def prepare(self, values, elementwise_functions):
+        """Works out the steps that do not read an array. Returns (constants, arrays, steps, shape): the
+        value of each step worked out (None for the others), the arrays read as one dimensional views, the
+        remaining steps as (step, function, ufunc or None, [argument steps]) and the shape of the arrays.
+        None if the expression has to be worked out the usual way."""
+        constants = [None] * len(self.steps)
+        is_constant = [True] * len(self.steps)
+        arrays = {}
+        steps = []
+        shape = None
+
+        for n, step in enumerate(self.steps):
+            kind = step[0]
+            if kind == 'name':
+                value = values[step[1]]
+                if type(value) is scipy.ndarray:
+                    if value.dtype.kind not in 'biufc' or not value.flags.c_contiguous:
+                        return None
+                    if shape is None:
+                        shape = value.shape
+                    elif value.shape != shape:
+                        return None
+                    arrays[n] = value.reshape(-1)
+                    is_constant[n] = False
+                else:
+                    constants[n] = value
+                continue
+
+            if kind == 'number':
+                constants[n] = step[1]
+                continue
+
+            if kind == 'operator':
+                function, ufunc, arguments = step[1:]
+            else:
+                function = constants[step[1]]
+                arguments = step[2]
+                if isinstance(function, scipy.ufunc):
+                    ufunc = function
+                elif [f for f in elementwise_functions if f is function]:
+                    ufunc = None
+                else:
+                    return None
+
+            #Same as the usual way for anything not reading an array
+            if not [a for a in arguments if not is_constant[a]]:
+                constants[n] = function(*[constants[a] for a in arguments])
+                continue
+
+            for a in arguments:
+                if is_constant[a] and not isinstance(constants[a], scalar_types):
+                    return None
+            is_constant[n] = False
+            steps.append((n, function, ufunc, arguments))
+
+        if is_constant[self.root]:
+            return None
+
+        return constants, arrays, steps, shape
+
+    def block(self, prepared, start, stop, dtypes=None, buffers=None, out=None):
+        """Works out the steps for elements start to stop and returns the value of each step. Without dtypes
+        (the first block) every step makes a new array. Otherwise the ufuncs work into buffers, the result
+        goes into out and Mismatch is raised if a step gives another type than it did for the first block."""
+        constants, arrays, steps, shape = prepared
+        slots = list(constants)
+        for n, array in arrays.iteritems():
+            slots[n] = array[start:stop]
+
+        for n, function, ufunc, arguments in steps:
+            args = [slots[a] for a in arguments]
+            if dtypes is None:
+                value = function(*args)
+            elif ufunc is not None:
+                if n == self.root:
+                    value = ufunc(*args, out=out)
+                else:
+                    value = ufunc(*args, out=buffers[n][:stop - start])
+            else:
+                value = function(*args)
+                if type(value) is not scipy.ndarray or value.dtype != dtypes[n] or value.shape != (stop - start, ):
+                    raise Mismatch()
+                if n == self.root:
+                    out[...] = value
+            slots[n] = value
+
+        return slots
+
+    def blocks(self, prepared, starts, size, dtypes, flat):
+        #Scratch arrays of one block for the steps worked out by ufuncs, the result goes straight into flat
+        buffers = {}
+        for n, function, ufunc, arguments in prepared[2]:
+            if ufunc is not None and n != self.root:
+                buffers[n] = scipy.empty(block_size, dtypes[n])
+
+        for start in starts:
+            stop = min(start + block_size, size)
+            self.block(prepared, start, stop, dtypes, buffers, flat[start:stop])
+
+    def work(self, prepared, starts, size, dtypes, flat, settings, errors):
+        #Body of a worker thread, anything raised is handed back to the thread waiting for it
+        try:
+            scipy.seterr(**settings)
+            self.blocks(prepared, starts, size, dtypes, flat)
+        except:
+            errors.append(sys.exc_info())
+
+    def run(self, values, elementwise_functions, thread_count):
+        """Value of the expression, None if it has to be worked out the usual way. That includes a step
+        raising one of the errors the usual way raises, which then raises it again."""
+        try:
+            prepared = self.prepare(values, elementwise_functions)
+            if prepared is None:
+                return None
+            constants, arrays, steps, shape = prepared
+            size = arrays.values()[0].size
+            if size < min_size:
+                return None
+
+            #First block tells what type each step gives
+            slots = self.block(prepared, 0, block_size)
+            dtypes = {}
+            for n, function, ufunc, arguments in steps:
+                value = slots[n]
+                if type(value) is not scipy.ndarray or value.dtype.kind not in 'biufc' or value.shape != (block_size, ):
+                    return None
+                dtypes[n] = value.dtype
+
+            result = scipy.empty(shape, dtypes[self.root])
+            flat = result.reshape(-1)
+            flat[:block_size] = slots[self.root]
+
+            #Each thread works through a run of the remaining blocks, this one takes the first run
+            starts = range(block_size, size, block_size)
+            count = max(1, min(thread_count, len(starts)))
+            runs = [starts[i * len(starts) / count:(i + 1) * len(starts) / count] for i in xrange(count)]
+
+            errors = []
+            workers = []
+            for starts in runs[1:]:
+                worker = threading.Thread(target=self.work,
+                                          args=(prepared, starts, size, dtypes, flat, scipy.geterr(), errors))
+                worker.setDaemon(True)
+                worker.start()
+                workers.append(worker)
+
+            self.blocks(prepared, runs[0], size, dtypes, flat)
+
+            #Wait with a timeout so a stop sent to this thread is not held up
+            for worker in workers:
+                while worker.isAlive():
+                    worker.join(0.1)
+            if errors:
+                raise errors[0][0], errors[0][1], errors[0][2]
+
+        except expression_errors + (Mismatch, ):
+            return None
+
+        return result
+
+
+class Evaluator(object):
+    """__elementwise of the numeric layer, see numerics_init.py. elementwise_functions are the functions
+    other than ufuncs that work element by element."""
+
+    #Most kernels kept, one for each expression text
+    max_kernels = 1000
+
+    def __init__(self, elementwise_functions):
+        self.elementwise_functions = list(elementwise_functions)
+        self.kernels = {}
+
+    def __call__(self, text, values, expression):
+        for value in values:
+            if type(value) is scipy.ndarray and value.size >= min_size:
+                break
+        else:
+            return expression()
+
+        kernel = self.kernels.get(text)
+        if kernel is None:
+            if len(self.kernels) >= self.max_kernels:
+                self.kernels.clear()
+            kernel = Kernel(text)
+            self.kernels[text] = kernel
+
+        result = kernel.run(values, self.elementwise_functions, threads)
+        if result is None:
+            return expression()
+        return result
@@ -19,12 +19,10 @@
 #   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
 #------------------------------------------------------------------------------
 
-import sys
 import time
 import copy
 import re
 import scipy
-import sympy
 
 #from PyQt4 import Qt
 from PyQt4.QtCore import *
@@ -37,6 +35,9 @@ from layout import Layout
 
 import inputparser
 import outputparser
+import parsethread
+import parsecache
+import dependencygraph
 import equationcursor
 import activebox
 import shadowbox
@@ -160,7 +161,7 @@ class Equation(QGraphicsRectItem):
         self.setAcceptsHoverEvents(True)
         self.setSelected(True)
         self.setZValue(100)  # Z value on worksheet
-        self.object_id = id(self)  # Unique ID for instance
+        self.object_id = dependencygraph.new_object_id()  # Unique ID for instance
 
         #Create equation cursor
         self.cursor = equationcursor.EquationCursor(self)
@@ -189,6 +190,7 @@ class Equation(QGraphicsRectItem):
         self.equationListIndex = 0
         self.equationNeedsParsing = True
         self.equationHasBeenParsed = False
+        self.parseTime = 0.0            # Seconds the last parse took, see profiler.py
         self.hasTable = False
         self.tableIndex = 0
         self.initialTableWidth = 400
@@ -205,6 +207,8 @@ class Equation(QGraphicsRectItem):
         self.selectionRightIndex = -1
         self.selectionLeftIndex = -1
         self.inputVariables = set([])   # Records input variable names (labels used by eqn)
+        self.inputFunctions = set([])   # Records names of functions called by eqn
+        self.outputVariables = set([])  # Records names of variables/functions assigned by eqn
         self.outputValue = None         # Records the numerical result of equation (if any)
         self.inputValues = {}
         self.program = ''
@@ -3705,7 +3709,7 @@ class Equation(QGraphicsRectItem):
                 has_result = True
 
             #Prepare what's needed for the execution thread
-            t = [(self.program, self.inputVariables, self.inputFunctions, has_result, self.forceSymbolic), self.object_id]
+            t = [(self.program, self.inputVariables, self.inputFunctions, has_result, self.forceSymbolic, self.outputVariables), self.object_id]
             return t
 
         return None
@@ -3713,21 +3717,49 @@ class Equation(QGraphicsRectItem):
     def parseEquation(self):
         '''This function parses the equation and produces a Python program'''
         s = self.getEquationString()
-        self.equationParser.reset()
-
-        #Try running parser
-        try:
-            self.equationParser.run(s)   # Parse
-            self.equationHasBeenParsed = True
-        except:
-            print str(sys.exc_info())
+        start_time = time.time()
+        result = parsethread.parse(self.equationParser, s)
+        self.parseTime = time.time() - start_time
+        self.setParseResult(result)
+
+    def setParseResult(self, result):
+        '''Take on the program etc. the parser made of the equation, result as returned by parsethread.parse'''
+        if result is None:
             self.setToolTip('Parser: Syntax error in equation')
             self.setColor(QColor('red'))
             self.equationHasBeenParsed = False
+        else:
+            self.program, self.inputVariables, self.inputFunctions, self.outputVariables = result
+            self.equationHasBeenParsed = True
+
+    def parseRequest(self):
+        '''Returns the equation string if the equation has to be parsed before it can be run, else None.
+        Equations whose string is in the parse cache take on the cached result straight away.'''
+        if self.equationNeedsParsing:
+            for c in self.equationList:
+                if c.object_type == 'character' and c.ascii_value == "__reserved__":
+                    return None
+
+            s = self.getEquationString()
+            found, result = parsecache.cache.get(s)
+            if found:
+                self.equationNeedsParsing = False
+                self.parseTime = 0.0
+                self.setParseResult(result)
+                return None
 
-        self.inputVariables = self.equationParser.inputVariables    # Vars used by eqn
-        self.inputFunctions = self.equationParser.inputFunctions
-        self.program = ''.join([self.equationParser.functions, self.equationParser.program])
+            return s
+
+        return None
+
+    def parsedElsewhere(self, s, result, parse_time):
+        '''Result of parsing equation string s in the parse thread, which took parse_time seconds. It is only
+        used if the equation has not been edited since s was taken, otherwise tryToExecuteEquation parses
+        the equation again.'''
+        if self.equationNeedsParsing and s == self.getEquationString():
+            self.equationNeedsParsing = False
+            self.parseTime = parse_time
+            self.setParseResult(result)
 
     def show_result(self, q_item):
         #For an equation q_item list holds only ONE tuple
@@ -3872,6 +3904,9 @@ class Equation(QGraphicsRectItem):
             self.layoutEquation()
 
     def drawSymbolicResult(self, result, result_string):
+        #Only symbolic results get here, so sympy has already been imported
+        import sympy
+
         eqnlist = self.equationList
         append = eqnlist.append
         extend = eqnlist.extend
@@ -3988,6 +4023,8 @@ class Equation(QGraphicsRectItem):
         self.length += mat_size
 
     def insertSymbolicMatrixResult(self, result):
+        import sympy
+
         eqnlist = self.equationList
         append = eqnlist.append
         extend = eqnlist.extend
@@ -4166,34 +4203,3 @@ class Equation(QGraphicsRectItem):
             #retval = [EquationChar(self, s1, s1, font)]
 
         return retval
-
-    def checkForSymbolicVars(self, worksheet_variables, numerical_vars, symbolic_vars):
-        self.is_symbolic = False
-
-        for variable_name in self.inputVariables:
-            variable = worksheet_variables.get(variable_name) # Get actual value, return None if not in dict
-            m = type(variable).mro()
-
-            #Do a string search for sympy.  This seems to be about 10x faster than doing,
-            #for example: if '_evalf' in dir(variable)
-            if 'sympy' in str(m) or (isinstance(variable, scipy.ndarray) and variable.dtype.name == 'object'):
-                self.is_symbolic = True
-                return
-
-        for function_name in self.inputFunctions:
-            if worksheet_variables.has_key(function_name):
-                function = worksheet_variables[function_name]
-            elif numerical_vars.has_key(function_name):
-                function = numerical_vars[function_name]
-            elif symbolic_vars.has_key(function_name):
-                function = symbolic_vars[function_name]
-            else:
-                function = None
-            #function = worksheet_variables.get(function_name) # Get actual value, return None if not in dict
-            m = type(function)
-
-            #Do a string search for sympy.  This seems to be about 10x faster than doing,
-            #for example: if '_evalf' in dir(variable)
-            if 'sympy' in str(m):
-                self.is_symbolic = True
-                return
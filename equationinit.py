@@ -21,11 +21,15 @@
 
 '''This file is executed to fill the worksheet namespace before any equations are executed. It is shared by all equations'''
 
-import sympy
 import scipy
+import ast as __ast
+import purity as __purity
 import time as __time_module
 
-expand          = sympy.expand
+#Sympy is only imported once an equation calls expand, numeric worksheets never need it
+def expand(*args, **kwargs):
+    import sympy
+    return sympy.expand(*args, **kwargs)
 
 def time(n):
     if n <=1:
@@ -33,18 +37,235 @@ def time(n):
     else:
         return scipy.array([__time_module.time() for i in xrange(n)])
 
-#Rational class
-#Creates an instance of Rational suitably initialized
-class rational(sympy.Rational):
-    def __new__(cls, p, q=1):
-        r = sympy.Rational
-        num = r(str(p))
-        denom = r(str(q))
-        return num/denom
+#Hanging index expressions work out the same expression for every value of the index variables, so
+#numpy broadcasting can usually do the looping. Each index variable holding an array is replaced by the
+#array turned along its own axis of the result (first index variable along the first axis, as the loops
+#below nest them) and the expression is worked out once. Gathers such as y[i, j+1] become fancy indexing
+#and assignments such as x[i, j] = ... a single scatter. The answer is only used if it has the shape
+#and type the loops would give and agrees with the loops at a few spot checks, anything else (functions
+#that only take numbers, complex or symbolic results, assignments reading the array they assign, ...)
+#is left to the loops. So are expressions that would do harm when worked out again by the loops, e.g.
+#drawing random numbers or calling a worksheet function assigning globals, see purity.py.
+
+def __index_grid(index_vars, g):
+    """The names of the index variables holding arrays, the arrays and the shape of the result. None if
+    the loops have to be used, i.e. an index variable is not defined, holds anything else than a one
+    dimensional array or holds an empty one."""
+    names = []
+    arrays = []
+    for varname in index_vars:
+        if varname not in g:
+            return None
 
+        var = g[varname]
+        if isinstance(var, scipy.ndarray):
+            if var.ndim != 1 or len(var) == 0 or type(var) is not scipy.ndarray:
+                return None
+            names.append(varname)
+            arrays.append(var)
+
+    if not names:
+        return None
+
+    return names, arrays, tuple([len(array) for array in arrays])
+
+def __set_index_variables(names, arrays, g):
+    #Turn each array along its own axis so they broadcast to the shape of the result
+    for axis, (name, array) in enumerate(zip(names, arrays)):
+        shape = [1] * len(arrays)
+        shape[axis] = len(array)
+        g[name] = array.reshape(shape)
+
+def __spot_points(shape):
+    #First, last and middle element of the result, and one off the diagonal
+    points = [tuple([0] * len(shape)),
+              tuple([n - 1 for n in shape]),
+              tuple([n / 2 for n in shape]),
+              tuple([(n - 1) * (axis % 2) for axis, n in enumerate(shape)])]
+    return sorted(set(points))
+
+def __same_values(a, b):
+    """True if the arrays a and b hold the same numbers, give or take rounding"""
+    return bool(scipy.all((a == b) | (abs(a - b) <= 1e-9 * abs(b))))
+
+def __code_names(code):
+    #Global names read by code and the functions defined inside it
+    names = list(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, type(code)):
+            names.extend(__code_names(const))
+    return names
+
+def __reads_name(names, name, g, seen=None):
+    """True if code reading the given names can read name from g, directly or through functions
+    defined on the worksheet"""
+    if seen is None:
+        seen = set()
+
+    for other in names:
+        if other == name:
+            return True
+        if other in seen:
+            continue
+        seen.add(other)
+
+        code = getattr(g.get(other), 'func_code', None)
+        if code is not None and __reads_name(__code_names(code), name, g, seen):
+            return True
+
+    return False
+
+def __broadcast_index_expression(index_vars, expression, g):
+    """The result __loop_thru_index_variables would return, worked out without the loops. None if the
+    expression has to be left to the loops."""
+    grid = __index_grid(index_vars, g)
+    if grid is None:
+        return None
+    names, arrays, shape = grid
+
+    result = __zeros(list(shape))
+    if result.dtype.hasobject:
+        return None
+
+    code = compile(expression, '<index expression>', 'eval')
+    if not __purity.pure_code(code, g):
+        return None
+
+    saved = dict([(name, g[name]) for name in names])
+    try:
+        try:
+            __set_index_variables(names, arrays, g)
+            values = eval(code, g)
+            if not isinstance(values, scipy.ndarray) or values.dtype.kind not in 'biuf':
+                return None
+            result[...] = values
+
+            #Work out the spot checks the way the loops do, one element at a time
+            points = __spot_points(shape)
+            expected = __zeros(len(points))
+            for n, point in enumerate(points):
+                for name, array, k in zip(names, arrays, point):
+                    g[name] = array[k]
+                expected[n] = eval(code, g)
+        except (TypeError, ValueError, IndexError, KeyError, NameError, ArithmeticError, AttributeError):
+            return None
+    finally:
+        g.update(saved)
+
+    if not __same_values(scipy.array([result[point] for point in points]), expected):
+        return None
+
+    return result
+
+def __broadcast_index_assignment(index_vars, expression, indexed_label, index_variables_lhs, index_of_label, variables_dict):
+    """Does what __loop_thru_index_variables2 does without the loops. Returns False, having changed
+    nothing, if the assignment has to be left to the loops."""
+    if len(index_of_label) <= 2:
+        return False
+
+    grid = __index_grid(index_vars, variables_dict)
+    if grid is None:
+        return False
+    names, arrays, shape = grid
+
+    #Only a single assignment to an element of indexed_label, e.g. _x[_i, _j] = (_y[_i, _j+1])
+    statement = __ast.parse(expression).body
+    if len(statement) != 1 or not isinstance(statement[0], __ast.Assign) or len(statement[0].targets) != 1:
+        return False
+    target = statement[0].targets[0]
+    if not isinstance(target, __ast.Subscript) or not isinstance(target.slice, __ast.Index) or \
+       not isinstance(target.value, __ast.Name) or target.value.id != indexed_label:
+        return False
+
+    #The loops see the elements assigned so far, working out everything first does not
+    index_node = target.slice.value
+    value_node = statement[0].value
+    read = [node.id for node in __ast.walk(index_node) if isinstance(node, __ast.Name)]
+    read += [node.id for node in __ast.walk(value_node) if isinstance(node, __ast.Name)]
+    if __reads_name(read, indexed_label, variables_dict):
+        return False
+
+    index_code = compile(__ast.Expression(index_node), '<index>', 'eval')
+    value_code = compile(__ast.Expression(value_node), '<index expression>', 'eval')
+    if not __purity.pure_code(index_code, variables_dict) or not __purity.pure_code(value_code, variables_dict):
+        return False
+
+    #Same array the loops would assign into, grown the same way. Complex values going into a real
+    #array and symbolic arrays are left to the loops, which work out the type by trial and error
+    new_dimensions = __indexed_array_dimensions(index_variables_lhs, index_of_label, variables_dict)
+    old = variables_dict.get(indexed_label)
+    if isinstance(old, scipy.ndarray) and old.ndim == len(new_dimensions):
+        new_dimensions = [max(x, y) for x, y in zip(old.shape, new_dimensions)]
+        if new_dimensions == list(old.shape):
+            array = old
+        else:
+            array = __zeros(new_dimensions, dtype=old.dtype if old.dtype.kind in 'cO' else float)
+            array[tuple([slice(0, n) for n in old.shape])] = old
+    else:
+        array = __zeros(new_dimensions)
+    if array.dtype.hasobject:
+        return False
+
+    saved = dict([(name, variables_dict[name]) for name in names])
+    try:
+        try:
+            __set_index_variables(names, arrays, variables_dict)
+            index = eval(index_code, variables_dict)
+            values = eval(value_code, variables_dict)
+            if not isinstance(index, tuple):
+                index = (index, )
+            index = [scipy.asarray(part) for part in index]
+            values = scipy.asarray(values)
+
+            #Every loop has to show up in the index, one element is assigned on each pass
+            if len(index) != array.ndim or [part for part in index if part.dtype.kind not in 'iu']:
+                return False
+            if scipy.broadcast(*index).shape != shape:
+                return False
+            if values.dtype.kind not in 'biufc' or (values.dtype.kind == 'c' and array.dtype.kind != 'c'):
+                return False
+            if values.dtype.kind not in 'biu' and array.dtype.kind in 'biu':
+                return False
+            values = scipy.broadcast_to(values, shape)
+
+            #An element out of range or assigned twice is left to the loops
+            index = scipy.broadcast_arrays(*index)
+            for part, n in zip(index, array.shape):
+                if part.min() < -n or part.max() >= n:
+                    return False
+            flat = scipy.ravel_multi_index([part % n for part, n in zip(index, array.shape)], array.shape)
+            assigned = scipy.zeros(array.size, dtype=bool)
+            assigned[flat] = True
+            if assigned.sum() != flat.size:
+                return False
+
+            #Work out the spot checks the way the loops do, one element at a time
+            for point in __spot_points(shape):
+                for name, var, k in zip(names, arrays, point):
+                    variables_dict[name] = var[k]
+                expected_index = eval(index_code, variables_dict)
+                if not isinstance(expected_index, tuple):
+                    expected_index = (expected_index, )
+                if list(expected_index) != [part[point] for part in index]:
+                    return False
+                if not __same_values(values[point], eval(value_code, variables_dict)):
+                    return False
+        except (TypeError, ValueError, IndexError, KeyError, NameError, ArithmeticError, AttributeError):
+            return False
+    finally:
+        variables_dict.update(saved)
+
+    array[tuple(index)] = values
+    variables_dict[indexed_label] = array
+    return True
 
 #Do some voodoo magic to wrap for loops around any expression containing hanging indices
 def __loop_thru_index_variables(index_vars, expression, g):
+    #Work out the whole result in one go when the expression allows it
+    result = __broadcast_index_expression(index_vars, expression, g)
+    if result is not None:
+        return result
+
     indent = ''
     program_init = ''
     program = ''
@@ -149,7 +370,31 @@ def __loop_thru_index_variables(index_vars, expression, g):
 #global keyword above so that any functions called within the within expression have access
 #to the loop variables (i,j in this case).
 #
+def __indexed_array_dimensions(index_variables_lhs, index_of_label, variables_dict):
+    """Dimensions the array assigned by an equation such as x[i-1, j] = ... needs, going by the largest
+    value of each index variable on the left hand side"""
+    max_var_values = {}
+    for varname in index_variables_lhs:   # These index variables appear in the index on the left hand side
+
+        if varname in variables_dict:
+            var = variables_dict[varname]
+
+        else:
+            raise NameError('name ' + varname + ' is not defined')
+
+        #Get maximum value of index variable if it is an array type
+        if isinstance(var, scipy.ndarray):
+            max_var_values[varname] = var.max()
+
+    #Determine size of new array of zeros by evaluating max value of each dimension
+    new_dimensions = eval(index_of_label, variables_dict, max_var_values)
+    return [x+1 for x in new_dimensions]
+
 def __loop_thru_index_variables2(index_vars, expression, indexed_label, index_variables_lhs, index_of_label, variables_dict):
+    #Assign the whole result in one go when the equation allows it
+    if __broadcast_index_assignment(index_vars, expression, indexed_label, index_variables_lhs, index_of_label, variables_dict):
+        return
+
     indent = '    '
     program_init1 = ''
     program_init2a = ''
@@ -169,22 +414,7 @@ def __loop_thru_index_variables2(index_vars, expression, indexed_label, index_va
     if len(index_of_label) > 2:  # 2 because index_of_label is a string that can be "[x,y,z]" = "[]" when x,y,z do not exist
 
         #Determine dimensions of result array (left hand side of equation)
-        max_var_values = {}
-        for varname in index_variables_lhs:   # These index variables appear in the index on the left hand side
-
-            if varname in variables_dict:
-                var = variables_dict[varname]
-
-            else:
-                raise NameError('name ' + varname + ' is not defined')
-
-            #Get maximum value of index variable if it is an array type
-            if isinstance(var, scipy.ndarray):
-                max_var_values[varname] = var.max()
-
-        #Determine size of new array of zeros by evaluating max value of each dimension
-        new_dimensions = eval(index_of_label, variables_dict, max_var_values)
-        new_dimensions = [x+1 for x in new_dimensions]
+        new_dimensions = __indexed_array_dimensions(index_variables_lhs, index_of_label, variables_dict)
 
         #Make sure result is placed in globals so other equations in worksheet can see it
         program_init1 += "global %s\n" % indexed_label
@@ -18,52 +18,49 @@
 #   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
 #------------------------------------------------------------------------------
 
-import copy
-
 from PyQt4.QtCore import *
 
 import threading
 import time
 import Queue
-import sys
-import scipy
+
+import executor
 
 class ExecThread(QThread):
 
     #Define a signal that takes an integer arguement
     show_results_signal = pyqtSignal((int, ), name='show_results_signal')
 
-    def __init__(self, parent):
-
-        #Setup the global name space which is shared between all equations in worksheet
-        self.numerics_global_namespace = {}
-        self.symbolics_global_namespace = {}
-        self.worksheet_variable_namespace = {}
-
-        f = open('numerics_init.py')
-        numerics_init_program = f.read()
-        f.close()
-
-        f = open('symbolics_init.py')
-        symbolics_init_program = f.read()
-        f.close()
+    def __init__(self, parent, backend='thread'):
 
-        f = open('equationinit.py')
-        equation_init_program = f.read()
-        f.close()
-
-        exec numerics_init_program in self.numerics_global_namespace    # execfile goes away in 3.0
-        exec symbolics_init_program in self.symbolics_global_namespace    # execfile goes away in 3.0
-
-        exec equation_init_program in self.numerics_global_namespace    # execfile goes away in 3.0
-        exec equation_init_program in self.symbolics_global_namespace    # execfile goes away in 3.0
+        #Create the object that actually runs the equation programs and holds the worksheet namespace.
+        #'thread' runs programs in this thread, 'process' in a worker process.
+        self.backend = backend
+        self.executor = executor.backends[backend]()
 
         #Create Q to hold incomming equation mini-programs
         self.program_q = Queue.Queue()
 
+        #Held while a run is put on the Q, so the thread can take all of it in one go.
+        #The batch is the run being executed that way, with the IDs taken off its items.
+        self.submit_lock = threading.Lock()
+        self.batch = []
+        self.batch_ids = []
+
         #Create Q to hold results
         self.results_q = Queue.Queue()
 
+        #Set while a show_results_signal is on its way to the GUI, so one signal covers many results
+        self.delivery_pending = False
+
+        #IDs of equations/plots that were stopped or ran out of time, they have to be run again
+        self.interrupted = []
+
+        #When each queued equation/plot was put on the Q, and for each one whose results are on the results
+        #Q a tuple (seconds it waited, seconds it ran, time its results were put on the Q). By object ID.
+        self.submit_times = {}
+        self.timings = {}
+
         #Create an event
         #Equations in worksheet will only get run when this event is set
         self.execution_event = threading.Event()
@@ -77,9 +74,6 @@ class ExecThread(QThread):
 
     def run(self):
 
-        symbolics_globals = self.symbolics_global_namespace
-        numerics_globals = self.numerics_global_namespace
-
         #Forever loop waits for commands to execute all equations from main thread
         while(1):
 
@@ -87,108 +81,178 @@ class ExecThread(QThread):
             #Each item in Q is a list, e.g. [(...), (...), object_id]
             q_item = self.program_q.get()
 
+            if self.executor.parallel_workers > 1:
+                #Take the rest of the run as well, equations in it that do not depend on each other
+                #can then be run side by side
+                self.submit_lock.acquire()
+                try:
+                    q_items = [q_item] + self.take_queued()
+                    if len(q_items) > 1:
+                        self.batch_ids = [temp.pop() for temp in q_items]
+                        self.batch = q_items
+                finally:
+                    self.submit_lock.release()
+
+                if len(q_items) > 1:
+                    self.execute_batch()
+                    continue
+
             #Item off Q is a list. Last element of list is ID of equation/plot
             object_id = q_item.pop()
 
-            results = []
-
             #Loop through equation(s). Plots have more than one equation.
-            for temp in q_item:
-
-                #Updack data
-                program = temp[0]
-                inputvars = temp[1]
-                inputfuncs = temp[2]
-                has_result = temp[3]
-                force_symbolic = temp[4]
-
-                try:
-                    if force_symbolic:
-                        self.worksheet_variable_namespace.update(symbolics_globals)
-                        exec program in self.worksheet_variable_namespace
-                        is_symbolic = True
-
-                    else:
-                        #Look for any symbolic variables/functions used by this equation (self)
-                        self.worksheet_variable_namespace.update(numerics_globals)
-                        is_symbolic = self.check_for_symbolic_vars(inputvars, inputfuncs)
-
-                        if is_symbolic:
-                            self.worksheet_variable_namespace.update(symbolics_globals)
-                            exec program in self.worksheet_variable_namespace
-                        else:
-                            self.worksheet_variable_namespace.update(numerics_globals)
-                            exec program in self.worksheet_variable_namespace
-
-                    #Remember result
-                    if has_result:
-                        result = self.worksheet_variable_namespace['__result']
-                    else:
-                        result = None
-
-                    error = None
-
-                except:
-                    result = None
-                    error = str(sys.exc_value)
-
-                #Put results on output Q and notify parent thread via a Qt signal
-                #We use copy.copy here so that the value of result at this instant is sent in the Q.
-                #Since the Q object is sent asynchronously if we used 'result' without the copy the
-                #value sent could be random.  Presumably result is a reference (pointer) to some memory location
-                #that gets read at the time the Q object is sent which maybe be sometime after the put() call.
-                t = (copy.copy(result), error, is_symbolic)
-                results.append(t)
+            restarts = self.executor.restarts
+            start_time = time.time()
+            try:
+                results = self.executor.execute(q_item)
+            except executor.ComputationStopped:
+                #Stop or time out went off just as a program finished
+                results = [(None, 'Computation stopped', False) for temp in q_item]
+                self.executor.interrupted = True
+            run_time = time.time() - start_time
+
+            if self.executor.interrupted:
+                self.interrupted.append(object_id)
 
             results.append(object_id)
 
             #Send result back to main thread
             #Format is: [(result,error,is_symbolic), (...), (...), object_id]
-            self.results_q.put(results)
-            self.show_results_signal.emit(object_id)
-
-    def check_for_symbolic_vars(self, inputvars, inputfuncs):
-
-        numerical_vars = self.numerics_global_namespace
-        symbolic_vars = self.symbolics_global_namespace
-        worksheet_variables = self.worksheet_variable_namespace
-
-        #Find any symbolic type variables
-        for variable_name in inputvars:
-            variable = worksheet_variables.get(variable_name) # Get actual value, return None if not in dict
-            m = type(variable).mro()
-
-            #Do a string search for sympy.  This seems to be about 10x faster than doing,
-            #for example: if '_evalf' in dir(variable)
-            if 'sympy' in str(m) or (isinstance(variable, scipy.ndarray) and variable.dtype.name == 'object'):
-                return True
-
-        #Find any symbolic type functions
-        for function_name in inputfuncs:
-            if worksheet_variables.has_key(function_name):
-                function = worksheet_variables[function_name]
-            elif symbolic_vars.has_key(function_name):
-                function = symbolic_vars[function_name]
-            else:
-                function = None
-            #function = worksheet_variables.get(function_name) # Get actual value, return None if not in dict
-            m = type(function)
-
-            #Do a string search for sympy.  This seems to be about 10x faster than doing,
-            #for example: if '_evalf' in dir(variable)
-            if 'sympy' in str(m):
-                self.isSymbolic = True
-                return True
-
-        return False
+            self.post_results(results, start_time, run_time)
+
+            #A hung worker was replaced by one with an empty namespace, the rest of the run can not be
+            #run on it. Send it back so it gets run again, together with everything else, on the next run.
+            if self.executor.restarts != restarts:
+                self.send_back(self.drain(), 'Computation stopped')
+
+    def execute_batch(self):
+        """Run the batch, results come back in the order the items were sent"""
+        object_ids = self.batch_ids
+
+        def deliver(index, results, interrupted, start_time, run_time):
+            if interrupted:
+                self.interrupted.append(object_ids[index])
+            results.append(object_ids[index])
+            self.post_results(results, start_time, run_time)
+
+        self.executor.execute_batch(self.batch, deliver)
+
+    def post_results(self, results, start_time=None, run_time=0.0):
+        """Put results on the results Q. The GUI is only signalled if it is not already due to collect them.
+        start_time and run_time are when the programs were started and how long they took, if they were run."""
+        object_id = results[-1]
+        submit_time = self.submit_times.pop(object_id, None)
+        if start_time is not None and submit_time is not None:
+            self.timings[object_id] = (max(start_time - submit_time, 0.0), run_time, time.time())
+
+        self.results_q.put(results)
+        if not self.delivery_pending:
+            self.delivery_pending = True
+            self.show_results_signal.emit(results[-1])
+
+    def results_delivered(self):
+        """Called by the GUI before it empties the results Q, anything put on the Q after this gets a new signal"""
+        self.delivery_pending = False
+
+    def set_backend(self, backend):
+        """Switch to a new execution backend. The worksheet namespace starts out empty again."""
+        if backend != self.backend:
+            old_executor = self.executor
+            self.executor = executor.backends[backend]()
+            self.executor.set_time_limit(old_executor.time_limit)
+            self.backend = backend
+            old_executor.close()
+
+    def stop_backend(self):
+        self.executor.close()
 
     def reset(self):
-        self.worksheet_variable_namespace = {}
+        self.executor.reset()
 
     def do_computation(self, program):
+        self.submit_times[program[-1]] = time.time()
         self.program_q.put(program)
 
-    def stop_computations(self):
-        #Still need to figure out how to stop the thread if it is in the middle of a looong run
-        pass
+    def do_computations(self, programs):
+        """Queue a whole run"""
+        self.submit_lock.acquire()
+        try:
+            submit_time = time.time()
+            for program in programs:
+                self.submit_times[program[-1]] = submit_time
+                self.program_q.put(program)
+        finally:
+            self.submit_lock.release()
+
+    def set_time_limit(self, seconds):
+        self.executor.set_time_limit(seconds)
+
+    def set_parallel_workers(self, workers):
+        self.executor.set_parallel_workers(workers)
+
+    def set_elementwise_threads(self, threads):
+        self.executor.set_elementwise_threads(threads)
+
+    def set_result_cache(self, megabytes):
+        """Reuse results of equations whose program and input values are unchanged, 0 turns it off"""
+        self.executor.set_result_cache(megabytes)
+
+    def take_queued(self):
+        items = []
+        while(1):
+            try:
+                items.append(self.program_q.get_nowait())
+            except Queue.Empty:
+                break
+
+        return items
+
+    def drain(self):
+        """Throw away work that has not been started yet, including what is left of a batch being run.
+        Returns the items thrown away."""
+        self.submit_lock.acquire()
+        try:
+            items = self.take_queued()
+            for index in self.executor.withdraw():
+                items.append(self.batch[index] + [self.batch_ids[index]])
+        finally:
+            self.submit_lock.release()
+
+        for q_item in items:
+            self.submit_times.pop(q_item[-1], None)
 
+        return items
+
+    def stop_computations(self):
+        """Throw away queued work and stop the equation being run. The equations thrown away are sent
+        back with an error so they get marked on the worksheet."""
+        self.send_back(self.drain(), 'Computation stopped')
+        self.executor.stop()
+
+    def send_back(self, items, error):
+        """Post the items as interrupted with error, so they get marked on the worksheet and run again"""
+        for q_item in items:
+            object_id = q_item.pop()
+            self.interrupted.append(object_id)
+            results = [(None, error, False) for temp in q_item]
+            results.append(object_id)
+            self.post_results(results)
+
+    def take_timing(self, object_id):
+        """Returns (queue wait, run time, time the results were put on the results Q) of the results of
+        object_id just taken off the results Q, None if it was not run"""
+        return self.timings.pop(object_id, None)
+
+    def take_interrupted(self):
+        """Returns IDs of equations/plots that were stopped or timed out since the last call"""
+        object_ids = []
+        while self.interrupted:
+            object_ids.append(self.interrupted.pop(0))
+
+        return object_ids
+
+    def namespace_lost(self):
+        """True if the worksheet namespace was thrown away since the last call, e.g. a hung worker was killed"""
+        lost = self.executor.namespace_lost
+        self.executor.namespace_lost = False
+        return lost
@@ -0,0 +1,1196 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+'''Runs equation mini-programs inside a worksheet namespace.
+
+The scipy/sympy bindings set up by numerics_init.py and symbolics_init.py are built once per process
+into a numeric and a symbolic builtin layer shared by every worksheet (the symbolic one the first time
+it is needed).  A new worksheet namespace starts out as a copy of the numeric layer, and when an
+equation needs the other layer only the names the two layers bind differently are swapped, leaving
+the names the worksheet assigned alone.  '__builtins__' stays Python's own builtin module: frames
+running with a builtins dict of their own are in Python's restricted mode, which stops functions and
+classes from being looked into (func_globals, __dict__, ...).
+
+Executor does the work in the calling thread. ProcessExecutor has the same interface but
+hands the work over to a worker process which holds the worksheet namespace, so that heavy
+pure Python programs neither hold the GIL of the GUI process nor share its core.
+
+A running program can be stopped, and each program can be given a wall clock time limit.  Both
+work by raising an exception inside the thread running the program, which takes effect at the
+next Python bytecode.  A program stuck inside one long C call (e.g. a huge scipy.linalg solve)
+can only be stopped with the process backend, where the worker is killed if it does not respond.
+
+The thread backend can also be handed a whole run at once (execute_batch).  Equations that neither
+read nor write anything written by another are then run side by side on a pool of worker threads,
+which pays off for heavy scipy calls that let go of the GIL, e.g. two unrelated large solves or FFTs.
+Each of them runs in a private copy of the worksheet namespace, and what it assigns is copied back
+in screen order, so the results are the same as running the equations one after the other.'''
+
+import copy
+import sys
+import __builtin__
+import os
+import time
+import thread
+import threading
+import signal
+import ctypes
+import hashlib
+import multiprocessing
+import Queue
+import cPickle as pickle
+
+import scipy
+
+import programcache
+import resultcache
+import elementwise
+import purity
+
+
+class ComputationStopped(Exception):
+    pass
+
+
+class TimeLimitExceeded(ComputationStopped):
+    pass
+
+
+def raise_in_thread(thread_ident, exception):
+    '''Raise exception in another thread the next time it runs Python code. None clears a pending one.'''
+    if exception is None:
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(thread_ident), None)
+    else:
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(thread_ident), ctypes.py_object(exception))
+
+
+#Functions giving a different answer each time they are called. Equations calling them are kept in
+#screen order relative to each other, so they draw random numbers in the same order as before.
+impure_functions = purity.impure_functions
+
+#Made up name read and written by every equation calling an impure function
+random_state = '<random state>'
+
+#Made up name under which a namespace keeps the builtin layer its builtin names come from
+layer_key = '<builtin layer>'
+
+#Stands in for names that are not there
+missing = object()
+
+#Values that can not be changed in place, the result cache shares them rather than copying them
+immutable_types = (int, long, float, complex, bool, str, unicode, type(None), scipy.generic)
+
+
+def classify(value, symbolic_types):
+    '''True if value is symbolic. Result is cached per type in symbolic_types, except for arrays which
+    are symbolic if they hold objects.'''
+    if isinstance(value, scipy.ndarray):
+        return value.dtype.name == 'object'
+
+    value_type = type(value)
+    try:
+        return symbolic_types[value_type]
+    except KeyError:
+        #Do a string search for sympy.  This seems to be about 10x faster than doing,
+        #for example: if '_evalf' in dir(variable)
+        symbolic = 'sympy' in str(value_type.__mro__)
+        symbolic_types[value_type] = symbolic
+        return symbolic
+
+
+class BuiltinLayers(object):
+    """The builtin names seen by equation programs, set up by running numerics_init.py, symbolics_init.py
+    and equationinit.py from the program directory. Nothing writes to them once they are built (programs
+    assign into the worksheet namespace, and the helpers in the init files are handed that namespace),
+    so a single instance is shared by every Executor in the process, see builtin_layers().
+
+    Only the numeric layer is built up front. Setting up the symbolic one imports sympy, which takes
+    longer than anything else at start up, so it is left until an equation turns out to need it: one
+    forced to run symbolically, or one calling a function the numeric layer does not have."""
+
+    def __init__(self):
+        self.directory = os.path.dirname(os.path.abspath(__file__))
+        self.lock = threading.Lock()
+
+        self.numerics_global_namespace = {}
+        exec self.readInitFile('numerics_init.py') in self.numerics_global_namespace    # execfile goes away in 3.0
+        exec self.readInitFile('equationinit.py') in self.numerics_global_namespace    # execfile goes away in 3.0
+
+        #Layer looked up behind the worksheet variables
+        self.numerics_layer = self.makeLayer(self.numerics_global_namespace)
+
+        #Whether each builtin name is symbolic, see kind()
+        self.numeric_kinds = {}
+        self.symbolic_types = {}
+        for name, value in self.numerics_layer.iteritems():
+            self.numeric_kinds[name] = classify(value, self.symbolic_types)
+
+        #Built by the first call to symbolics()
+        self.symbolics_global_namespace = None
+        self.symbolics_layer = None
+        self.builtin_kinds = None
+        self.symbolic_names = None
+
+    def readInitFile(self, name):
+        f = open(os.path.join(self.directory, name))
+        program = f.read()
+        f.close()
+
+        return program
+
+    def symbolics(self):
+        '''The layer seen by symbolic equations, built by the first call'''
+        if self.symbolics_layer is None:
+            self.lock.acquire()
+            try:
+                if self.symbolics_layer is None:
+                    self.buildSymbolics()
+            finally:
+                self.lock.release()
+
+        return self.symbolics_layer
+
+    def buildSymbolics(self):
+        #Fill in locals first, a stop going off half way through leaves nothing half built behind
+        namespace = {}
+        exec self.readInitFile('symbolics_init.py') in namespace    # execfile goes away in 3.0
+        exec self.readInitFile('equationinit.py') in namespace    # execfile goes away in 3.0
+
+        #Symbolic equations see the numeric names too, with the sympy versions taking precedence
+        layer = self.makeLayer(self.numerics_global_namespace, namespace)
+
+        #A builtin is looked up in the numeric layer first, sympy only versions are looked up last
+        kinds = {}
+        for name, value in namespace.iteritems():
+            kinds[name] = classify(value, self.symbolic_types)
+        kinds.update(self.numeric_kinds)
+
+        #Names bound to something else than in the numeric layer, they are swapped when switching layers
+        numerics_layer = self.numerics_layer
+        symbolic_names = [name for name, value in layer.iteritems() if numerics_layer.get(name, missing) is not value]
+
+        self.symbolics_global_namespace = namespace
+        self.builtin_kinds = kinds
+        self.symbolic_names = symbolic_names
+        self.symbolics_layer = layer
+
+    def kind(self, name):
+        '''True if the builtin called name is symbolic, None if there is no such builtin'''
+        kind = self.numeric_kinds.get(name)
+        if kind is None:
+            self.symbolics()
+            kind = self.builtin_kinds.get(name)
+
+        return kind
+
+    def makeLayer(self, *namespaces):
+        '''Python builtins with the given namespaces on top, later ones taking precedence. The layer is
+        copied into the worksheet namespace, it never becomes a frame's builtins.'''
+        layer = dict(__builtin__.__dict__)
+        for namespace in namespaces:
+            layer.update(namespace)
+        del layer['__builtins__']
+
+        return layer
+
+
+shared_layers = None
+shared_layers_lock = threading.Lock()
+
+def builtin_layers():
+    '''The BuiltinLayers of this process, built by the first call'''
+    global shared_layers
+    shared_layers_lock.acquire()
+    try:
+        if shared_layers is None:
+            shared_layers = BuiltinLayers()
+        return shared_layers
+    finally:
+        shared_layers_lock.release()
+
+
+class Runner(object):
+    """State of the program being run by one thread, used to stop it from another thread. The thread
+    running programs never takes a lock, an exception going off while it held one would leave the
+    lock held for good."""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.thread_ident = thread.get_ident()
+        self.program_count = 0
+        self.deadline = None
+        self.running = False
+        self.raising = False
+
+    def startProgram(self):
+        self.program_count += 1
+        if self.executor.time_limit:
+            self.deadline = time.time() + self.executor.time_limit
+        else:
+            self.deadline = None
+        self.running = True
+
+        #Stop may have come in between programs of a plot
+        if self.executor.stop_requested:
+            raise ComputationStopped
+
+    def endProgram(self):
+        self.running = False
+        self.deadline = None
+
+        #Wait for a stop or time out that is being raised right now, then throw away any exception that
+        #was raised but has not gone off yet. The program is finished, it is too late to stop it.
+        while(1):
+            try:
+                while self.raising:
+                    time.sleep(0.001)
+                raise_in_thread(self.thread_ident, None)
+                return
+            except ComputationStopped:
+                pass
+
+    def interrupt(self, exception, program_count=None):
+        '''Raise exception in the thread, if it is still running the program given'''
+        self.lock.acquire()
+        self.raising = True
+        if self.running and program_count in (None, self.program_count):
+            raise_in_thread(self.thread_ident, exception)
+        self.raising = False
+        self.lock.release()
+
+
+class Watchdog(threading.Thread):
+    """Raises TimeLimitExceeded in any thread running a program once the program's deadline has passed"""
+
+    check_interval = 0.05
+    repeat_interval = 1.0       # Keep raising in case the exception gets swallowed by the program
+
+    def __init__(self, executor):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.executor = executor
+        self.start()
+
+    def run(self):
+        fired = {}      # Runner -> (program count, time) of the last exception raised
+
+        #Daemon thread, module globals may already be gone at interpreter shutdown
+        sleep = time.sleep
+        clock = time.time
+
+        while(1):
+            sleep(self.check_interval)
+
+            now = clock()
+            for runner in self.executor.runners.values():
+                count = runner.program_count
+                deadline = runner.deadline
+
+                if runner.running and deadline is not None and now > deadline:
+                    fired_count, fired_time = fired.get(runner, (None, 0))
+                    if count != fired_count or now - fired_time > self.repeat_interval:
+                        runner.interrupt(TimeLimitExceeded, count)
+                        fired[runner] = (count, now)
+
+
+class WorkerPool(object):
+    """Threads running work items of a batch side by side, see Executor.execute_batch()"""
+
+    def __init__(self, executor, size):
+        self.executor = executor
+        self.size = size
+        self.tasks = Queue.Queue()
+        self.done = Queue.Queue()
+
+        self.threads = []
+        for i in xrange(size):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def work(self):
+        while(1):
+            task = self.tasks.get()
+            if task is None:
+                break
+
+            index, q_item, codes, namespace = task
+            start_time = time.time()
+            try:
+                results, interrupted = self.executor.executeItem(q_item, namespace, codes)
+            except:
+                #The thread must carry on, the batch waits for every item it was given
+                results = [(None, str(sys.exc_value), False) for temp in q_item]
+                interrupted = isinstance(sys.exc_value, ComputationStopped)
+
+            self.done.put((index, (results, interrupted, start_time, time.time() - start_time)))
+
+        self.executor.runners.pop(thread.get_ident(), None)
+
+    def close(self):
+        for t in self.threads:
+            self.tasks.put(None)
+
+
+class Executor(object):
+
+    namespace_lost = False     # Never set, the namespace lives in this process
+    restarts = 0               # Never changes either
+    max_auto_workers = 4       # Most worker threads picked when asked for one per core
+    parallel_threshold = 0.005 # Seconds, quicker equations are not worth handing to a worker thread
+    max_run_times = 10000
+
+    def __init__(self):
+
+        #Time limit per program in seconds, 0 means no limit
+        self.time_limit = 0
+        self.watchdog = None
+
+        #State of the programs being run, one Runner per thread running them, by thread ident
+        self.runners = {}
+        self.stop_requested = False
+        self.interrupted = False
+
+        #Worker threads for running independent equations side by side, 1 runs everything in order.
+        #The lock guards the levels of the batch still to be started, see withdraw().
+        self.parallel_workers = 1
+        self.pool = None
+        self.lock = threading.Lock()
+        self.pending_levels = []
+
+        #How long each program took the last time it was run, by program text
+        self.run_times = {}
+
+        #Compiled programs, they stay valid when the namespace is reset
+        self.program_cache = programcache.ProgramCache()
+
+        #Results of programs by the values they read, also kept when the namespace is reset. Off unless
+        #turned on with set_result_cache().
+        self.result_cache = None
+
+        #Builtin names the programs see, shared with every other worksheet in this process
+        self.layers = builtin_layers()
+        self.numerics_layer = self.layers.numerics_layer
+
+        #The namespace which is shared between all equations in worksheet
+        self.worksheet_variable_namespace = self.new_namespace()
+
+        #Whether each name is symbolic: worksheet names as they get assigned
+        self.symbolic_types = {}
+        self.kinds = {}
+
+        #Names read by each function defined on the worksheet, and the functions that write into the
+        #namespace they are called from (e.g. sums and substitutions). Used to schedule batches.
+        self.function_inputs = {}
+        self.namespace_functions = set([])
+
+        #Program defining each function on the worksheet
+        self.function_programs = {}
+
+    def execute(self, q_item):
+        """Run all the programs of one equation/plot.
+        q_item is a list of tuples, e.g. [(program, inputvars, inputfuncs, has_result, force_symbolic, outputvars), (...)]
+        Returns a list of tuples, one per program: [(result, error, is_symbolic), (...)]
+        Sets self.interrupted if any of the programs was stopped or ran out of time."""
+
+        self.stop_requested = False
+        results, self.interrupted = self.executeItem(q_item, self.worksheet_variable_namespace)
+
+        return results
+
+    def executeItem(self, q_item, namespace, codes=None):
+        '''Run the programs of one equation/plot in namespace, codes being the compiled programs if they
+        already are. Returns a tuple (results, interrupted).'''
+        runner = self.runner()
+        results = []
+
+        try:
+            interrupted = self.executePrograms(q_item, namespace, codes, runner, results)
+
+        except ComputationStopped:
+            #Stop or time out went off just as a program finished
+            runner.endProgram()
+            interrupted = True
+            while len(results) < len(q_item):
+                results.append((None, 'Computation stopped', False))
+
+        return results, interrupted
+
+    def runner(self):
+        '''Runner of the calling thread'''
+        ident = thread.get_ident()
+        runner = self.runners.get(ident)
+        if runner is None:
+            runner = Runner(self)
+            self.runners[ident] = runner
+
+        return runner
+
+    def executePrograms(self, q_item, namespace, codes, runner, results):
+        interrupted = False
+
+        #Loop through equation(s). Plots have more than one equation.
+        for n, temp in enumerate(q_item):
+
+            #Updack data
+            program = temp[0]
+            inputvars = temp[1]
+            inputfuncs = temp[2]
+            has_result = temp[3]
+            force_symbolic = temp[4]
+            if len(temp) > 5:
+                outputvars = temp[5]
+            else:
+                outputvars = ()
+            is_symbolic = force_symbolic
+
+            #Rest of a plot is skipped once it has been stopped
+            if self.stop_requested:
+                results.append((None, 'Computation stopped', is_symbolic))
+                interrupted = True
+                continue
+
+            #Reuse the result of an earlier run that read the same values. Values that can not be
+            #fingerprinted (unusual objects, ...) are simply a cache miss.
+            key = None
+            entry = None
+            if self.result_cache is not None:
+                try:
+                    key = self.result_key(program, inputvars, inputfuncs, outputvars, force_symbolic, namespace)
+                    if key is not None:
+                        entry = self.result_cache.get(key)
+                    if entry is not None:
+                        #The namespace and the GUI get copies, anything changing them in place would
+                        #change the cached result too
+                        result, outputs, is_symbolic = entry
+                        outputs = [(name, self.snapshot(value)) for name, value in outputs]
+                        entry = (self.snapshot(result), outputs, is_symbolic)
+                except ComputationStopped:
+                    raise
+                except Exception:
+                    key = None
+                    entry = None
+
+            if entry is not None:
+                result, outputs, is_symbolic = entry
+                for name, value in outputs:
+                    namespace[name] = value
+                self.record_kinds(outputvars, namespace)
+                results.append((result, None, is_symbolic))
+                continue
+
+            try:
+                try:
+                    #Compiled before the program starts, so a stop or time out never goes off inside the
+                    #program cache and compiling does not count against the time limit
+                    if codes is None:
+                        code = self.program_cache.compile(program)
+                    else:
+                        code = codes[n]
+                    runner.startProgram()
+
+                    if not force_symbolic:
+                        #Look for any symbolic variables/functions used by this equation (self)
+                        is_symbolic = self.check_for_symbolic_vars(inputvars, inputfuncs)
+
+                    #Switch builtin layer, the worksheet variables stay where they are
+                    if is_symbolic:
+                        self.switch_layer(namespace, self.layers.symbolics())
+                    else:
+                        self.switch_layer(namespace, self.numerics_layer)
+
+                    #Arrays handed to the GUI are read-only, copy the ones this program assigns into. Functions
+                    #defined on the worksheet can write into anything they read, so copy those too. Programs are
+                    #never run twice, anything that still writes into a read-only array is the equation's error.
+                    self.thaw([name for name in inputvars if name in outputvars], namespace)
+                    if inputfuncs:
+                        self.thaw(self.expand_function_inputs(inputfuncs, self.function_inputs), namespace)
+
+                    start_time = time.time()
+                    exec code in namespace
+
+                    run_times = self.run_times
+                    if len(run_times) >= self.max_run_times:
+                        run_times.clear()
+                    run_times[program] = time.time() - start_time
+
+                    #Remember result
+                    if has_result:
+                        result = namespace['__result']
+                    else:
+                        result = None
+
+                    error = None
+
+                except TimeLimitExceeded:
+                    result = None
+                    error = 'Time limit of %g s exceeded' % self.time_limit
+                    interrupted = True
+
+                except ComputationStopped:
+                    result = None
+                    error = 'Computation stopped'
+                    interrupted = True
+
+                except:
+                    result = None
+                    error = str(sys.exc_value)
+
+            finally:
+                runner.endProgram()
+
+            self.record_kinds(outputvars, namespace)
+            for name in outputvars:
+                if not name.startswith('_'):
+                    self.record_function(name, program, inputvars, inputfuncs, self.function_inputs,
+                                         self.namespace_functions)
+                    self.function_programs[name] = program
+
+            if key is not None and error is None:
+                try:
+                    self.store_result(key, result, outputvars, is_symbolic, namespace)
+                except ComputationStopped:
+                    raise
+                except Exception:
+                    pass
+
+            #The value of result at this instant is what has to be sent in the Q. The Q object is read
+            #asynchronously by the GUI, so anything a later equation changes in place could show up there.
+            t = (self.handoff(result), error, is_symbolic)
+            results.append(t)
+
+        return interrupted
+
+    def result_key(self, program, inputvars, inputfuncs, outputvars, force_symbolic, namespace):
+        '''Digest of program and the values it reads, None if its result can not be reused'''
+
+        #Programs can assign anything through global statements, and functions have to be defined
+        if 'def __program_function' in program:
+            return None
+        for name in outputvars:
+            if not name.startswith('_'):
+                return None
+
+        #Functions read the names they use when they are called
+        names = self.expand_function_inputs(set(inputvars) | set(inputfuncs), self.function_inputs)
+        if names & impure_functions:
+            return None
+
+        digest = hashlib.md5(program)
+        digest.update(str(bool(force_symbolic)))
+        for name in sorted(names):
+            if name in self.function_programs:
+                value_digest = self.function_programs[name]
+            elif self.is_assigned(name, namespace):
+                value_digest = resultcache.fingerprint(namespace[name])
+                if value_digest is None:
+                    return None
+            else:
+                #Builtin function, or not defined at all
+                value_digest = ''
+            digest.update('\0%s\0%s' % (name, value_digest))
+
+        return digest.hexdigest()
+
+    def store_result(self, key, result, outputvars, is_symbolic, namespace):
+        result = self.snapshot(result)
+        size = resultcache.sizeof(result)
+        outputs = []
+        for name in outputvars:
+            if name in namespace:
+                value = self.snapshot(namespace[name])
+                outputs.append((name, value))
+                size += resultcache.sizeof(value)
+
+        self.result_cache.put(key, (result, outputs, is_symbolic), size)
+
+    def execute_batch(self, q_items, deliver):
+        """Run the work items of a whole run, letting items that do not depend on each other run side by
+        side on the worker threads. deliver(index, results, interrupted, start_time, run_time) is called
+        once for each item in the order given, with what execute() would have returned running them one
+        after the other, when the item was started and how long it took.
+        Items taken back by withdraw() before they were started are neither run nor delivered."""
+
+        self.stop_requested = False
+
+        if self.parallel_workers > 1:
+            #Pool is (re)started here, never while a program is running, see set_time_limit()
+            if self.pool is None or self.pool.size != self.parallel_workers:
+                if self.pool is not None:
+                    self.pool.close()
+                self.pool = WorkerPool(self, self.parallel_workers)
+
+        levels, serial = self.schedule(q_items)
+
+        self.lock.acquire()
+        self.pending_levels = levels
+        self.lock.release()
+
+        finished = {}
+        next_index = 0
+        while(1):
+            self.lock.acquire()
+            if self.pending_levels:
+                level = self.pending_levels.pop(0)
+            else:
+                level = None
+            self.lock.release()
+
+            if level is None:
+                break
+
+            self.executeLevel(q_items, level, serial, finished)
+
+            #Hand over results in the order given, as far as they are available
+            while next_index in finished:
+                deliver(next_index, *finished.pop(next_index))
+                next_index += 1
+
+        #Anything behind an item that was withdrawn
+        for index in sorted(finished):
+            deliver(index, *finished[index])
+
+    def executeLevel(self, q_items, level, serial, finished):
+        '''Run the items of one level, putting (results, interrupted, start_time, run_time) for each of them
+        in finished'''
+        namespace = self.worksheet_variable_namespace
+
+        #Items that may run in a namespace of their own. Symbolic items are left out, they only show up
+        #once the kinds of the names they read are known, i.e. now. So are items that were quick the last
+        #time they ran, copying the namespace and switching threads would take longer than they do.
+        parallel = []
+        codes = {}
+        if self.pool is not None and len(level) > 1 and not self.stop_requested:
+            for index in level:
+                q_item = q_items[index]
+                if index in serial or self.is_quick_item(q_item) or self.is_symbolic_item(q_item):
+                    continue
+
+                #Program cache is not thread safe, so compile here. Errors are reported when run on its own.
+                try:
+                    codes[index] = [self.program_cache.compile(temp[0]) for temp in q_item]
+                except:
+                    continue
+
+                parallel.append(index)
+
+        if len(parallel) > 1:
+            #Functions defined on the worksheet look up names in the worksheet namespace, whichever
+            #namespace they are called from, so it is left alone until the whole level is done
+            self.switch_layer(namespace, self.numerics_layer)
+
+            private = {}
+            for index in parallel:
+                private[index] = dict(namespace)
+                self.pool.tasks.put((index, q_items[index], codes[index], private[index]))
+
+            for index in parallel:
+                index, outcome = self.pool.done.get()
+                finished[index] = outcome
+
+            #Copy back what was assigned. Nothing else in the level reads or writes these names.
+            for index in parallel:
+                for temp in q_items[index]:
+                    for name in temp[5]:
+                        if name in private[index]:
+                            namespace[name] = private[index][name]
+
+        for index in level:
+            if index not in finished:
+                start_time = time.time()
+                results, interrupted = self.executeItem(q_items[index], namespace)
+                finished[index] = (results, interrupted, start_time, time.time() - start_time)
+
+    def is_quick_item(self, q_item):
+        '''True if the programs of q_item were run before and took less than parallel_threshold'''
+        total = 0
+        for temp in q_item:
+            run_time = self.run_times.get(temp[0])
+            if run_time is None:
+                return False
+            total += run_time
+
+        return total < self.parallel_threshold
+
+    def is_symbolic_item(self, q_item):
+        for temp in q_item:
+            if temp[4] or self.check_for_symbolic_vars(temp[1], temp[2]):
+                return True
+        return False
+
+    def schedule(self, q_items):
+        """Sort the work items of a run into levels. No item in a level reads or writes a name written by
+        another item in the same level, so the items of a level can run in any order or side by side,
+        and running the levels one after the other gives the same results as running the items in the
+        order given. Returns a tuple (levels, serial), levels being lists of item indices and serial
+        the set of items that have to be run in the worksheet namespace itself."""
+
+        function_inputs = dict(self.function_inputs)
+        namespace_functions = set(self.namespace_functions)
+
+        levels = []
+        serial = set([])
+        last_write = {}     # name -> level of the last item writing it
+        last_read = {}      # name -> highest level of an item reading it
+        floor = 0           # Nothing goes below the last barrier
+
+        for index, q_item in enumerate(q_items):
+            reads = set([])
+            writes = set([])
+            barrier = False
+
+            for temp in q_item:
+                program, inputvars, inputfuncs = temp[0], temp[1], temp[2]
+                names = set(inputvars) | set(inputfuncs)
+
+                if len(temp) <= 5:
+                    #Names written are not known
+                    outputvars = ()
+                    barrier = True
+                else:
+                    outputvars = temp[5]
+
+                #Reads something written by an earlier program of the same plot, or updates in place
+                if names & writes or set(inputvars) & set(outputvars):
+                    serial.add(index)
+
+                reads.update(names)
+                writes.update(outputvars)
+
+                #Programs can assign anything through global statements
+                if 'def __program_function' in program:
+                    barrier = True
+
+                #Functions have to be defined in the worksheet namespace, and calls to them are only
+                #looked at once the definition has run
+                for name in outputvars:
+                    if not name.startswith('_'):
+                        barrier = True
+                        self.record_function(name, program, inputvars, inputfuncs, function_inputs,
+                                             namespace_functions)
+
+            #Functions read the names they use when they are called
+            reads = self.expand_function_inputs(reads, function_inputs)
+            if reads & namespace_functions:
+                serial.add(index)
+            if reads & impure_functions:
+                reads.add(random_state)
+                writes.add(random_state)
+
+            level = floor
+            for name in reads:
+                if name in last_write:
+                    level = max(level, last_write[name] + 1)
+            for name in writes:
+                if name in last_write:
+                    level = max(level, last_write[name] + 1)
+                if name in last_read:
+                    level = max(level, last_read[name] + 1)
+            if barrier:
+                level = max(level, len(levels))
+                floor = level + 1
+                serial.add(index)
+
+            for name in reads:
+                last_read[name] = max(last_read.get(name, level), level)
+            for name in writes:
+                last_write[name] = level
+
+            while len(levels) <= level:
+                levels.append([])
+            levels[level].append(index)
+
+        return levels, serial
+
+    def expand_function_inputs(self, names, function_inputs):
+        '''Add the names read by the worksheet functions in names, and the functions they call'''
+        expanded = set(names)
+        todo = [name for name in names if name in function_inputs]
+        while todo:
+            for name in function_inputs[todo.pop()]:
+                if name not in expanded:
+                    expanded.add(name)
+                    if name in function_inputs:
+                        todo.append(name)
+
+        return expanded
+
+    def record_function(self, name, program, inputvars, inputfuncs, function_inputs, namespace_functions):
+        function_inputs[name] = set(inputvars) | set(inputfuncs)
+        if 'globals()' in program:
+            namespace_functions.add(name)
+        else:
+            namespace_functions.discard(name)
+
+    def withdraw(self):
+        '''Take back the items of the batch being run that have not been started yet. Returns their indices.'''
+        self.lock.acquire()
+        indices = [index for level in self.pending_levels for index in level]
+        self.pending_levels = []
+        self.lock.release()
+
+        return sorted(indices)
+
+    def handoff(self, result):
+        '''Snapshot of result for the GUI. Arrays can be huge so they are not copied, instead they (and any
+        arrays they are views of) are made read-only. The worksheet copies them before writing into them
+        again, see thaw().'''
+        if isinstance(result, scipy.ndarray):
+            array = result
+            while isinstance(array, scipy.ndarray):
+                array.flags.writeable = False
+                array = array.base
+            return result
+
+        return copy.copy(result)
+
+    def snapshot(self, value):
+        '''Copy of value sharing nothing that can be changed with it, for the result cache. Arrays of numbers
+        are made read-only rather than copied, as in handoff(), and numbers and strings are shared.'''
+        if isinstance(value, scipy.ndarray) and not value.dtype.hasobject:
+            return self.handoff(value)
+        if isinstance(value, immutable_types):
+            return value
+
+        return copy.deepcopy(value)
+
+    def thaw(self, names, namespace):
+        '''Replace read-only arrays held by the given names with writeable copies'''
+        for name in names:
+            value = namespace.get(name)
+            if isinstance(value, scipy.ndarray) and self.is_frozen(value):
+                namespace[name] = value.copy()
+
+    def is_frozen(self, array):
+        while isinstance(array, scipy.ndarray):
+            if not array.flags.writeable:
+                return True
+            array = array.base
+        return False
+
+    def check_for_symbolic_vars(self, inputvars, inputfuncs):
+        '''An equation is run symbolically if it uses a symbolic variable or function. Kinds of worksheet
+        names are recorded as they are assigned (see record_kinds), so no values are looked at here.'''
+        kinds = self.kinds
+
+        for variable_name in inputvars:
+            symbolic = kinds.get(variable_name)
+            if symbolic is None and self.is_assigned(variable_name, self.worksheet_variable_namespace):
+                #Assigned by something that did not declare it, classify it now
+                symbolic = self.record_kind(variable_name, self.worksheet_variable_namespace)
+            if symbolic:
+                return True
+
+        for function_name in inputfuncs:
+            if function_name in kinds:
+                if kinds[function_name]:
+                    return True
+            elif self.layers.kind(function_name):
+                return True
+
+        return False
+
+    def record_kinds(self, names, namespace):
+        for name in names:
+            self.record_kind(name, namespace)
+
+    def record_kind(self, name, namespace):
+        if self.is_assigned(name, namespace):
+            symbolic = self.classify(namespace[name])
+            self.kinds[name] = symbolic
+            return symbolic
+        else:
+            self.kinds.pop(name, None)
+            return None
+
+    def classify(self, value):
+        '''True if value is symbolic'''
+        return classify(value, self.symbolic_types)
+
+    def stop(self):
+        '''Stop the programs being run (if any) from another thread, along with the rest of their plots'''
+        self.stop_requested = True
+        for runner in self.runners.values():
+            runner.interrupt(ComputationStopped)
+
+    def set_time_limit(self, seconds):
+        #Watchdog is not started while a program runs, a thread being created briefly shares the
+        #identity of its parent so an exception raised at that moment could hit the new thread
+        if seconds and self.watchdog is None:
+            self.watchdog = Watchdog(self)
+        self.time_limit = seconds
+
+    def set_result_cache(self, megabytes):
+        '''Keep up to megabytes of results for reuse, 0 turns the cache off'''
+        if not megabytes:
+            self.result_cache = None
+        elif self.result_cache is None:
+            self.result_cache = resultcache.ResultCache(megabytes * 1024 * 1024)
+        else:
+            self.result_cache.resize(megabytes * 1024 * 1024)
+
+    def set_parallel_workers(self, workers):
+        '''Number of worker threads for batches, 0 for one per core. Takes effect at the next batch.'''
+        if not workers:
+            try:
+                workers = min(self.max_auto_workers, multiprocessing.cpu_count())
+            except NotImplementedError:
+                workers = 1
+        self.parallel_workers = workers
+
+    def set_elementwise_threads(self, threads):
+        '''Number of threads working out the blocks of long array expressions, 0 for one per core. The
+        setting is shared by every Executor in the process, see elementwise.py.'''
+        elementwise.set_threads(threads)
+
+    def new_namespace(self):
+        '''An empty worksheet namespace, holding the names of the numeric layer'''
+        namespace = dict(self.numerics_layer)
+        namespace['__builtins__'] = __builtin__
+        namespace[layer_key] = self.numerics_layer
+        return namespace
+
+    def switch_layer(self, namespace, layer):
+        '''Bind the builtin names in namespace to layer. Names assigned on the worksheet are left alone.'''
+        old_layer = namespace[layer_key]
+        if old_layer is layer:
+            return
+
+        for name in self.layers.symbolic_names:
+            if namespace.get(name, missing) is old_layer.get(name, missing):
+                if name in layer:
+                    namespace[name] = layer[name]
+                else:
+                    namespace.pop(name, None)
+        namespace[layer_key] = layer
+
+    def is_assigned(self, name, namespace):
+        '''True if name holds something assigned on the worksheet, rather than a builtin'''
+        value = namespace.get(name, missing)
+        return value is not missing and value is not namespace[layer_key].get(name, missing)
+
+    def reset(self):
+        self.worksheet_variable_namespace = self.new_namespace()
+        self.kinds = {}
+        self.function_inputs = {}
+        self.namespace_functions = set([])
+        self.function_programs = {}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+
+class ProcessExecutor(object):
+    """Same interface as Executor, but programs are run by an Executor living in a worker process"""
+
+    #Seconds the worker is given to react to a stop or time out before it gets killed
+    kill_grace = 2.0
+    poll_interval = 0.1
+
+    #Work is always sent one item at a time, in order
+    parallel_workers = 1
+
+    def __init__(self):
+        self.time_limit = 0
+        self.result_cache_size = 0
+        self.elementwise_threads = 1
+        self.lock = threading.Lock()        # Connection is written to from the GUI thread and execution thread
+        self.busy = False
+        self.stop_time = None
+        self.interrupted = False
+        self.namespace_lost = False
+        self.restarts = 0                   # Number of times a hung worker was replaced
+        self.startWorker()
+
+    def startWorker(self):
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_loop, args=(worker_connection,))
+
+        #Make sure worker does not outlive the application
+        self.process.daemon = True
+        self.process.start()
+
+        if self.time_limit:
+            self.send(('time_limit', self.time_limit))
+        if self.result_cache_size:
+            self.send(('result_cache', self.result_cache_size))
+        if self.elementwise_threads != 1:
+            self.send(('elementwise_threads', self.elementwise_threads))
+
+    def send(self, message):
+        self.lock.acquire()
+        try:
+            self.connection.send(message)
+        finally:
+            self.lock.release()
+
+    def execute(self, q_item):
+        self.stop_time = None
+        self.interrupted = False
+        self.busy = True
+        start_time = time.time()
+
+        try:
+            self.send(('execute', q_item))
+
+            #Wait for the results, killing the worker if it does not respond to a stop or time out
+            while not self.connection.poll(self.poll_interval):
+                if self.stop_time is not None and time.time() - self.stop_time > self.kill_grace:
+                    error = 'Computation stopped'
+                elif self.time_limit and time.time() - start_time > self.time_limit*len(q_item) + self.kill_grace:
+                    error = 'Time limit of %g s exceeded' % self.time_limit
+                else:
+                    continue
+
+                self.restartWorker()
+                self.interrupted = True
+                return [(None, error, False) for temp in q_item]
+
+            results, self.interrupted = self.connection.recv()
+            return results
+
+        except (EOFError, IOError):
+            #Worker has gone away, e.g. it was killed while running a program
+            error = 'Worker process stopped'
+            return [(None, error, False) for temp in q_item]
+
+        finally:
+            self.busy = False
+
+    def restartWorker(self):
+        '''Replace a hung worker with a new one. Everything held in the worksheet namespace is lost.'''
+        self.close()
+        self.startWorker()
+        self.namespace_lost = True
+        self.restarts += 1
+
+    def stop(self):
+        '''Ask the worker to stop the program it is running. It gets killed if it does not stop in time.'''
+        if self.busy:
+            self.stop_time = time.time()
+            if hasattr(signal, 'SIGUSR1'):
+                try:
+                    os.kill(self.process.pid, signal.SIGUSR1)
+                except OSError:
+                    pass
+
+    def set_time_limit(self, seconds):
+        self.time_limit = seconds
+        try:
+            self.send(('time_limit', seconds))
+        except IOError:
+            pass
+
+    def set_result_cache(self, megabytes):
+        self.result_cache_size = megabytes
+        try:
+            self.send(('result_cache', megabytes))
+        except IOError:
+            pass
+
+    def set_parallel_workers(self, workers):
+        pass
+
+    def set_elementwise_threads(self, threads):
+        self.elementwise_threads = threads
+        try:
+            self.send(('elementwise_threads', threads))
+        except IOError:
+            pass
+
+    def withdraw(self):
+        return []
+
+    def reset(self):
+        try:
+            self.send(('reset', None))
+        except IOError:
+            pass
+
+    def close(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+
+
+def worker_loop(connection):
+    '''Main loop of worker process. Runs programs sent by a ProcessExecutor and sends back the results'''
+    executor = Executor()
+
+    #ProcessExecutor.stop() signals the worker, which stops the program being run
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: executor.stop())
+
+    while(1):
+        try:
+            command, q_item = connection.recv()
+        except (EOFError, IOError):
+            break
+
+        if command == 'execute':
+            try:
+                results = executor.execute(q_item)
+            except ComputationStopped:
+                #Stop arrived just as a program finished
+                results = [(None, 'Computation stopped', False) for temp in q_item]
+                executor.interrupted = True
+
+            #Results are pickled before anything is written to the pipe, so a failed send can be retried
+            try:
+                connection.send((results, executor.interrupted))
+            except:
+                connection.send((make_picklable(results), executor.interrupted))
+
+        elif command == 'time_limit':
+            executor.set_time_limit(q_item)
+
+        elif command == 'result_cache':
+            executor.set_result_cache(q_item)
+
+        elif command == 'elementwise_threads':
+            executor.set_elementwise_threads(q_item)
+
+        elif command == 'reset':
+            executor.reset()
+
+    connection.close()
+
+
+def make_picklable(results):
+    '''Results have to be pickled to get back to the GUI process. Replace any that can not be with an error'''
+    picklable_results = []
+    for t in results:
+        try:
+            pickle.dumps(t, pickle.HIGHEST_PROTOCOL)
+        except:
+            t = (None, 'Result can not be sent from worker process: %s' % sys.exc_value, t[2])
+        picklable_results.append(t)
+
+    return picklable_results
+
+
+#Available execution backends
+backends = {'thread'  : Executor,
+            'process' : ProcessExecutor}
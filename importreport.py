@@ -0,0 +1,144 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+
+'''Times every module imported while MiraMath starts up.
+
+    python main.py --import-report
+
+install() replaces the import statement with one that records how long each module took to import,
+both in total and on its own (leaving out the modules it imported in turn), and report() prints the
+modules by their own time along with what was imported by whom.  Imports done by other threads are
+timed too, e.g. the scipy subpackages pulled in by the execution thread.'''
+
+import sys
+import time
+import thread
+import threading
+import __builtin__
+
+
+class ImportTimer(object):
+    """Wraps __import__, recording a (name, importer, total time, own time, depth) tuple per module"""
+
+    def __init__(self):
+        self.original_import = None
+        self.start_time = None
+        self.records = []
+        self.lock = threading.Lock()
+
+        #Per thread stack of [name, time spent importing children] for the imports under way
+        self.stacks = {}
+
+    def install(self):
+        if self.original_import is None:
+            self.original_import = __builtin__.__import__
+            self.start_time = time.time()
+            __builtin__.__import__ = self.timed_import
+
+    def uninstall(self):
+        if self.original_import is not None:
+            __builtin__.__import__ = self.original_import
+            self.original_import = None
+
+    def timed_import(self, name, *args, **kwargs):
+        #Only the first import of a module costs anything
+        if name in sys.modules:
+            return self.original_import(name, *args, **kwargs)
+
+        #from . import x comes in without a name, put it down to the module doing it
+        if not name:
+            if args:
+                importing_globals = args[0]
+            else:
+                importing_globals = kwargs.get('globals')
+            label = '%s (from .)' % (importing_globals or {}).get('__name__', '?')
+        else:
+            label = name
+
+        stack = self.stacks.setdefault(thread.get_ident(), [])
+        if stack:
+            importer = stack[-1][0]
+        else:
+            importer = None
+        stack.append([label, 0.0])
+
+        start = time.time()
+        try:
+            return self.original_import(name, *args, **kwargs)
+        finally:
+            total = time.time() - start
+            children = stack.pop()[1]
+            if stack:
+                stack[-1][1] += total
+
+            self.lock.acquire()
+            self.records.append((label, importer, total, total - children, len(stack)))
+            self.lock.release()
+
+    def report(self, out=None, count=30):
+        '''Print the count slowest modules, by time spent in the module itself'''
+        if out is None:
+            out = sys.stderr
+
+        self.lock.acquire()
+        records = list(self.records)
+        self.lock.release()
+
+        elapsed = time.time() - self.start_time
+        top_level = sum([total for name, importer, total, own, depth in records if depth == 0])
+
+        #Names imported relative to a package are looked up again each time, add those up
+        modules = {}
+        for name, importer, total, own, depth in records:
+            if name in modules:
+                modules[name][0] += own
+                modules[name][1] += total
+            else:
+                modules[name] = [own, total, importer]
+
+        out.write('Import time by module, %d modules, %.3f s of %.3f s since start up\n' %
+                  (len(modules), top_level, elapsed))
+        out.write('%10s %10s  %-30s %s\n' % ('own (s)', 'total (s)', 'module', 'imported by'))
+
+        for name, (own, total, importer) in sorted(modules.items(), key=lambda item: item[1][0], reverse=True)[:count]:
+            out.write('%10.4f %10.4f  %-30s %s\n' % (own, total, name, importer or '-'))
+
+        #Cost of each package, counting everything below it
+        packages = {}
+        for name, importer, total, own, depth in records:
+            package = name.split(' ')[0].split('.')[0]
+            packages[package] = packages.get(package, 0.0) + own
+
+        out.write('\nImport time by package\n')
+        for package, own in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:count]:
+            out.write('%10.4f  %s\n' % (own, package))
+
+
+timer = ImportTimer()
+
+def install():
+    timer.install()
+
+def uninstall():
+    timer.uninstall()
+
+def report(out=None, count=30):
+    timer.report(out, count)
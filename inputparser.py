@@ -20,13 +20,11 @@
 #------------------------------------------------------------------------------
 
 import sys
-import os
 import re
 
-import ply.lex as lex
-import ply.yacc as yacc
-
 from keywords import *
+import parsertables
+import programir
 
 sys.path.insert(0,"../..")
 
@@ -46,44 +44,20 @@ def show_docstring(original_method):
 
 class InputParser(object):
 
+    #Print the tree of the generated code before and after it is optimized, see programir.py
+    dumpIR = False
+
     def __init__(self, **kw):
-        #Get the namespace dictionary for Keyword class
-        keywords = Keyword.__dict__
         self.reset()
 
-        #Define a 'rule maker' lambda
-        #Produces e.g. t_KEYWORD=r'KEYWORD' token rule
-        rulemaker = lambda x, y : 'InputParser.t_' + x + " = '" + y + "'"
-
-        #For each keyword defined in class Keyword a add token corresponding to the keyword
-        #to tokens list and create a t_'keyword' class variable to define a search rule for
-        #that keyword. This avoids the need of having to write a bunch of t_KEYWORD='<keyword>'
-        #lines to define all the search rules for the lexer
-        #
-        #Remember that at this point the class attribute 'tokens' has already been partially filled, here we append the keywords
-        for k in keywords:
-            if k.isupper():
-                InputParser.tokens.append(k)  #Add token to existing token list (tokens is a CLASS variable, already filled below)
-                s = keywords[k]
-                exec(rulemaker(k, keywords[k]))  #Create token rule attribute in this class
-
-        #Figure out file names of various parser files
-        try:
-            modname = os.path.split(os.path.splitext(__file__)[0])[1] + "_" + self.__class__.__name__
-        except:
-            modname = "parser"+"_"+self.__class__.__name__
-        self.debugfile = modname + ".dbg"
-        self.tabmodule = modname + "_" + "parsetab"
-
-        # Build the lexer and parser
-        self.lexer = lex.lex(object=self, debug=0)
-        self.parser = yacc.yacc(module=self,
-                                debug=0,
-                                debugfile=self.debugfile,
-                                tabmodule=self.tabmodule)
+        # Build the lexer and parser, see parsertables.py. The keyword tokens are added to the class
+        # when this module is imported, see the bottom of this file.
+        self.lexer = parsertables.make_lexer(self)
+        self.parser = parsertables.make_parser(self)
 
     def run(self, s):
         self.parser.parse(s, self.lexer)
+        self.functions, self.program = programir.optimize(self.functions, self.program, self.dumpIR)
 
 #        print 'parser input string=', s
 #        print 'parser: input variables=', self.inputVariables
@@ -100,6 +74,7 @@ class InputParser(object):
         self.functions = ''
         self.inputVariables = set([])
         self.inputFunctions = set([])
+        self.outputVariables = set([])
         self.functionArgs = set([])
         self.more_than_one_row = False
         self.recordIndexVariables = 0
@@ -284,6 +259,12 @@ class InputParser(object):
         else:
             t[0] = t[1]
 
+        #Record the variable assigned by this equation. An indexed assignment updates the existing
+        #array in place (or grows it) so the variable is also an input of the equation
+        self.outputVariables.add(self.indexed_label)
+        if self.index_of_label:
+            self.inputVariables.add(self.indexed_label)
+
         #Final result is program
         self.program = t[0]
 
@@ -300,6 +281,7 @@ def __program_function():
 
         self.functions += f
         t[0] = "_%s = __program_function()" % t[1]
+        self.outputVariables.add("_%s" % t[1])
 
         #Save the final parsed result
         self.program = t[0]
@@ -318,6 +300,11 @@ def __program_function():
         self.functions += f
         t[0] = "%s = __program_function()" % t[1]
 
+        #Indexed variable is updated in place, so it is both read and written
+        label = t[1].split('[')[0]
+        self.outputVariables.add(label)
+        self.inputVariables.add(label)
+
         #Save the final parsed result
         self.program = t[0]
 
@@ -352,6 +339,7 @@ def %s(%s):
         t[0] = '0'
         self.program = t[0]
         self.functions += s
+        self.outputVariables.add(t[1])
 
         #Remove function arguements from the set of variables used in current equation
         self.inputVariables = self.inputVariables.difference(self.functionArgs)
@@ -364,6 +352,7 @@ def %s(%s):
 """ % (t[3], t[3])
 
         self.program = s
+        self.outputVariables.update([v.strip() for v in t[3].split(',')])
 
     @show_docstring
     def p_statement_create_real_symbols(self, t):
@@ -373,6 +362,7 @@ def %s(%s):
 """ % (t[3], t[3])
 
         self.program = s
+        self.outputVariables.update([v.strip() for v in t[3].split(',')])
 
     @show_docstring
     def p_statement_create_integer_symbols(self, t):
@@ -382,6 +372,7 @@ def %s(%s):
 """ % (t[3], t[3])
 
         self.program = s
+        self.outputVariables.update([v.strip() for v in t[3].split(',')])
 
     @show_docstring
     def p_statement_create_complex_symbols(self, t):
@@ -391,6 +382,7 @@ def %s(%s):
 """ % (t[3], t[3])
 
         self.program = s
+        self.outputVariables.update([v.strip() for v in t[3].split(',')])
 
     @show_docstring
     def p_define_function(self, t):
@@ -403,6 +395,7 @@ def %s(%s):
 
         t[0] = '0'  #Need 0 for statement:expression above so that __result is set to something
         self.functions += s
+        self.outputVariables.add(t[1])
 
         #Remove function arguements from the set of variables used in current equation
         self.inputVariables = self.inputVariables.difference(self.functionArgs)
@@ -750,7 +743,7 @@ def %s(%s):
     @show_docstring
     def p_norm(self, t):
         '''norm : NORMSTART BODYSTART expression BODYEND NORMEND'''
-        t[0] = "scipy.linalg.norm(%s)" % t[3]
+        t[0] = "__norm(%s)" % t[3]
 
     @show_docstring
     def p_expression_norm(self, t):
@@ -833,28 +826,33 @@ def __rangesum_func_%s():
 
     @show_docstring
     def p_expression_product(self, t):
-        '''expression : PRODUCTSTART seen_SUMSTART FROMSTART SUMVARSTART LABEL SUMVAREND \
-                        ASSIGNMENT SUMFROMVALSTART expression SUMFROMVALEND FROMEND \
-                        SUMTOSTART expression SUMTOEND seen_SUMTOEND SUMBODYSTART expression SUMBODYEND PRODUCTEND'''
+        '''expression : PRODUCTSTART seen_SUMSTART SUMVAREND ASSIGNMENT SUMFROMVALSTART expression SUMFROMVALEND FROMEND SUMTOSTART expression SUMTOEND seen_SUMTOEND SUMBODYSTART expression SUMBODYEND PRODUCTEND'''
 
-        #Pop off in reverse order
+        #Same as a sum, see p_expression_sum. Pop off in reverse order
         list_of_index_vars_before_sum_body = self.indexVariablesStack.pop()
         list_of_index_vars_before_sum = self.indexVariablesStack.pop()
 
-        temp = "_%s" % t[5]
+        temp = "_%s" % t[2]
         if temp not in list_of_index_vars_before_sum_body and temp in self.indexVariables:
             self.indexVariables.remove(temp)
 
+        self.nested_variables.pop()
+        if self.nested_variables:
+            args_str = ("_%s, " * len(self.nested_variables)) % tuple(self.nested_variables)
+        else:
+            args_str = ''
+
         s = """
-def __run_time_function_%s():
-    return __product('%s', '_%s', '%s', '%s', globals())
-""" % (self.functionCounter, t[17], t[5], t[9], t[13])
+def __run_time_function_%s(%s):
+    retval =__product(lambda _%s: %s, %s, %s, '%s')
+    return retval
+""" % (self.functionCounter, args_str, t[2], t[14], t[6], t[10], t[2])
         self.functions += s
 
-        t[0] = "__run_time_function_%s()" % (self.functionCounter)
+        t[0] = "__run_time_function_%s(%s)" % (self.functionCounter, args_str)
 
         #Remove counter variable from the set of variables used in current equation
-        self.inputVariables.discard("_%s" % t[5])
+        self.inputVariables.discard(temp)
         self.functionCounter += 1
 
     @show_docstring
@@ -875,14 +873,14 @@ def __run_time_function_%s():
     def p_expression_vectorize(self, t):
         '''expression : VECTORIZESTART BODYSTART expression BODYEND VECTORIZEEND'''
 
-        args_string = ','.join(self.inputVariables)
+        args = list(self.inputVariables)
         f = """\
 def __vectorize_function(%s):
     return %s
-""" % (args_string, t[3])
+""" % (','.join(args), t[3])
 
         self.functions += f
-        t[0] = "scipy.vectorize(__vectorize_function)(%s)" % args_string
+        t[0] = "__vectorize(%s)" % ', '.join(['__vectorize_function'] + args)
 
     @show_docstring
     def p_elements(self, t):
@@ -1037,6 +1035,7 @@ _%s = sympy.Symbol('_%s')
 """ % (t[4], t[4])
 
         self.functions += s
+        self.outputVariables.add("_%s" % t[4])
 
     @show_docstring
     def p_expression_recuring_decimal(self, t):
@@ -1135,3 +1134,17 @@ _%s = sympy.Symbol('_%s')
 
 
 
+
+
+#For each keyword defined in class Keyword add a token corresponding to the keyword to the tokens list
+#and create a t_'keyword' class variable to define a search rule for that keyword. This avoids the need
+#of having to write a bunch of t_KEYWORD='<keyword>' lines to define all the search rules for the lexer.
+#Done once here rather than for every parser, adding the tokens twice changes the grammar signature
+#and makes PLY work the tables out again.
+def add_keyword_tokens(cls):
+    for k, v in Keyword.__dict__.items():
+        if k.isupper():
+            cls.tokens.append(k)
+            setattr(cls, 't_' + k, v)
+
+add_keyword_tokens(InputParser)
@@ -0,0 +1,69 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+
+'''Stand-ins for modules and functions that are only imported when first used.
+
+numerics_init.py binds many scipy functions into the worksheet namespace.  Importing the scipy
+subpackages they live in takes longer than everything else a worksheet with plain arithmetic needs,
+so the bindings are made with these and the import happens the first time an equation calls one.'''
+
+import sys
+
+
+def load(module_name):
+    '''The module called module_name, importing it if needed'''
+    __import__(module_name)
+    return sys.modules[module_name]
+
+
+class LazyModule(object):
+    """Stands in for a module, which is imported the first time one of its attributes is read"""
+
+    def __init__(self, module_name):
+        self.__dict__['_module_name'] = module_name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, name):
+        module = self._module
+        if module is None:
+            module = load(self._module_name)
+            self.__dict__['_module'] = module
+        return getattr(module, name)
+
+    def __repr__(self):
+        return "<lazy module '%s'>" % self._module_name
+
+
+def module(module_name):
+    return LazyModule(module_name)
+
+
+def function(module_name, name):
+    '''Stands in for function name of module module_name, which is imported by the first call'''
+    target = []
+
+    def call(*args, **kwargs):
+        if not target:
+            target.append(getattr(load(module_name), name))
+        return target[0](*args, **kwargs)
+
+    call.__name__ = name
+    return call
@@ -25,7 +25,13 @@ import sys
 
 #from PyQt4 import Qt
 
+#Start timing imports before anything else is imported, see importreport.py
+import importreport
+if '--import-report' in sys.argv:
+    importreport.install()
+
 from mainwindow import *
+import inputparser
 
 class MyApplication(QApplication):
     def quit(self):
@@ -33,6 +39,9 @@ class MyApplication(QApplication):
 
 def main(args):
     print 'running...'
+    if '--dump-ir' in args:
+        inputparser.InputParser.dumpIR = True
+
     app = MyApplication([])
 
     #Set up signal handlers
@@ -52,6 +61,10 @@ def main(args):
     main.show()
     splash.finish(main)
 
+    if '--import-report' in args:
+        importreport.report()
+        importreport.uninstall()
+
     #app.connect(app, SIGNAL("lastWindowClosed()"), app, SLOT("quit()"))
     app.connect(app, SIGNAL("lastWindowClosed()"), app.quit)
 
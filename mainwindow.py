@@ -23,6 +23,8 @@ from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 import worksheet
 import mathtoolbox
+import profilepanel
+import parsecache
 import os
 
 _ICONSIZE = 25
@@ -43,6 +45,9 @@ class MainWindow(QMainWindow):
         #Create worksheet list
         self.worksheets = []
 
+        #Dock listing the slowest equations of the current worksheet, hidden until asked for
+        self.profilePanel = profilepanel.ProfilePanel(self)
+
         #Some setup
         self.createStatusBar()
         self.createTabsBar()
@@ -58,9 +63,13 @@ class MainWindow(QMainWindow):
         mathdockwidget = mathtoolbox.MathToolBox(self, self.iconSize())
         self.addDockWidget(Qt.LeftDockWidgetArea, mathdockwidget)
 
+        self.addDockWidget(Qt.RightDockWidgetArea, self.profilePanel)
+        self.profilePanel.hide()
+
     def closeEvent(self, event):
         #Check each worksheet to see if it needs to be saved before closing down application
         if self.saveAllOnExit():
+            parsecache.cache.save()
             event.accept()
         else:
             event.ignore()
@@ -129,6 +138,9 @@ class MainWindow(QMainWindow):
 
         #**********Create math menu and add its' actions**********
         math = menubar.addMenu('&Math')
+        math.addAction(self.stopComputationsAction)
+        math.addSeparator()
+        math.addAction(self.profilePanel.toggleViewAction())
 
         #**********Create settings menu and add its' actions**********
         settings = menubar.addMenu('&Settings')
@@ -266,6 +278,12 @@ class MainWindow(QMainWindow):
         self.connect(self.allignBottomAction, SIGNAL('triggered()'), self.allignBottom)
 
         #****Math edit actions****
+        #Stop computations action
+        stopComputations = QAction(QIcon('icons/exit.png'), 'Stop Computations', self)
+        stopComputations.setShortcut('Ctrl+.')
+        stopComputations.setStatusTip('Stop the equation being run and everything waiting to run')
+        self.stopComputationsAction = stopComputations
+        self.connect(self.stopComputationsAction, SIGNAL('triggered()'), self.stopComputations)
 
         #**************Settings menu actions*************
         #Preferences action
@@ -400,18 +418,106 @@ class MainWindow(QMainWindow):
         colorlayout.addWidget(backgroundcolorbutton, 0, 1)
         colorgroup = QGroupBox('Default Colors')
         colorgroup.setLayout(colorlayout)
+        self.worksheetBackgroundColor = worksheet.WorkSheet.backgroundColor
+
+        #Execution backend
+        processcheckbox = QCheckBox('Run equations in a separate process')
+        processcheckbox.setChecked(worksheet.WorkSheet.executionBackend == 'process')
+        self.processCheckBox = processcheckbox
+
+        #Time limit per equation
+        timelimitlabel = QLabel('Time limit per equation (s)')
+        timelimitspinbox = QDoubleSpinBox()
+        timelimitspinbox.setRange(0, 86400)
+        timelimitspinbox.setDecimals(1)
+        timelimitspinbox.setSpecialValueText('None')
+        timelimitspinbox.setValue(worksheet.WorkSheet.timeLimit)
+        self.timeLimitSpinBox = timelimitspinbox
+
+        timelimitlayout = QHBoxLayout()
+        timelimitlayout.addWidget(timelimitlabel)
+        timelimitlayout.addWidget(timelimitspinbox)
+
+        #Threads running independent equations side by side
+        workerslabel = QLabel('Worker threads')
+        workersspinbox = QSpinBox()
+        workersspinbox.setRange(0, 64)
+        workersspinbox.setSpecialValueText('One per core')
+        workersspinbox.setValue(worksheet.WorkSheet.parallelWorkers)
+        self.workersSpinBox = workersspinbox
+
+        workerslayout = QHBoxLayout()
+        workerslayout.addWidget(workerslabel)
+        workerslayout.addWidget(workersspinbox)
+
+        #Threads sharing out the blocks of long array expressions
+        elementwiselabel = QLabel('Array expression threads')
+        elementwisespinbox = QSpinBox()
+        elementwisespinbox.setRange(0, 64)
+        elementwisespinbox.setSpecialValueText('One per core')
+        elementwisespinbox.setValue(worksheet.WorkSheet.elementwiseThreads)
+        self.elementwiseSpinBox = elementwisespinbox
+
+        elementwiselayout = QHBoxLayout()
+        elementwiselayout.addWidget(elementwiselabel)
+        elementwiselayout.addWidget(elementwisespinbox)
+
+        #Results kept for equations whose inputs have not changed
+        resultcachelabel = QLabel('Result cache (MB)')
+        resultcachespinbox = QSpinBox()
+        resultcachespinbox.setRange(0, 65536)
+        resultcachespinbox.setSpecialValueText('Off')
+        resultcachespinbox.setValue(worksheet.WorkSheet.resultCacheSize)
+        self.resultCacheSpinBox = resultcachespinbox
+
+        resultcachelayout = QHBoxLayout()
+        resultcachelayout.addWidget(resultcachelabel)
+        resultcachelayout.addWidget(resultcachespinbox)
+
+        #Equations on screen are run ahead of the rest
+        viewportcheckbox = QCheckBox('Run equations in view first')
+        viewportcheckbox.setChecked(worksheet.WorkSheet.viewportPriority)
+        self.viewportPriorityCheckBox = viewportcheckbox
+
+        #Parse results kept between sessions
+        parsecachecheckbox = QCheckBox('Keep parsed equations on disk')
+        parsecachecheckbox.setChecked(worksheet.WorkSheet.parseCacheOnDisk)
+        self.parseCacheCheckBox = parsecachecheckbox
+
+        executionlayout = QVBoxLayout()
+        executionlayout.addWidget(processcheckbox)
+        executionlayout.addWidget(viewportcheckbox)
+        executionlayout.addWidget(parsecachecheckbox)
+        executionlayout.addLayout(timelimitlayout)
+        executionlayout.addLayout(workerslayout)
+        executionlayout.addLayout(elementwiselayout)
+        executionlayout.addLayout(resultcachelayout)
+        executiongroup = QGroupBox('Execution')
+        executiongroup.setLayout(executionlayout)
 
         #Layout everythang in preferences dialog
         preflayout = QGridLayout(self.preferencesDialog)
         preflayout.addWidget(fontgroup, 0, 0)
-        preflayout.addLayout(prefsbuttonslayout, 1, 1)
+        preflayout.addLayout(prefsbuttonslayout, 2, 1)
         preflayout.addWidget(colorgroup, 0, 1)
+        preflayout.addWidget(executiongroup, 1, 0)
 
     #******************************Callbacks for various dialogs*********************************
     def preferencesDialogApply(self):
         brush = QBrush(QColor('red'))
 
         worksheet.WorkSheet.backgroundColor = self.worksheetBackgroundColor
+        if self.processCheckBox.isChecked():
+            worksheet.WorkSheet.executionBackend = 'process'
+        else:
+            worksheet.WorkSheet.executionBackend = 'thread'
+        worksheet.WorkSheet.timeLimit = self.timeLimitSpinBox.value()
+        worksheet.WorkSheet.parallelWorkers = self.workersSpinBox.value()
+        worksheet.WorkSheet.elementwiseThreads = self.elementwiseSpinBox.value()
+        worksheet.WorkSheet.resultCacheSize = self.resultCacheSpinBox.value()
+        worksheet.WorkSheet.viewportPriority = self.viewportPriorityCheckBox.isChecked()
+        worksheet.WorkSheet.parseCacheOnDisk = self.parseCacheCheckBox.isChecked()
+
         for w in self.worksheets:
             w.setPreferences()
 
@@ -465,6 +571,14 @@ class MainWindow(QMainWindow):
         #Display font of current tab on font toolbar
         self.displayCurrentFont(w.font)
 
+        #Show equation times of current tab
+        self.profilePanel.showWorksheet(w)
+
+    def profileChanged(self, w):
+        #Called by a worksheet when a run has finished and its equation times changed
+        if w.is_current_tab:
+            self.profilePanel.showWorksheet(w)
+
     def openFile(self):
         #Bring up an open file dialog
         filedir = QFileDialog.getOpenFileName(self, 'Open File' + self.applicationName, \
@@ -667,6 +781,7 @@ class MainWindow(QMainWindow):
 
     def deleteTab(self, index, numtabs):
         self.tabs.removeTab(index)
+        self.worksheets[index].execution_thread.stop_backend()
         del self.worksheets[index]
         numtabs -= 1
 
@@ -772,6 +887,11 @@ class MainWindow(QMainWindow):
         w = self.getCurrentWorksheet()
         w.allignBottom()
 
+    #****************************************Callbacks for math menu*********************************
+    def stopComputations(self):
+        w = self.getCurrentWorksheet()
+        w.stopComputations()
+
     #****************************************Callbacks for help menu*********************************
     def showAboutQt(self):
         QMessageBox.aboutQt(self, self.applicationName)
@@ -21,12 +21,18 @@
 
 '''This file is executed to fill the worksheet namespace before any equations are executed. It is shared by all equations'''
 
+import sys
 import scipy
-import scipy.linalg
-import scipy.fftpack
-import scipy.integrate
-import scipy.special
-import scipy.signal
+import elementwise
+import purity
+
+#The scipy subpackages are imported when an equation first uses them, see lazyimport.py
+import lazyimport
+__linalg        = lazyimport.module('scipy.linalg')
+__integrate     = lazyimport.module('scipy.integrate')
+
+#Worksheets loaded from file run their symbol definitions here, sympy is imported by the first one
+sympy           = lazyimport.module('sympy')
 
 
 #*******************************************************************************************************************
@@ -52,13 +58,13 @@ def hstack(*args):
     return scipy.hstack(args)
 
 def lsolve(M, v):
-    return scipy.linalg.solve(M, v)
+    return __linalg.solve(M, v)
 
 def eigenvals(m):
-    return asmatrix(scipy.linalg.eigvals(m))
+    return asmatrix(__linalg.eigvals(m))
 
 def eigenvecs(m):
-    return asmatrix(scipy.linalg.eig(m)[1])
+    return asmatrix(__linalg.eig(m)[1])
 
 def zeros(*args):
     return scipy.zeros(args)
@@ -109,36 +115,36 @@ def crandn(*args):
     return x + 1j * y
 
 #FFT, etc
-fft             = scipy.fftpack.fft
-ifft            = scipy.fftpack.ifft
-rfft            = scipy.fftpack.rfft
-irfft           = scipy.fftpack.irfft
-hilbert         = scipy.signal.hilbert
-hilbert2        = scipy.signal.hilbert2
+fft             = lazyimport.function('scipy.fftpack', 'fft')
+ifft            = lazyimport.function('scipy.fftpack', 'ifft')
+rfft            = lazyimport.function('scipy.fftpack', 'rfft')
+irfft           = lazyimport.function('scipy.fftpack', 'irfft')
+hilbert         = lazyimport.function('scipy.signal', 'hilbert')
+hilbert2        = lazyimport.function('scipy.signal', 'hilbert2')
 
 #Time domain windows
-barthann        = scipy.signal.barthann
-bartlett        = scipy.signal.bartlett
-blackman        = scipy.signal.blackman
-blackmanharris  = scipy.signal.blackmanharris
-bohman          = scipy.signal.bohman
-boxcar          = scipy.signal.boxcar
-chebwin         = scipy.signal.chebwin
-flattop         = scipy.signal.flattop
-gaussian        = scipy.signal.gaussian
-hamming         = scipy.signal.hamming
-hanning         = scipy.signal.hanning
-kaiser          = scipy.signal.kaiser
-nuttall         = scipy.signal.nuttall
-parzen          = scipy.signal.parzen
-slepian         = scipy.signal.slepian
-triang          = scipy.signal.triang
+barthann        = lazyimport.function('scipy.signal', 'barthann')
+bartlett        = lazyimport.function('scipy.signal', 'bartlett')
+blackman        = lazyimport.function('scipy.signal', 'blackman')
+blackmanharris  = lazyimport.function('scipy.signal', 'blackmanharris')
+bohman          = lazyimport.function('scipy.signal', 'bohman')
+boxcar          = lazyimport.function('scipy.signal', 'boxcar')
+chebwin         = lazyimport.function('scipy.signal', 'chebwin')
+flattop         = lazyimport.function('scipy.signal', 'flattop')
+gaussian        = lazyimport.function('scipy.signal', 'gaussian')
+hamming         = lazyimport.function('scipy.signal', 'hamming')
+hanning         = lazyimport.function('scipy.signal', 'hanning')
+kaiser          = lazyimport.function('scipy.signal', 'kaiser')
+nuttall         = lazyimport.function('scipy.signal', 'nuttall')
+parzen          = lazyimport.function('scipy.signal', 'parzen')
+slepian         = lazyimport.function('scipy.signal', 'slepian')
+triang          = lazyimport.function('scipy.signal', 'triang')
 
 #Integration
-trapz           = scipy.integrate.trapz
-cumtrapz        = scipy.integrate.cumtrapz
-simpson         = scipy.integrate.simps
-romb            = scipy.integrate.romb
+trapz           = lazyimport.function('scipy.integrate', 'trapz')
+cumtrapz        = lazyimport.function('scipy.integrate', 'cumtrapz')
+simpson         = lazyimport.function('scipy.integrate', 'simps')
+romb            = lazyimport.function('scipy.integrate', 'romb')
 
 #Trig functions
 sin             = scipy.sin
@@ -158,7 +164,7 @@ atanh           = scipy.arctanh
 log10           = scipy.log10
 log             = scipy.log
 exp             = scipy.exp
-__zeta__        = scipy.special.zeta
+__zeta__        = lazyimport.function('scipy.special', 'zeta')
 
 #Complex numbers
 arg             = scipy.angle
@@ -177,10 +183,16 @@ def Im(z):
 __matrix        = scipy.matrix
 __sqrt          = scipy.sqrt
 __divide        = lambda p, q:p/q
-__determinant   = scipy.linalg.det
+__determinant   = lazyimport.function('scipy.linalg', 'det')
+__norm          = lazyimport.function('scipy.linalg', 'norm')
 __conjugate     = scipy.conjugate
 __absolute      = scipy.absolute
 
+#Elementwise expressions on long arrays are worked out a block at a time, see elementwise.py. Besides
+#scipy's ufuncs these work element by element
+__elementwise   = elementwise.Evaluator([__divide, __sqrt, asin, acos, atanh, log, log10])
+__ndarray       = scipy.ndarray     # Only expressions reading one of these are handed to __elementwise
+
 def __zeros(dimensions, dtype=float):
     return scipy.zeros(dimensions, dtype)
 
@@ -205,20 +217,85 @@ def __hermitian(m):
         retval = m.T
     return scipy.conj(retval)
 
-def __summation(body_str, label_str, from_str, to_str, g):
-    s = """scipy.sum([%s for %s in xrange(%s, %s+1)], dtype=float)""" % (body_str, label_str, from_str, to_str)
-    return eval(s, g)
-
+#Sums and products over at least this many terms try working out their terms with the index variable
+#holding an array of indices rather than one index at a time, a block of __block_size indices at a time
+#so the arrays stay small. Shorter ranges are not worth the checks.
+__vector_threshold = 64
+__block_size = 65536
+
+def __array_terms(func, indices):
+    """func(indices) if it gives the term for each index, None if the body can not be worked out on an
+    array. numpy does not trap integer overflow, so the body is worked out on the indices as floats too
+    and the two have to agree everywhere: an integer power or product too big for the array's integers,
+    anywhere in the body, shows up as a difference (so does classic division of integers, which is left
+    to the loop). Spot checks against the body worked out one index at a time (as a Python int, the way
+    the terms of a short range are worked out) catch bodies that give a different answer for an array,
+    e.g. a body holding a vector. A division by zero or an overflow of floats, which Python would raise
+    on, also sends the block back to the loop."""
+    old_settings = scipy.seterr(divide='raise', over='raise', invalid='raise')
+    try:
+        try:
+            values = func(indices)
+            float_values = func(indices.astype(float))
+        except (TypeError, ValueError, IndexError, ArithmeticError, AttributeError):
+            return None
+    finally:
+        scipy.seterr(**old_settings)
+
+    if not isinstance(values, scipy.ndarray) or values.shape != indices.shape or values.dtype.hasobject:
+        return None
+    if not isinstance(float_values, scipy.ndarray) or float_values.shape != values.shape or \
+       float_values.dtype.hasobject or not __same_values(values, float_values):
+        return None
+
+    for i in set([0, len(indices) / 2, len(indices) - 1]):
+        term = func(int(indices[i]))
+        if isinstance(term, scipy.ndarray) and term.shape != ():
+            return None
+        if not __same_value(values[i], term):
+            return None
+
+    return values
+
+def __same_value(a, b):
+    try:
+        return a == b or abs(a - b) <= 1e-9 * abs(b)
+    except (TypeError, ValueError, ArithmeticError):
+        return False
+
+def __same_values(a, b):
+    #Elementwise __same_value of two arrays
+    try:
+        return bool(scipy.all((a == b) | (scipy.absolute(a - b) <= 1e-9 * scipy.absolute(b))))
+    except (TypeError, ValueError, ArithmeticError):
+        return False
+
+def __range_reduce(func, from_val, to_val, reduce):
+    """reduce(terms, dtype=float) for the terms func(k), k going from from_val to to_val. reduce is
+    scipy.sum or scipy.product, and the answer is a float however it is worked out, as it always was.
+    The terms are worked out a block at a time, on an array of indices if the body allows it (see
+    __array_terms) and one index at a time if not. Bodies that would do harm when run again (see
+    purity.py) always go one index at a time."""
+    indices = xrange(from_val, to_val+1)
+    if len(indices) < __vector_threshold or not purity.pure(func):
+        return reduce([func(dummy) for dummy in indices], dtype=float)
+
+    partials = []
+    for start in xrange(0, len(indices), __block_size):
+        first = indices[start]
+        last = indices[min(start+__block_size, len(indices)) - 1]
+        values = __array_terms(func, scipy.arange(first, last+1))
+        if values is None:
+            values = [func(dummy) for dummy in xrange(first, last+1)]
+        partials.append(reduce(values, dtype=float))
+
+    return reduce(partials, dtype=float)
 
 def __summation(func, from_val, to_val, ignore_val):
-    return scipy.sum([func(dummy) for dummy in xrange(from_val, to_val+1)], dtype=float)
+    return __range_reduce(func, from_val, to_val, scipy.sum)
 
-
-
-
-def __product(body_str, label_str, from_str, to_str, g):
-    s = """scipy.product([%s for %s in xrange(%s, %s+1)], dtype=float)""" % (body_str, label_str, from_str, to_str)
-    return eval(s, g)
+def __product(func, from_val, to_val, ignore_val):
+    return __range_reduce(func, from_val, to_val, scipy.product)
 
 def __substitution(program_string, d, g, inputvars):
     temp_dict = {}
@@ -237,8 +314,214 @@ def __substitution(program_string, d, g, inputvars):
 
     return ret_val
 
+#Integrals over arrays of limits, or of integrands giving arrays, are worked out for every element at once
+#with an adaptive Gauss-Kronrod 7-15 rule. Each round both halves of every interval not settled yet are
+#worked out, the integrand being given the nodes of all of them, for all elements, in one array. An interval
+#is settled once the difference between the Gauss and Kronrod sums on its halves, and the change from the
+#Kronrod sum on the whole interval, are well inside its share of quad's default tolerances (1.49e-8), so the
+#answers agree with what quad gives one element at a time. Elements that do not get there (singularities,
+#wild oscillations, infinite limits, ...) are left to quad. quad works out the integrand for every element
+#each time it calls it, so if many elements are left it is quicker to give up and let the caller work out
+#the elements one at a time.
+__kronrod_nodes = scipy.array([-0.991455371120812639206854697526329, -0.949107912342758524526189684047851,
+                               -0.864864423359769072789712788640926, -0.741531185599394439863864773280788,
+                               -0.586087235467691130294144845693013, -0.405845151377397166906606412076961,
+                               -0.207784955007898467600689403773245, 0.0,
+                               0.207784955007898467600689403773245, 0.405845151377397166906606412076961,
+                               0.586087235467691130294144845693013, 0.741531185599394439863864773280788,
+                               0.864864423359769072789712788640926, 0.949107912342758524526189684047851,
+                               0.991455371120812639206854697526329])
+__kronrod_weights = scipy.array([0.022935322010529224963732008058970, 0.063092092629978553290700663189204,
+                                 0.104790010322250183839876322541518, 0.140653259715525918745189590510238,
+                                 0.169004726639267902826583426598550, 0.190350578064785409913256402421014,
+                                 0.204432940075298892414161999234649, 0.209482141084727828012999174891714,
+                                 0.204432940075298892414161999234649, 0.190350578064785409913256402421014,
+                                 0.169004726639267902826583426598550, 0.140653259715525918745189590510238,
+                                 0.104790010322250183839876322541518, 0.063092092629978553290700663189204,
+                                 0.022935322010529224963732008058970])
+
+#The 7 Gauss nodes are every other Kronrod node
+__gauss_weights = scipy.array([0.0, 0.129484966168869693270611432679082, 0.0, 0.279705391489276667901467771423780,
+                               0.0, 0.381830050505118944950369775488975, 0.0, 0.417959183673469387755102040816327,
+                               0.0, 0.381830050505118944950369775488975, 0.0, 0.279705391489276667901467771423780,
+                               0.0, 0.129484966168869693270611432679082, 0.0])
+
+__quad_tolerance = 1e-11
+__max_quad_rounds = 50
+__max_quad_intervals = 64       # Most intervals worked on at once for one element
+__max_quad_left = 0.1           # Share of the elements that may be left to quad
+__max_quad_values = 1 << 22     # Most integrand values worked out in one go
+
+def __kronrod_sums(integrand_func, lower, upper, shape):
+    """Kronrod sums and their error estimates (difference from the Gauss sums) on the intervals lower to
+    upper, arrays with a row for each interval and a column for each element of an answer of the given
+    shape. None if the integrand does not give real numbers."""
+    size = lower.shape[1]
+    nodes = ((__kronrod_nodes + 1) / 2).reshape(1, 15, 1)
+    kronrod = scipy.empty(lower.shape)
+    error = scipy.empty(lower.shape)
+
+    group = max(1, __max_quad_values / (15 * size))
+    for start in xrange(0, len(lower), group):
+        a = lower[start:start + group, scipy.newaxis]
+        b = upper[start:start + group, scipy.newaxis]
+        x = (a + (b - a) * nodes).reshape((-1, ) + shape)
+        values = scipy.asarray(integrand_func(x))
+        if values.dtype.kind not in 'biuf':
+            return None
+        values = scipy.broadcast_to(values, x.shape).reshape(-1, 15, size)
+
+        kronrod_sums = scipy.tensordot(values, __kronrod_weights, ([1], [0]))
+        gauss_sums = scipy.tensordot(values, __gauss_weights, ([1], [0]))
+        kronrod[start:start + group] = kronrod_sums
+        error[start:start + group] = abs(kronrod_sums - gauss_sums)
+
+    scale = (upper - lower) / 2
+    return kronrod * scale, error * abs(scale)
+
+def __batched_quad(integrand_func, from_val, to_val):
+    """Integral of integrand_func from from_val to to_val for each element of the limits and of what the
+    integrand gives, see above. None if the integrand can not be worked out on arrays of nodes, or would
+    do harm when run again (see purity.py)."""
+    if not purity.pure(integrand_func):
+        return None
+
+    try:
+        a = scipy.asarray(from_val)
+        b = scipy.asarray(to_val)
+        if a.dtype.kind not in 'biuf' or b.dtype.kind not in 'biuf':
+            return None
+
+        #Ranges that are not finite are left to quad, the others worked out on a dummy range meanwhile
+        finite = scipy.isfinite(a) & scipy.isfinite(b)
+        lower = scipy.where(finite, a, 0.0)
+        upper = scipy.where(finite, b, 1.0)
+
+        #The shape of the answer comes from the limits and from what the integrand gives for one x
+        shape = scipy.broadcast(lower, upper, scipy.asarray(integrand_func(float(lower.flat[0])))).shape
+        if shape == ():
+            return None
+        lower = scipy.broadcast_to(lower, shape)
+        upper = scipy.broadcast_to(upper, shape)
+
+        #The integrand has to work element by element, check it against one x at a time
+        x = lower + 0.3 * (upper - lower)
+        values = scipy.broadcast_to(scipy.asarray(integrand_func(x)), shape)
+        for index in set([(0, ) * len(shape), tuple([n - 1 for n in shape])]):
+            value = scipy.broadcast_to(scipy.asarray(integrand_func(float(x[index]))), shape)[index]
+            if not __same_value(values[index], value):
+                return None
+
+        lower = lower.ravel()
+        upper = upper.ravel()
+        size = len(lower)
+        failed = ~scipy.broadcast_to(finite, shape).ravel()
+        if failed.sum() > __max_quad_left * size:
+            return None
+
+        result = scipy.zeros(size)
+        span = abs(upper - lower)
+        span[span == 0] = 1
+
+        #Intervals not settled yet, grouped by element, with the Kronrod sum on each from the round before
+        owner = scipy.nonzero(~failed)[0]
+        start = lower[owner]
+        end = upper[owner]
+        whole = scipy.zeros(len(owner)) + scipy.inf
+        rounds = 0
+        while len(owner):
+            if rounds == __max_quad_rounds:
+                failed[owner] = True
+                break
+            rounds += 1
+
+            #Lay the halves out in a table with a column for each element, padded with empty intervals
+            counts = scipy.bincount(owner, minlength=size)
+            rank = scipy.arange(len(owner)) - (scipy.cumsum(counts) - counts)[owner]
+            middle = (start + end) / 2
+            table_lower = scipy.repeat(lower[scipy.newaxis], 2 * counts.max(), axis=0)
+            table_upper = table_lower.copy()
+            table_lower[2 * rank, owner] = start
+            table_upper[2 * rank, owner] = middle
+            table_lower[2 * rank + 1, owner] = middle
+            table_upper[2 * rank + 1, owner] = end
+
+            sums = __kronrod_sums(integrand_func, table_lower, table_upper, shape)
+            if sums is None:
+                return None
+            kronrod, error = sums
+
+            halves = scipy.array([kronrod[2 * rank, owner], kronrod[2 * rank + 1, owner]])
+            both = halves.sum(axis=0)
+            both_error = error[2 * rank, owner] + error[2 * rank + 1, owner]
+
+            estimate = result + scipy.bincount(owner, both, minlength=size)
+            tolerance = scipy.maximum(__quad_tolerance, __quad_tolerance * abs(estimate))[owner] * abs(end - start) / span[owner]
+            settled = scipy.isfinite(both) & (both_error <= tolerance) & (abs(both - whole) <= tolerance)
+            result += scipy.bincount(owner[settled], both[settled], minlength=size)
+
+            #Split the others, giving up on elements needing too many intervals
+            split = ~settled
+            failed |= scipy.bincount(owner[split], minlength=size) > __max_quad_intervals / 2
+            if failed.sum() > __max_quad_left * size:
+                return None
+            split &= ~failed[owner]
+
+            owner = scipy.repeat(owner[split], 2)
+            start, end = (scipy.column_stack([start[split], middle[split]]).ravel(),
+                          scipy.column_stack([middle[split], end[split]]).ravel())
+            whole = halves[:, split].T.ravel()
+
+        if failed.sum() > __max_quad_left * size:
+            return None
+
+    except (TypeError, ValueError, IndexError, ArithmeticError, AttributeError):
+        return None
+
+    result = result.reshape(shape)
+    for index in zip(*scipy.unravel_index(scipy.nonzero(failed)[0], shape)):
+        element = lambda x: scipy.broadcast_to(scipy.asarray(integrand_func(x)), shape)[index]
+        result[index] = __integrate.quad(element, scipy.broadcast_to(a, shape)[index], scipy.broadcast_to(b, shape)[index])[0]
+
+    return result
+
 def __definite_integral(integrand_func, from_val, to_val, variable_name, g):
-    return scipy.integrate.quad(integrand_func, from_val, to_val, args=())[0]
+    try:
+        return __integrate.quad(integrand_func, from_val, to_val, args=())[0]
+    except (TypeError, ValueError):
+        #Array limits, or an integrand giving arrays (e.g. reading a hanging index variable or the array a
+        #function was called with), are worked out all at once
+        error = sys.exc_info()
+        result = __batched_quad(integrand_func, from_val, to_val)
+        if result is None:
+            raise error[0], error[1], error[2]
+        return result
+
+def __vectorize(function, *args):
+    """scipy.vectorize(function)(*args). function is first called with the whole arrays, which is used if
+    it gives an array of the right shape and type agreeing with function called one element at a time
+    at a few elements, e.g. a function working out integrals for every element at once. Functions that
+    would do harm when run again (see purity.py) only get the elements."""
+    try:
+        shape = scipy.broadcast(*args).shape
+        if shape != () and purity.pure(function):
+            values = function(*args)
+            if isinstance(values, scipy.ndarray) and values.shape == shape and not values.dtype.hasobject:
+                elements = [scipy.broadcast_to(arg, shape) for arg in args]
+                size = values.size
+                for i in sorted(set([0, size / 2, size - 1])):
+                    index = scipy.unravel_index(i, shape)
+                    value = function(*[element[index] for element in elements])
+                    if i == 0 and scipy.asarray(value).dtype != values.dtype:
+                        break
+                    if not __same_value(values[index], value):
+                        break
+                else:
+                    return values
+    except (TypeError, ValueError, IndexError, ArithmeticError, AttributeError):
+        pass
+
+    return scipy.vectorize(function)(*args)
 
 def __differentiate(function_object, variable, g):
     diff = __derivative(function_object)
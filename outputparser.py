@@ -20,15 +20,12 @@
 
 import sys
 sys.path.insert(0,"../..")
-import os
 import re
 
-import ply.lex as lex
-import ply.yacc as yacc
-
 from keywords import *
 from equationwidgets import *
 from symbolscharmap import SymbolsTable
+import parsertables
 
 
 #Simple decorator that will print method doc string when method is called
@@ -46,20 +43,9 @@ class OutputParser(object):
 
     def __init__(self, **kw):
 
-        #Figure out file names of various parser files
-        try:
-            modname = os.path.split(os.path.splitext(__file__)[0])[1] + "_" + self.__class__.__name__
-        except:
-            modname = "parser"+"_"+self.__class__.__name__
-        self.debugfile = modname + ".dbg"
-        self.tabmodule = modname + "_" + "parsetab"
-
-        # Build the lexer and parser
-        self.lexer = lex.lex(object=self, debug=0)
-        self.parser = yacc.yacc(module=self,
-                                debug=0,
-                                debugfile=self.debugfile,
-                                tabmodule=self.tabmodule)
+        # Build the lexer and parser, see parsertables.py
+        self.lexer = parsertables.make_lexer(self)
+        self.parser = parsertables.make_parser(self)
 
         #Create a list of special symbols (ASCII names of symbols)
        # [ascii_value, unicode_value, tooltip] = zip(*SymbolsTable.symbols)
@@ -76,7 +62,7 @@ class OutputParser(object):
     def testLexer(self, s):
         self.lexer.input(s)
         while 1:
-            tok = lex.token()
+            tok = self.lexer.token()
             if not tok: break      # No more input
             print tok
 
@@ -0,0 +1,203 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+
+'''Cache of parse results, keyed by equation string'''
+
+import os
+import hashlib
+import threading
+import collections
+import cPickle as pickle
+
+import keywords
+import inputparser
+import programir
+import elementwise
+import parsertables
+
+
+def parser_version():
+    '''Digest of the parser source, parse results saved by another version are not used. None if the
+    source can not be read.'''
+    digest = hashlib.md5()
+    try:
+        for module in (inputparser, programir, elementwise, keywords):
+            f = open(os.path.splitext(module.__file__)[0] + '.py', 'rb')
+            digest.update(f.read())
+            f.close()
+    except IOError:
+        return None
+
+    return digest.hexdigest()
+
+
+class ParseCache(object):
+    """What the parser made of each equation string, see parsethread.parse(), least recently used ones are
+    thrown out first. Strings that do not parse are kept too, with None as their result.
+
+    Equations that read the same, e.g. the axis equations of plots or a block that was pasted several
+    times, are then only parsed once. Used by the GUI thread and the parse thread, hence the lock.
+
+    The cache can be kept on disk (see setPersistent), so a worksheet opened again does not have to be
+    parsed at all."""
+
+    max_size = 10000
+    filename = 'parsecache.pickle'
+
+    def __init__(self, max_size=None):
+        if max_size is not None:
+            self.max_size = max_size
+
+        self.results = collections.OrderedDict()    # equation string -> parse result
+        self.lock = threading.Lock()
+        self.persistent = False
+        self.loaded = False
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, s):
+        '''Returns (True, parse result) if s is in the cache, else (False, None)'''
+        self.lock.acquire()
+        try:
+            result = self.results.pop(s, self)
+            if result is self:
+                self.misses += 1
+                return False, None
+
+            #Most recently used go at the end
+            self.hits += 1
+            self.results[s] = result
+        finally:
+            self.lock.release()
+
+        return True, self.copy(result)
+
+    def put(self, s, result):
+        result = self.copy(result)
+
+        self.lock.acquire()
+        try:
+            self.results.pop(s, None)
+            if len(self.results) >= self.max_size:
+                self.results.popitem(last=False)
+                self.evictions += 1
+
+            self.results[s] = result
+            self.changed = True
+        finally:
+            self.lock.release()
+
+    def copy(self, result):
+        '''Equations get sets of their own, so nothing they do to them ends up in the cache'''
+        if result is None:
+            return None
+
+        program, input_variables, input_functions, output_variables = result
+        return program, set(input_variables), set(input_functions), set(output_variables)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.results.clear()
+            self.changed = True
+        finally:
+            self.lock.release()
+
+    def setPersistent(self, persistent):
+        '''Keep the cache on disk or not. The first time it is turned on the results saved last time are
+        read back in.'''
+        self.persistent = persistent
+        if persistent and not self.loaded:
+            self.loaded = True
+            self.load()
+
+    def path(self):
+        return os.path.join(parsertables.cache_directory(), self.filename)
+
+    def load(self):
+        version = parser_version()
+        if version is None:
+            return
+
+        try:
+            f = open(self.path(), 'rb')
+            try:
+                saved_version, items = pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return
+
+        if saved_version != version:
+            return
+
+        #Anything parsed in the meantime is more recent
+        self.lock.acquire()
+        try:
+            results = collections.OrderedDict(items[-self.max_size:])
+            for s, result in self.results.iteritems():
+                results.pop(s, None)
+                results[s] = result
+            while len(results) > self.max_size:
+                results.popitem(last=False)
+            self.results = results
+        finally:
+            self.lock.release()
+
+    def save(self):
+        '''Write the cache to disk if it is kept there and has changed'''
+        version = parser_version()
+        if not self.persistent or not self.changed or version is None:
+            return
+
+        self.lock.acquire()
+        try:
+            items = self.results.items()
+            self.changed = False
+        finally:
+            self.lock.release()
+
+        #Write to a new file first, so a worksheet opened by another copy of the program never sees half a file
+        path = self.path()
+        temp_path = '%s.%d' % (path, os.getpid())
+        try:
+            f = open(temp_path, 'wb')
+            try:
+                pickle.dump((version, items), f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            self.changed = True
+
+    def statistics(self):
+        return {'size'      : len(self.results),
+                'hits'      : self.hits,
+                'misses'    : self.misses,
+                'evictions' : self.evictions}
+
+
+#Shared by every worksheet
+cache = ParseCache()
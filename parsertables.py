@@ -0,0 +1,142 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+
+'''Builds the PLY lexers and parsers of InputParser and OutputParser.
+
+Working out the LALR tables of the equation grammar takes about a second, so PLY keeps them in a
+file and only works them out again when the grammar changes.  The files are kept in a per user
+cache directory (one per PLY and Python version, as the files of one can not be read by the other)
+rather than next to the source or in the current directory, which need not be writable.  Set
+MIRAMATH_CACHE_DIR to put them somewhere else.  If it can not be written to the tables are kept in
+a temporary directory until the program exits.
+
+Within a process the lexer of each parser class is only built once, later parsers of the class
+get a copy of it bound to themselves.'''
+
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+import threading
+
+import ply
+import ply.lex as lex
+import ply.yacc as yacc
+
+
+#Lexer built for the first parser of each class, by class
+lexers = {}
+lock = threading.Lock()
+
+#Used when the cache directory can not be written to, see private_directory()
+temporary_directory = None
+
+
+def cache_directory():
+    '''Directory the parser tables are kept in, created if needed'''
+    base = os.environ.get('MIRAMATH_CACHE_DIR')
+    if not base:
+        if sys.platform == 'win32':
+            base = os.path.join(os.environ.get('LOCALAPPDATA') or os.path.expanduser('~'), 'MiraMath', 'cache')
+        else:
+            base = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'miramath')
+
+    directory = os.path.join(base, 'ply-%s-py%d.%d' % (ply.__version__, sys.version_info[0], sys.version_info[1]))
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            return private_directory()
+
+    if not os.access(directory, os.W_OK):
+        return private_directory()
+
+    return directory
+
+
+def private_directory():
+    '''Temporary directory of this process, removed when it exits, so the tables are at least only worked
+    out once per process'''
+    global temporary_directory
+    if temporary_directory is None:
+        temporary_directory = tempfile.mkdtemp(prefix='miramath-')
+        atexit.register(shutil.rmtree, temporary_directory, True)
+    return temporary_directory
+
+
+def make_lexer(parser_object):
+    '''Lexer for parser_object, the token rules are only compiled for the first object of its class'''
+    cls = parser_object.__class__
+    lock.acquire()
+    try:
+        if cls not in lexers:
+            lexers[cls] = lex.lex(object=parser_object, debug=0)
+            return lexers[cls]
+    finally:
+        lock.release()
+
+    lexer = lexers[cls].clone()
+    bind_rules(lexer, parser_object)
+
+    #Copying leaves the rules of the first object in place, selecting the state picks up the new ones
+    lexer.begin('INITIAL')
+    return lexer
+
+
+def bind_rules(lexer, parser_object):
+    """Make the token rules of lexer call the methods of parser_object. Lexer.clone(parser_object) does
+    the same, but PLY 3.11 only keeps the last master regex of each state, which for the equation lexer
+    (too many tokens for one regex) loses most of the tokens."""
+    def bind(rule):
+        if not rule or not rule[0]:
+            return rule
+        return getattr(parser_object, rule[0].__name__), rule[1]
+
+    states = {}
+    for state, regexes in lexer.lexstatere.items():
+        states[state] = [(regex, [bind(rule) for rule in rules]) for regex, rules in regexes]
+    lexer.lexstatere = states
+
+    lexer.lexstateerrorf = dict([(state, getattr(parser_object, rule.__name__))
+                                 for state, rule in lexer.lexstateerrorf.items()])
+    lexer.lexmodule = parser_object
+
+
+def make_parser(parser_object):
+    '''LALR parser for parser_object, tables are read from the cache directory when the grammar matches'''
+    name = '%s_%s' % (parser_object.__class__.__module__, parser_object.__class__.__name__)
+    picklefile = os.path.join(cache_directory(), name + '_parsetab.pickle')
+
+    #Parsers made on different threads would otherwise write the same file at the same time
+    lock.acquire()
+    try:
+        try:
+            return yacc.yacc(module=parser_object, debug=0, picklefile=picklefile)
+        except Exception:
+            #Left half written by another process, throw it away and work the tables out again
+            try:
+                os.remove(picklefile)
+            except OSError:
+                pass
+            return yacc.yacc(module=parser_object, debug=0, picklefile=picklefile)
+    finally:
+        lock.release()
@@ -0,0 +1,124 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+from PyQt4.QtCore import *
+
+import sys
+import time
+import Queue
+
+import inputparser
+import parsecache
+
+
+def parse(parser, s):
+    '''Parse equation string s with parser. Returns (program, inputVariables, inputFunctions, outputVariables),
+    or None if s is not a valid equation. Strings parsed before are taken from the parse cache.'''
+    found, result = parsecache.cache.get(s)
+    if found:
+        return result
+
+    parser.reset()
+    try:
+        parser.run(s)
+    except:
+        print str(sys.exc_info())
+        result = None
+    else:
+        program = ''.join([parser.functions, parser.program])
+        result = program, parser.inputVariables, parser.inputFunctions, parser.outputVariables
+
+    parsecache.cache.put(s, result)
+    return result
+
+
+class ParseThread(QThread):
+    """Parses equations for a worksheet so the GUI does not have to wait for them.
+
+    The thread has a parser of its own, the parser shared by the Equation class is only used on the
+    GUI thread. Jobs are parsed in the order they were sent and each job's results are put on the
+    results Q as soon as they are ready, so the worksheet can start running the equations at the top
+    while the ones further down are still being parsed."""
+
+    #Define a signal that takes an integer arguement
+    parsed_signal = pyqtSignal((int, ), name='parsed_signal')
+
+    def __init__(self, parent):
+
+        #Create Q to hold incomming jobs. Each is a tuple (run_id, object_id, [equation string, ...])
+        self.job_q = Queue.Queue()
+
+        #Create Q to hold results. Each is a tuple (run_id, object_id, [parse result, ...], [seconds taken, ...])
+        self.results_q = Queue.Queue()
+
+        #Jobs sent before the last call to do_parsing or cancel are thrown away
+        self.run_id = 0
+
+        #Set while a parsed_signal is on its way to the GUI, so one signal covers many results
+        self.delivery_pending = False
+
+        #Call super classes init method last when were ready to go
+        super(ParseThread, self).__init__(parent)
+
+        #Finally start up thread
+        self.start()
+
+    def run(self):
+        parser = inputparser.InputParser()
+
+        #Forever loop waits for jobs from main thread
+        while(1):
+            run_id, object_id, strings = self.job_q.get()
+            if run_id != self.run_id:
+                continue
+
+            results = []
+            times = []
+            for s in strings:
+                start_time = time.time()
+                results.append(parse(parser, s))
+                times.append(time.time() - start_time)
+
+            self.results_q.put((run_id, object_id, results, times))
+            if not self.delivery_pending:
+                self.delivery_pending = True
+                self.parsed_signal.emit(run_id)
+
+    def do_parsing(self, jobs):
+        """Start a new run. jobs is a list of (object_id, [equation string, ...]) in the order they should
+        be parsed. Returns the ID of the run, results of older runs should be ignored."""
+        self.cancel()
+        for object_id, strings in jobs:
+            self.job_q.put((self.run_id, object_id, strings))
+
+        return self.run_id
+
+    def cancel(self):
+        """Throw away jobs not parsed yet"""
+        self.run_id += 1
+        while(1):
+            try:
+                self.job_q.get_nowait()
+            except Queue.Empty:
+                break
+
+    def results_delivered(self):
+        """Called by the GUI before it empties the results Q, anything put on the Q after this gets a new signal"""
+        self.delivery_pending = False
@@ -32,6 +32,7 @@ from equation import *
 from colorbutton import ColorButton
 
 import plotlegend
+import dependencygraph
 
 
 class Plot2d(QGraphicsRectItem):
@@ -79,7 +80,7 @@ class Plot2d(QGraphicsRectItem):
         self.bottom = 0
         self.characterClicked = False
         self.currentEquation = None
-        self.object_id = id(self)  # Unique ID for instance
+        self.object_id = dependencygraph.new_object_id()  # Unique ID for instance
         self.shadowBox = ShadowBox(self)
         self.shadowBox.setColor(Plot2d.cursor_over_equation_color)
         self.activeBox = ActiveBox('plot', self)
@@ -31,6 +31,7 @@ from equation import *
 from colorbutton import ColorButton
 
 import plot3dwidget
+import dependencygraph
 
 
 class Plot3d(QGraphicsRectItem):
@@ -63,7 +64,7 @@ class Plot3d(QGraphicsRectItem):
         self.setPos(position)
         self.object_type = 'plot'
         self.currentIndex = -1  #Index of this equation in worksheets list
-        self.object_id = id(self)  # Unique ID for instance
+        self.object_id = dependencygraph.new_object_id()  # Unique ID for instance
         self.positionChanged = False
         self.isGlobalDefinition = False #Global definitions will be executed before all others
         self.font = QFont(font.family(), font.pointSize())
@@ -19,7 +19,6 @@
 #   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
 #------------------------------------------------------------------------------
 
-import sys
 import re
 import copy
 import scipy
@@ -304,32 +303,17 @@ class PlotEquation(Equation):
                 has_result = True
 
             #Prepare what's needed for the execution thread
-            ret_val = (self.program, self.inputVariables, self.inputFunctions, has_result, self.forceSymbolic)
+            ret_val = (self.program, self.inputVariables, self.inputFunctions, has_result, self.forceSymbolic, self.outputVariables)
             self.is_valid = True
 
         return ret_val
 
-    def parseEquation(self):
-        '''This function parses the equation and produces a Python program'''
-        s = self.getEquationString()
-        self.equationParser.reset()
-
-        #Try running parser
-        try:
-            self.equationParser.run(s)   # Parse
-            self.inputVariables = self.equationParser.inputVariables    # Vars used by eqn
-            self.inputFunctions = self.equationParser.inputFunctions
-            self.program = ''.join([self.equationParser.functions, self.equationParser.program])
-            self.equationHasBeenParsed = True
-
-        except:
-            print str(sys.exc_info())
-            self.setToolTip('Parser: Syntax error in equation')
-            self.setColor(QColor('red'))
-            self.equationHasBeenParsed = False
+    def setParseResult(self, result):
+        '''Take on the program etc. the parser made of the equation, result as returned by parsethread.parse'''
+        Equation.setParseResult(self, result)
 
+        if result is None:
             self.inputVariables = []
             self.inputFunctions = []
+            self.outputVariables = []
             self.program = ''
-
-
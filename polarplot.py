@@ -32,6 +32,7 @@ from equation import *
 from colorbutton import ColorButton
 
 import plotlegend
+import dependencygraph
 
 
 class PolarPlot(QGraphicsRectItem):
@@ -78,7 +79,7 @@ class PolarPlot(QGraphicsRectItem):
         self.bottom = 0
         self.character_clicked = False
         self.currentEquation = None
-        self.object_id = id(self)  # Unique ID for instance
+        self.object_id = dependencygraph.new_object_id()  # Unique ID for instance
         self.shadowBox = ShadowBox(self)
         self.shadowBox.setColor(PolarPlot.cursor_over_equation_color)
         self.activeBox = ActiveBox('plot', self)
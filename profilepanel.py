@@ -0,0 +1,101 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+import profiler
+
+
+class TimeItem(QTableWidgetItem):
+    """Table cell showing a time in milliseconds that sorts by the time rather than the text"""
+    def __init__(self, seconds):
+        QTableWidgetItem.__init__(self, '%.1f' % (seconds * 1000))
+        self.seconds = seconds
+        self.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+
+    def __lt__(self, other):
+        return self.seconds < getattr(other, 'seconds', 0.0)
+
+
+class ProfilePanel(QDockWidget):
+    """Lists the equations/plots of the current worksheet with the time spent on each of them in the
+    last run, slowest first. Any column can be sorted by clicking its header, double clicking a row
+    scrolls the worksheet to the equation."""
+    def __init__(self, parent):
+        QDockWidget.__init__(self, 'Slowest Equations', parent)
+        self.setMinimumWidth(100)
+        self.worksheet = None
+
+        columns = ['Equation'] + [profiler.stage_names[stage] for stage in profiler.stages] + ['Total']
+        self.table = QTableWidget(0, len(columns))
+        self.table.setHorizontalHeaderLabels(columns)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.verticalHeader().hide()
+        self.table.setToolTip('Times in ms')
+        self.connect(self.table, SIGNAL('cellDoubleClicked(int, int)'), self.rowDoubleClicked)
+
+        export_button = QPushButton('Export...')
+        export_button.setToolTip('Save the times to a CSV or JSON file')
+        self.connect(export_button, SIGNAL('clicked()'), self.export)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.table)
+        layout.addWidget(export_button)
+        frame = QWidget()
+        frame.setLayout(layout)
+        self.setWidget(frame)
+
+    def showWorksheet(self, worksheet):
+        """Fill the table with the profiles of worksheet"""
+        self.worksheet = worksheet
+        profiles = worksheet.profiler.slowest()
+
+        #Rows move around while sorting is on, so fill the table with it off
+        self.table.setSortingEnabled(False)
+        self.table.setRowCount(len(profiles))
+        for row, profile in enumerate(profiles):
+            label = QTableWidgetItem(profile.label)
+            label.setData(Qt.UserRole, QVariant(long(profile.object_id)))
+            self.table.setItem(row, 0, label)
+            for column, stage in enumerate(profiler.stages):
+                self.table.setItem(row, column + 1, TimeItem(getattr(profile, stage)))
+            self.table.setItem(row, len(profiler.stages) + 1, TimeItem(profile.total()))
+        self.table.setSortingEnabled(True)
+
+    def rowDoubleClicked(self, row, column):
+        if self.worksheet is None:
+            return
+
+        object_id, ok = self.table.item(row, 0).data(Qt.UserRole).toLongLong()
+        if ok:
+            self.worksheet.showItem(object_id)
+
+    def export(self):
+        if self.worksheet is None:
+            return
+
+        filename = QFileDialog.getSaveFileName(self, 'Export equation times', '', 'CSV files (*.csv);;JSON files (*.json)')
+        if filename:
+            try:
+                self.worksheet.profiler.export(unicode(filename))
+            except IOError, e:
+                QMessageBox.warning(self, 'Export equation times', 'Could not write %s\n%s' % (filename, e))
@@ -0,0 +1,125 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+
+'''Where the time goes for each equation/plot of a worksheet run'''
+
+import csv
+import json
+
+
+#Stages of running an equation, in the order they happen
+stages = ['parse', 'queue', 'execute', 'transfer', 'show']
+
+stage_names = {'parse'    : 'Parse',
+               'queue'    : 'Queue wait',
+               'execute'  : 'Execute',
+               'transfer' : 'Transfer',
+               'show'     : 'Show result'}
+
+#Starts the timings in an equation's tooltip, anything after it is replaced by the next run
+tooltip_separator = u'\n\nTimes of the last run\n'
+
+
+def milliseconds(seconds):
+    return '%.1f ms' % (seconds * 1000)
+
+
+class EquationProfile(object):
+    """Seconds spent on one equation/plot in each stage of the last run it was part of:
+
+    parse       parsing its equation(s), whenever that was last done
+    queue       from being handed to the execution thread until its programs started
+    execute     running its programs
+    transfer    from its results being ready until the GUI picked them up
+    show        show_result, i.e. building the result widgets and laying them out"""
+
+    def __init__(self, object_id, label, parse=0.0, queue=0.0, execute=0.0, transfer=0.0, show=0.0):
+        self.object_id = object_id
+        self.label = label
+        self.parse = parse
+        self.queue = queue
+        self.execute = execute
+        self.transfer = transfer
+        self.show = show
+
+    def total(self):
+        return self.parse + self.queue + self.execute + self.transfer + self.show
+
+    def describe(self):
+        '''Timings as shown in the tooltip'''
+        lines = ['%s: %s' % (stage_names[stage], milliseconds(getattr(self, stage))) for stage in stages]
+        lines.append('Total: %s' % milliseconds(self.total()))
+        return u'\n'.join(lines)
+
+    def dictionary(self):
+        d = {'object_id' : self.object_id, 'label' : self.label, 'total' : self.total()}
+        for stage in stages:
+            d[stage] = getattr(self, stage)
+        return d
+
+
+class Profiler(object):
+    """Latest EquationProfile of each equation/plot of a worksheet, by object id"""
+
+    def __init__(self):
+        self.profiles = {}
+
+    def record(self, profile):
+        self.profiles[profile.object_id] = profile
+
+    def get(self, object_id):
+        return self.profiles.get(object_id)
+
+    def forget(self, object_ids):
+        '''Drop the profiles of everything not in object_ids, e.g. equations deleted from the worksheet'''
+        object_ids = set(object_ids)
+        for object_id in self.profiles.keys():
+            if object_id not in object_ids:
+                del self.profiles[object_id]
+
+    def slowest(self, count=None):
+        '''Profiles by total time, slowest first'''
+        profiles = sorted(self.profiles.values(), key=lambda profile: profile.total(), reverse=True)
+        if count is not None:
+            profiles = profiles[:count]
+        return profiles
+
+    def clear(self):
+        self.profiles.clear()
+
+    def export(self, name):
+        '''Write the profiles to file name, slowest first. JSON if name ends in .json, otherwise CSV with
+        times in seconds.'''
+        profiles = self.slowest()
+
+        if name.lower().endswith('.json'):
+            f = open(name, 'w')
+            json.dump([profile.dictionary() for profile in profiles], f, indent=1)
+            f.close()
+            return
+
+        f = open(name, 'wb')
+        writer = csv.writer(f)
+        writer.writerow(['label', 'object_id'] + stages + ['total'])
+        for profile in profiles:
+            d = profile.dictionary()
+            writer.writerow([unicode(profile.label).encode('utf-8'), profile.object_id] + [d[stage] for stage in stages] + [d['total']])
+        f.close()
@@ -0,0 +1,69 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+'''Cache of compiled equation programs'''
+
+import collections
+
+
+class ProgramCache(object):
+    """Compiled code objects keyed by program text, least recently used ones are thrown out first.
+
+    An equation's program includes the helper functions generated by the parser, so as long as an
+    equation is not edited neither it nor its helpers get compiled again."""
+
+    max_size = 1000
+
+    def __init__(self, max_size=None):
+        if max_size is not None:
+            self.max_size = max_size
+
+        self.code_objects = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def compile(self, program):
+        '''Returns the code object for program, compiling it if it is not in the cache'''
+        code = self.code_objects.pop(program, None)
+
+        if code is None:
+            self.misses += 1
+            code = compile(program, '<equation>', 'exec')   # SyntaxError goes to the caller, nothing is cached
+
+            if len(self.code_objects) >= self.max_size:
+                self.code_objects.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+
+        #Most recently used go at the end
+        self.code_objects[program] = code
+
+        return code
+
+    def clear(self):
+        self.code_objects.clear()
+
+    def statistics(self):
+        return {'size'      : len(self.code_objects),
+                'hits'      : self.hits,
+                'misses'    : self.misses,
+                'evictions' : self.evictions}
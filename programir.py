@@ -0,0 +1,832 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+
+'''Intermediate representation of the code generated by the input parser, and the passes run over it.
+
+The grammar actions of InputParser build each equation as two pieces of Python text: the helper functions
+(sums, integrals, programs, functions defined on the worksheet) and the program calling them.  Both are
+read into a tree of typed nodes (the ast module's), optimized and written back out as Python text:
+
+    constant folding            arithmetic on number literals is done once here, e.g. the 10+1 of a range
+    common subexpressions       a pure subexpression used more than once in a statement is worked out
+                                once into a temporary, helpers that are the same (e.g. the same sum typed
+                                twice) are merged first so calls to them count as the same subexpression
+    dead helpers                helper functions nothing calls any more are left out
+    elementwise fusion          arithmetic and elementwise functions on names, e.g. a*sin(b)+c**2/d, are
+                                handed to __elementwise, which works long arrays out a block at a time.
+                                Only done in statements run once per equation, not in functions or loops,
+                                and only called when one of the names holds an array
+
+Anything the passes do not understand is left as it was, and if the text written out does not read back
+into the same tree the original text is used.'''
+
+import re
+import ast
+import copy
+import math
+import operator
+
+import elementwise
+
+
+#Operators folded when both sides are number literals, classic division as the equations are compiled
+#without 'from __future__ import division'
+binary_operators = {ast.Add      : operator.add,
+                    ast.Sub      : operator.sub,
+                    ast.Mult     : operator.mul,
+                    ast.Div      : operator.div,
+                    ast.FloorDiv : operator.floordiv,
+                    ast.Mod      : operator.mod,
+                    ast.Pow      : operator.pow,
+                    ast.BitAnd   : operator.and_,
+                    ast.BitOr    : operator.or_,
+                    ast.BitXor   : operator.xor,
+                    ast.LShift   : operator.lshift,
+                    ast.RShift   : operator.rshift}
+
+unary_operators = {ast.UAdd   : operator.pos,
+                   ast.USub   : operator.neg,
+                   ast.Invert : operator.invert}
+
+#Functions the generated code calls which only depend on their arguments, see numerics_init.py and
+#symbolics_init.py
+pure_functions = set(['__sqrt', '__divide', '__factorial', '__transpose', '__hermitian', '__conjugate',
+                      '__absolute', '__determinant', '__norm', '__matrix'])
+
+#Functions of the builtin layers a worksheet can call which only depend on their arguments. A function
+#defined on the worksheet can change variables, so a statement calling anything else is left alone.
+library_functions = set(['sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'sinh', 'cosh', 'tanh', 'asinh',
+                         'acosh', 'atanh', 'exp', 'log', 'log10', 'arg', 'Re', 'Im', 'fft', 'ifft', 'rfft',
+                         'irfft', 'hilbert', 'trapz', 'cumtrapz', 'simpson', 'romb', 'lsolve', 'eigenvals',
+                         'eigenvecs', 'reshape', 'expand'])
+
+pure_attributes = set([('scipy', name) for name in ['dot', 'convolve', 'ceil', 'floor', 'real_if_close', 'sum',
+                                                    'mean', 'arange', 'array', 'hstack', 'vstack']])
+pure_attributes.add(('sympy', 'Symbol'))
+
+#Functions running the code or functions they are handed, a helper calling them is pure if what it hands
+#them is
+evaluating_functions = set(['__summation', '__product', '__definite_integral', '__indefinite_integral',
+                            '__differentiate', 'globals'])
+
+#Prefix of the temporaries holding common subexpressions
+temporary_prefix = '__cse_'
+
+#Helper functions made by the parser, anything else defined is the user's and always kept
+helper_prefix = '__'
+
+#Fewest operators and function calls an expression handed to __elementwise has, plain arithmetic such as
+#a*2+1 is left alone
+min_fused_operations = 4
+
+#Statements bigger than this (in nodes, e.g. a large matrix typed in) are not searched for common
+#subexpressions, and no statement gets more than max_temporaries of them
+max_statement_size = 2000
+max_temporaries = 16
+
+identifier = re.compile(r'[A-Za-z_]\w*')
+called_in_string = re.compile(r'([A-Za-z_][\w.]*)\s*\(')
+
+
+class Unsupported(Exception):
+    '''Raised when the tree holds a node that can not be written out as text'''
+
+
+#*********************************************Constant folding*********************************************
+def is_number(node):
+    return isinstance(node, ast.Num) and isinstance(node.n, (int, long, float))
+
+
+def foldable(value):
+    '''True if value reads back as the same literal, see to_source'''
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+        return False
+    if isinstance(value, float):
+        return not (math.isinf(value) or math.isnan(value) or (value == 0 and math.copysign(1, value) < 0))
+    return True
+
+
+def small_power(left, right):
+    '''Guard against folding powers that take long to work out or make huge numbers'''
+    if isinstance(left, float) or isinstance(right, float):
+        return True
+    return -64 <= right <= 64 and abs(left) < 2 ** 32
+
+
+class ConstantFolder(ast.NodeTransformer):
+    """Replaces operators on number literals with their value, worked out the way Python would at run time"""
+
+    def __init__(self):
+        self.changed = False
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        function = binary_operators.get(node.op.__class__)
+        if function is None or not is_number(node.left) or not is_number(node.right):
+            return node
+
+        left, right = node.left.n, node.right.n
+        if isinstance(node.op, ast.Pow) and not small_power(left, right):
+            return node
+        if isinstance(node.op, (ast.LShift, ast.RShift)) and not 0 <= right <= 64:
+            return node
+
+        try:
+            value = function(left, right)
+        except (ArithmeticError, ValueError, TypeError):
+            return node
+
+        return self.literal(node, value)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        function = unary_operators.get(node.op.__class__)
+        if function is None or not is_number(node.operand):
+            return node
+
+        try:
+            value = function(node.operand.n)
+        except (ArithmeticError, ValueError, TypeError):
+            return node
+
+        return self.literal(node, value)
+
+    def literal(self, node, value):
+        if not foldable(value):
+            return node
+
+        self.changed = True
+        return ast.copy_location(ast.Num(n=value), node)
+
+
+#***************************************Common subexpression elimination***********************************
+def evaluated_children(node):
+    '''Children of node that are always worked out when node is. The bodies of lambdas and comprehensions
+    run later or more than once with names of their own, and the rest of a conditional may not run at all.'''
+    if isinstance(node, (ast.Lambda, ast.GeneratorExp, ast.ListComp, ast.SetComp, ast.DictComp)):
+        return []
+    if isinstance(node, ast.IfExp):
+        return [node.test]
+    if isinstance(node, ast.BoolOp):
+        return node.values[:1]
+    if isinstance(node, ast.Compare):
+        return [node.left, node.comparators[0]]
+    return list(ast.iter_child_nodes(node))
+
+
+def called_names(node):
+    """Names of the functions called anywhere under node, e.g. 'sin' or 'scipy.sum', including the ones called
+    by code in strings. None stands for a call through anything else, e.g. scipy.vectorize(f)(x)."""
+    names = set([])
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call):
+            function = child.func
+            if isinstance(function, ast.Name):
+                names.add(function.id)
+            elif isinstance(function, ast.Attribute) and isinstance(function.value, ast.Name):
+                names.add('%s.%s' % (function.value.id, function.attr))
+            else:
+                names.add(None)
+        elif isinstance(child, ast.Str):
+            names.update(called_in_string.findall(child.s))
+    return names
+
+
+class Purity(object):
+    """Which functions called by an equation only depend on their arguments, i.e. can be called once
+    instead of twice and the calls moved around"""
+
+    def __init__(self, functions):
+        self.names = set(pure_functions) | library_functions
+        self.names.update(['%s.%s' % pair for pair in pure_attributes])
+
+        #Helpers whose code only calls pure functions, and the functions running it
+        helpers = {}
+        for statement in functions:
+            if isinstance(statement, ast.FunctionDef) and statement.name.startswith(helper_prefix):
+                helpers[statement.name] = called_names(statement)
+        self.helpers = set(helpers)
+
+        changed = True
+        while changed:
+            changed = False
+            for name, called in helpers.iteritems():
+                if name not in self.names and called.issubset(self.names | evaluating_functions):
+                    self.names.add(name)
+                    changed = True
+
+    def is_pure_call(self, node):
+        if node.starargs is not None or node.kwargs is not None:
+            return False
+        function = node.func
+        if isinstance(function, ast.Name):
+            return function.id in self.names
+        if isinstance(function, ast.Attribute) and isinstance(function.value, ast.Name):
+            return '%s.%s' % (function.value.id, function.attr) in self.names
+        return False
+
+    def only_pure_calls(self, node):
+        '''True if the calls under node can not change anything another part of it reads'''
+        return called_names(node).issubset(self.names | evaluating_functions)
+
+
+class Expressions(object):
+    """The expressions evaluated by a list of statements, by their text in ast.dump form"""
+
+    def __init__(self, roots, purity):
+        self.purity = purity
+        self.pure = {}              # id(node) -> True if node only depends on the values it reads
+        self.reads_variable = {}    # id(node) -> True if a worksheet variable is read by node
+        self.sizes = {}             # id(node) -> number of nodes
+        self.occurrences = {}       # dump -> [node, ...]
+        self.roots = roots
+        for root in roots:
+            self.visit(root)
+
+    def visit(self, node):
+        children = evaluated_children(node)
+        for child in children:
+            self.visit(child)
+
+        pure = True
+        reads_variable = False
+        size = 1
+        for child in ast.iter_child_nodes(node):
+            pure = pure and self.pure.get(id(child), False)
+            reads_variable = reads_variable or self.reads_variable.get(id(child), False)
+            size += self.sizes.get(id(child), 1)
+
+        if isinstance(node, ast.Name):
+            reads_variable = node.id.startswith('_') and not node.id.startswith('__')
+        elif isinstance(node, ast.Call):
+            pure = pure and self.purity.is_pure_call(node)
+
+            #Helpers read the variables when called, e.g. a sum
+            if isinstance(node.func, ast.Name) and node.func.id in self.purity.helpers:
+                reads_variable = True
+        elif isinstance(node, ast.Attribute):
+            pure = isinstance(node.value, ast.Name) and node.value.id == 'scipy'
+        elif not isinstance(node, (ast.Num, ast.Str, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Subscript,
+                                   ast.Index, ast.Slice, ast.ExtSlice, ast.Tuple, ast.List, ast.keyword,
+                                   ast.operator, ast.unaryop, ast.cmpop, ast.expr_context)):
+            pure = False
+
+        #Only single comparisons, chained ones stop early
+        if isinstance(node, ast.Compare) and len(node.ops) > 1:
+            pure = False
+
+        self.pure[id(node)] = pure
+        self.reads_variable[id(node)] = reads_variable
+        self.sizes[id(node)] = size
+
+        if pure and reads_variable and isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Call, ast.Subscript)):
+            self.occurrences.setdefault(ast.dump(node), []).append(node)
+
+    def size(self):
+        return sum([self.sizes[id(root)] for root in self.roots])
+
+    def largest_repeated(self):
+        '''Text of the biggest expression worked out more than once, None if there is none'''
+        best = None
+        best_size = 0
+        for text, nodes in self.occurrences.iteritems():
+            if len(nodes) > 1 and self.sizes[id(nodes[0])] > best_size:
+                best = text
+                best_size = self.sizes[id(nodes[0])]
+        return best
+
+
+class Replacer(object):
+    """Replaces every evaluated occurrence of an expression with a name"""
+
+    def __init__(self, text, name):
+        self.text = text
+        self.name = name
+        self.count = 0
+
+    def replace(self, node):
+        if isinstance(node, ast.expr) and ast.dump(node) == self.text:
+            self.count += 1
+            return ast.copy_location(ast.Name(id=self.name, ctx=ast.Load()), node)
+
+        children = set([id(child) for child in evaluated_children(node)])
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, ast.AST):
+                if id(value) in children:
+                    setattr(node, field, self.replace(value))
+            elif isinstance(value, list):
+                for i, item in enumerate(value):
+                    if isinstance(item, ast.AST) and id(item) in children:
+                        value[i] = self.replace(item)
+        return node
+
+
+class CommonSubexpressionEliminator(object):
+    """Works out pure subexpressions used more than once in a statement into temporaries assigned just
+    before it. Only assignments, expression statements and returns are looked at, the tests of loops are
+    worked out again on each pass. Statements calling anything that is not pure are left alone, the call
+    could change what the other occurrences read."""
+
+    def __init__(self, purity):
+        self.purity = purity
+        self.counter = 0
+        self.changed = False
+
+    def new_name(self):
+        name = '%s%d' % (temporary_prefix, self.counter)
+        self.counter += 1
+        return name
+
+    def statements(self, body, module=False):
+        '''Returns body with temporaries added. Temporaries of the statements of the module itself would
+        stay in the worksheet namespace, so they are deleted again.'''
+        new_body = []
+        for statement in body:
+            names = []
+            if isinstance(statement, ast.FunctionDef):
+                statement.body = self.statements(statement.body)
+            elif isinstance(statement, (ast.For, ast.While, ast.If)):
+                statement.body = self.statements(statement.body)
+                statement.orelse = self.statements(statement.orelse)
+            elif isinstance(statement, (ast.Assign, ast.Expr, ast.Return)) and statement.value is not None:
+                temporaries = self.hoist(statement)
+                new_body.extend(temporaries)
+                names = [temporary.targets[0].id for temporary in temporaries]
+
+            new_body.append(statement)
+            if module and names:
+                targets = [ast.Name(id=name, ctx=ast.Del()) for name in names]
+                new_body.append(ast.copy_location(ast.Delete(targets=targets), statement))
+        return new_body
+
+    def hoist(self, statement):
+        '''Temporaries to assign before statement, whose value is changed to use them'''
+        if not self.purity.only_pure_calls(statement.value):
+            return []
+
+        #Expressions in the order they are worked out, the temporaries and then the statement's value
+        values = [statement.value]
+        names = []
+        while len(names) < max_temporaries:
+            expressions = Expressions(values, self.purity)
+            if expressions.size() > max_statement_size:
+                break
+
+            text = expressions.largest_repeated()
+            if text is None:
+                break
+
+            name = self.new_name()
+            replacer = Replacer(text, name)
+            value = expressions.occurrences[text][0]
+            first = None
+            for i in xrange(len(values)):
+                count = replacer.count
+                values[i] = replacer.replace(values[i])
+                if first is None and replacer.count > count:
+                    first = i
+
+            #Must be assigned before the first expression using it
+            values.insert(first, value)
+            names.insert(first, name)
+
+        if not names:
+            return []
+
+        self.changed = True
+        statement.value = values[-1]
+        return [ast.copy_location(ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())], value=value), statement)
+                for name, value in zip(names, values[:-1])]
+
+
+def merge_helpers(functions, program):
+    """Make calls to helper functions that are the same as one defined before them (apart from the name)
+    call that one instead, e.g. for the same sum typed twice. Returns True if anything changed."""
+    first = {}      # Text of arguments and body -> name of the first helper with them
+    renamed = {}    # Name of a helper -> name of the same helper defined before it
+    for statement in functions:
+        if isinstance(statement, ast.FunctionDef) and statement.name.startswith(helper_prefix):
+            text = ast.dump(statement.args) + ''.join([ast.dump(s) for s in statement.body])
+            if text in first and first[text] != statement.name:
+                renamed[statement.name] = first[text]
+            else:
+                first.setdefault(text, statement.name)
+
+    #A helper defined twice under the same name is left to remove_dead_helpers
+    defined = {}
+    for statement in functions:
+        if isinstance(statement, ast.FunctionDef):
+            defined[statement.name] = defined.get(statement.name, 0) + 1
+    for name in renamed.keys():
+        if defined[name] > 1 or defined[renamed[name]] > 1:
+            del renamed[name]
+
+    if not renamed:
+        return False
+
+    def rename(match):
+        name = match.group(0)
+        return renamed.get(name, name)
+
+    for statement in functions + program:
+        for node in ast.walk(statement):
+            if isinstance(node, ast.Name) and node.id in renamed:
+                node.id = renamed[node.id]
+            elif isinstance(node, ast.Str):
+                node.s = identifier.sub(rename, node.s)
+
+    return True
+
+
+#*********************************************Dead helper removal******************************************
+def names_used(node):
+    '''Names read by node, including names in strings as some helpers are handed code to evaluate'''
+    names = set([])
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name):
+            names.add(child.id)
+        elif isinstance(child, ast.Str):
+            names.update(identifier.findall(child.s))
+    return names
+
+
+def remove_dead_helpers(functions, program):
+    '''Returns the statements of functions without the helper functions program never calls, directly or
+    through other functions. A helper defined again further down is dead as well, unless something in
+    between uses it, as the helpers are all defined before the program is run.'''
+    helpers = [statement for statement in functions
+               if isinstance(statement, ast.FunctionDef) and statement.name.startswith(helper_prefix)]
+    if not helpers:
+        return functions
+
+    live = [False] * len(functions)
+    reads = [names_used(statement) for statement in functions]
+    for i, statement in enumerate(functions):
+        if not (isinstance(statement, ast.FunctionDef) and statement.name.startswith(helper_prefix)):
+            live[i] = True
+
+    def defined_later(i):
+        name = functions[i].name
+        for j in xrange(i + 1, len(functions)):
+            if isinstance(functions[j], ast.FunctionDef) and functions[j].name == name:
+                return True
+            if name in reads[j]:
+                return False
+        return False
+
+    wanted = set([])
+    for statement in program:
+        wanted.update(names_used(statement))
+
+    #Keep going until no more helpers are found to be needed
+    changed = True
+    while changed:
+        changed = False
+        for i in xrange(len(functions)):
+            if live[i]:
+                if not reads[i].issubset(wanted):
+                    wanted.update(reads[i])
+                    changed = True
+            elif functions[i].name in wanted and not defined_later(i):
+                live[i] = True
+                changed = True
+
+    return [statement for i, statement in enumerate(functions) if live[i]]
+
+
+#*************************************************Elementwise fusion***************************************
+#Code run once for each term, point or element, with numbers where __elementwise only adds work: functions
+#(worksheet functions, sums, integrals, plots), lambdas, hanging index loops and comprehensions
+repeated_nodes = (ast.FunctionDef, ast.Lambda, ast.For, ast.While, ast.ListComp, ast.GeneratorExp,
+                  ast.SetComp, ast.DictComp)
+
+
+class ElementwiseFuser(ast.NodeTransformer):
+    """Hands the largest elementwise expressions (see elementwise.fusible) to __elementwise as their text,
+    a tuple of the values of the names they read and a lambda working them out the usual way. Only the
+    statements of the program itself are looked at, outside any repeated_nodes.
+
+    Whether a name holds an array is only known when the program runs, so the expression is kept as it
+    was too and __elementwise is only called if one of the variables it reads holds an ndarray:
+
+        __elementwise('_a * sin(_b) + ...', (_a, sin, _b, ...), lambda: _a * sin(_b) + ...)
+            if type(_a) is __ndarray or type(_b) is __ndarray or ... else _a * sin(_b) + ...
+
+    The variables are tested left to right, so one that is not defined raises the same NameError."""
+
+    def __init__(self):
+        self.changed = False
+
+    def visit(self, node):
+        if isinstance(node, repeated_nodes):
+            return node
+        if isinstance(node, ast.expr) and elementwise.fusible(node) and \
+           elementwise.operations(node) >= min_fused_operations:
+            return self.fuse(node)
+        return self.generic_visit(node)
+
+    def fuse(self, node):
+        text = expression(node)
+        names = elementwise.leaves(ast.parse(text, mode='eval').body)
+        variables = [name for name in names if name not in elementwise.functions]
+        if not variables:
+            return node
+
+        values = ast.Tuple(elts=[ast.Name(id=name, ctx=ast.Load()) for name in names], ctx=ast.Load())
+        usual_way = ast.Lambda(args=ast.arguments(args=[], vararg=None, kwarg=None, defaults=[]),
+                               body=copy.deepcopy(node))
+        call = ast.Call(func=ast.Name(id='__elementwise', ctx=ast.Load()),
+                        args=[ast.Str(s=text), values, usual_way], keywords=[], starargs=None, kwargs=None)
+
+        tests = [ast.Compare(left=ast.Call(func=ast.Name(id='type', ctx=ast.Load()),
+                                           args=[ast.Name(id=name, ctx=ast.Load())], keywords=[],
+                                           starargs=None, kwargs=None),
+                             ops=[ast.Is()], comparators=[ast.Name(id='__ndarray', ctx=ast.Load())])
+                 for name in variables]
+        if len(tests) == 1:
+            test = tests[0]
+        else:
+            test = ast.BoolOp(op=ast.Or(), values=tests)
+
+        self.changed = True
+        return ast.copy_location(ast.IfExp(test=test, body=call, orelse=node), node)
+
+
+#***************************************************Lowering***********************************************
+binary_symbols = {ast.Add : '+', ast.Sub : '-', ast.Mult : '*', ast.Div : '/', ast.FloorDiv : '//',
+                  ast.Mod : '%', ast.Pow : '**', ast.BitAnd : '&', ast.BitOr : '|', ast.BitXor : '^',
+                  ast.LShift : '<<', ast.RShift : '>>'}
+
+unary_symbols = {ast.UAdd : '+', ast.USub : '-', ast.Invert : '~', ast.Not : 'not '}
+
+compare_symbols = {ast.Eq : '==', ast.NotEq : '!=', ast.Lt : '<', ast.LtE : '<=', ast.Gt : '>',
+                   ast.GtE : '>=', ast.Is : 'is', ast.IsNot : 'is not', ast.In : 'in', ast.NotIn : 'not in'}
+
+boolean_symbols = {ast.And : 'and', ast.Or : 'or'}
+
+#Expressions written out without brackets around them
+atoms = (ast.Num, ast.Name, ast.Str, ast.Call, ast.Attribute, ast.Subscript, ast.List, ast.Tuple, ast.Dict,
+         ast.ListComp, ast.GeneratorExp)
+
+
+def operand(node):
+    '''Text of node as part of a bigger expression, in brackets unless it is an atom'''
+    if isinstance(node, atoms):
+        return expression(node)
+    return '(%s)' % expression(node)
+
+
+def arguments(args):
+    names = [expression(arg) for arg in args.args]
+    defaults = [expression(default) for default in args.defaults]
+    for i in xrange(len(defaults)):
+        names[len(names) - len(defaults) + i] += '=' + defaults[i]
+    if args.vararg is not None:
+        names.append('*' + args.vararg)
+    if args.kwarg is not None:
+        names.append('**' + args.kwarg)
+    return ', '.join(names)
+
+
+def comprehensions(generators):
+    parts = []
+    for generator in generators:
+        parts.append('for %s in %s' % (expression(generator.target), operand(generator.iter)))
+        parts.extend(['if %s' % operand(test) for test in generator.ifs])
+    return ' '.join(parts)
+
+
+def slice_text(node):
+    if isinstance(node, ast.Index):
+        return expression(node.value)
+    if isinstance(node, ast.Slice):
+        text = ''
+        if node.lower is not None:
+            text += expression(node.lower)
+        text += ':'
+        if node.upper is not None:
+            text += expression(node.upper)
+        if node.step is not None:
+            text += ':' + expression(node.step)
+        return text
+    if isinstance(node, ast.ExtSlice):
+        return ', '.join([slice_text(dimension) for dimension in node.dims])
+    if isinstance(node, ast.Ellipsis):
+        return '...'
+    raise Unsupported(node.__class__.__name__)
+
+
+def expression(node):
+    '''Python text of expression node'''
+    if isinstance(node, ast.Num):
+        text = repr(node.n)
+        if text.startswith('-'):
+            text = '(%s)' % text
+        return text
+    if isinstance(node, ast.Str):
+        return repr(node.s)
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.BinOp):
+        return '%s %s %s' % (operand(node.left), binary_symbols[node.op.__class__], operand(node.right))
+    if isinstance(node, ast.UnaryOp):
+        return '%s%s' % (unary_symbols[node.op.__class__], operand(node.operand))
+    if isinstance(node, ast.BoolOp):
+        return (' %s ' % boolean_symbols[node.op.__class__]).join([operand(value) for value in node.values])
+    if isinstance(node, ast.Compare):
+        text = operand(node.left)
+        for op, comparator in zip(node.ops, node.comparators):
+            text += ' %s %s' % (compare_symbols[op.__class__], operand(comparator))
+        return text
+    if isinstance(node, ast.Call):
+        args = [expression(arg) for arg in node.args]
+        args.extend(['%s=%s' % (keyword.arg, expression(keyword.value)) for keyword in node.keywords])
+        if node.starargs is not None:
+            args.append('*' + operand(node.starargs))
+        if node.kwargs is not None:
+            args.append('**' + operand(node.kwargs))
+        return '%s(%s)' % (operand(node.func), ', '.join(args))
+    if isinstance(node, ast.Attribute):
+        if isinstance(node.value, ast.Num):
+            return '(%s).%s' % (expression(node.value), node.attr)
+        return '%s.%s' % (operand(node.value), node.attr)
+    if isinstance(node, ast.Subscript):
+        return '%s[%s]' % (operand(node.value), slice_text(node.slice))
+    if isinstance(node, ast.Tuple):
+        if len(node.elts) == 1:
+            return '(%s,)' % expression(node.elts[0])
+        return '(%s)' % ', '.join([expression(elt) for elt in node.elts])
+    if isinstance(node, ast.List):
+        return '[%s]' % ', '.join([expression(elt) for elt in node.elts])
+    if isinstance(node, ast.Dict):
+        return '{%s}' % ', '.join(['%s: %s' % (expression(key), expression(value))
+                                   for key, value in zip(node.keys, node.values)])
+    if isinstance(node, ast.Lambda):
+        return 'lambda %s: %s' % (arguments(node.args), expression(node.body))
+    if isinstance(node, ast.IfExp):
+        return '%s if %s else %s' % (operand(node.body), operand(node.test), operand(node.orelse))
+    if isinstance(node, ast.ListComp):
+        return '[%s %s]' % (expression(node.elt), comprehensions(node.generators))
+    if isinstance(node, ast.GeneratorExp):
+        return '(%s %s)' % (expression(node.elt), comprehensions(node.generators))
+    raise Unsupported(node.__class__.__name__)
+
+
+def statements(body, indent=''):
+    '''Python text of a list of statements'''
+    lines = []
+    for node in body:
+        if isinstance(node, ast.FunctionDef):
+            if node.decorator_list:
+                raise Unsupported('decorator')
+            lines.append('%sdef %s(%s):\n' % (indent, node.name, arguments(node.args)))
+            lines.append(statements(node.body, indent + '    '))
+        elif isinstance(node, ast.Assign):
+            targets = ''.join(['%s = ' % expression(target) for target in node.targets])
+            lines.append('%s%s%s\n' % (indent, targets, expression(node.value)))
+        elif isinstance(node, ast.Expr):
+            lines.append('%s%s\n' % (indent, expression(node.value)))
+        elif isinstance(node, ast.Return):
+            if node.value is None:
+                lines.append('%sreturn\n' % indent)
+            else:
+                lines.append('%sreturn %s\n' % (indent, expression(node.value)))
+        elif isinstance(node, ast.For):
+            lines.append('%sfor %s in %s:\n' % (indent, expression(node.target), expression(node.iter)))
+            lines.append(statements(node.body, indent + '    '))
+            lines.append(orelse(node.orelse, indent))
+        elif isinstance(node, ast.While):
+            lines.append('%swhile %s:\n' % (indent, expression(node.test)))
+            lines.append(statements(node.body, indent + '    '))
+            lines.append(orelse(node.orelse, indent))
+        elif isinstance(node, ast.If):
+            lines.append('%sif %s:\n' % (indent, expression(node.test)))
+            lines.append(statements(node.body, indent + '    '))
+            lines.append(orelse(node.orelse, indent))
+        elif isinstance(node, ast.Delete):
+            lines.append('%sdel %s\n' % (indent, ', '.join([expression(target) for target in node.targets])))
+        elif isinstance(node, ast.Break):
+            lines.append('%sbreak\n' % indent)
+        elif isinstance(node, ast.Continue):
+            lines.append('%scontinue\n' % indent)
+        elif isinstance(node, ast.Pass):
+            lines.append('%spass\n' % indent)
+        else:
+            raise Unsupported(node.__class__.__name__)
+    return ''.join(lines)
+
+
+def orelse(body, indent):
+    if not body:
+        return ''
+    return '%selse:\n%s' % (indent, statements(body, indent + '    '))
+
+
+def to_source(body):
+    '''Python text of a list of statements, checked to read back into the same tree'''
+    text = statements(body)
+    if ast.dump(ast.parse(text)) != ast.dump(ast.Module(body=body)):
+        raise Unsupported('text does not read back into the same tree')
+    return text
+
+
+#*****************************************************Dump*************************************************
+def dump(node, indent=''):
+    '''The tree under node, one node per line'''
+    if isinstance(node, list):
+        return ''.join([dump(child, indent) for child in node])
+
+    fields = []
+    children = []
+    for field, value in ast.iter_fields(node):
+        if isinstance(value, ast.AST) and not isinstance(value, (ast.operator, ast.unaryop, ast.cmpop,
+                                                                 ast.boolop, ast.expr_context)):
+            children.append((field, [value]))
+        elif isinstance(value, list) and value and isinstance(value[0], ast.AST):
+            children.append((field, value))
+        elif isinstance(value, ast.AST):
+            fields.append(value.__class__.__name__)
+        elif value is not None and value != []:
+            fields.append('%s=%r' % (field, value))
+
+    text = '%s%s\n' % (indent, ' '.join([node.__class__.__name__] + fields))
+    for field, values in children:
+        text += '%s  .%s\n' % (indent, field)
+        text += dump(values, indent + '    ')
+    return text
+
+
+#*****************************************************Passes***********************************************
+class Program(object):
+    """An equation as generated by the parser, the statements of its helper functions and of its program"""
+
+    def __init__(self, functions, program):
+        self.functions = ast.parse(functions).body
+        self.program = ast.parse(program).body
+        self.changed = False
+
+    def optimize(self):
+        folder = ConstantFolder()
+        self.functions = [folder.visit(statement) for statement in self.functions]
+        self.program = [folder.visit(statement) for statement in self.program]
+
+        merged = merge_helpers(self.functions, self.program)
+
+        eliminator = CommonSubexpressionEliminator(Purity(self.functions))
+        self.functions = eliminator.statements(self.functions)
+        self.program = eliminator.statements(self.program, module=True)
+
+        functions = remove_dead_helpers(self.functions, self.program)
+        self.changed = folder.changed or merged or eliminator.changed or len(functions) != len(self.functions)
+
+        fuser = ElementwiseFuser()
+        self.functions = functions
+        self.program = [fuser.visit(statement) for statement in self.program]
+        self.changed = self.changed or fuser.changed
+
+    def lower(self):
+        '''Returns the Python text of (functions, program)'''
+        return to_source(self.functions), to_source(self.program)
+
+    def dump(self):
+        return 'functions:\n%sprogram:\n%s' % (dump(self.functions, '  '), dump(self.program, '  '))
+
+
+def optimize(functions, program, show=False):
+    '''Returns (functions, program) after running the passes over them. They are handed back as they were
+    if nothing changed or they could not be handled. If show is set the tree is printed before and after.'''
+    try:
+        tree = Program(functions, program)
+        if show:
+            print 'IR before optimization:\n', tree.dump()
+
+        tree.optimize()
+        if show:
+            print 'IR after optimization:\n', tree.dump()
+
+        if tree.changed:
+            return tree.lower()
+
+    except (SyntaxError, Unsupported, RuntimeError), e:
+        if show:
+            print 'IR not optimized:', e
+
+    return functions, program
@@ -0,0 +1,158 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+
+'''Tells whether code can safely be run more than once.
+
+Sums, products, integrals, hanging indices and vectorized functions first try working their body out
+for a whole array of values, and go back to one value at a time if that fails, running the body again.
+That is only harmless if the body gives the same answer and changes nothing however often it runs: it
+may only call functions known to depend on nothing but their arguments (see programir.py) and functions
+defined on the worksheet that do the same, and may not assign globals, write into arrays or print.'''
+
+import types
+import opcode
+
+import scipy
+
+import programir
+import elementwise
+
+
+#Functions giving a different answer each time they are called
+impure_functions = frozenset(['beta', 'binomial', 'chisquare', 'exponential', 'geometric', 'laplace',
+                              'logistic', 'lognormal', 'logseries', 'negative_binomial',
+                              'noncentral_chisquare', 'poisson', 'permutation', 'randint', 'randn',
+                              'randu', 'randu8', 'rayleigh', 'uniform', 'crandu', 'crandn', 'time'])
+
+#Functions of the builtin layers the generated code calls or a worksheet can call that only depend on
+#their arguments. The helpers taking code as strings (hanging indices, substitutions) are not in here,
+#what they run can not be looked at.
+pure_functions = (programir.pure_functions | programir.library_functions | programir.evaluating_functions |
+                  elementwise.functions |
+                  set(['__summation', '__product', '__definite_integral', '__vectorize', '__elementwise',
+                       '__zeros', 'abs', 'float', 'int', 'long', 'complex', 'len', 'min', 'max', 'round']))
+
+pure_attributes = set([name for module, name in programir.pure_attributes])
+
+#Instructions changing something outside the code running them
+side_effect_opcodes = set([opcode.opmap[name] for name in
+                           ['STORE_GLOBAL', 'DELETE_GLOBAL', 'STORE_SUBSCR', 'DELETE_SUBSCR', 'STORE_SLICE+0',
+                            'STORE_SLICE+1', 'STORE_SLICE+2', 'STORE_SLICE+3', 'DELETE_SLICE+0',
+                            'DELETE_SLICE+1', 'DELETE_SLICE+2', 'DELETE_SLICE+3', 'STORE_ATTR', 'DELETE_ATTR',
+                            'PRINT_ITEM', 'PRINT_ITEM_TO', 'PRINT_NEWLINE', 'PRINT_NEWLINE_TO', 'EXEC_STMT',
+                            'IMPORT_NAME', 'IMPORT_STAR']])
+
+global_opcodes = set([opcode.opmap['LOAD_GLOBAL'], opcode.opmap['LOAD_NAME']])
+attribute_opcode = opcode.opmap['LOAD_ATTR']
+
+#code object -> None if it has side effects itself, else (global names read, attributes read). Cleared
+#once it holds max_scans codes, worksheets are compiled again after every edit.
+scans = {}
+max_scans = 1000
+
+
+def scan(top):
+    '''What the code object top, and the functions and lambdas defined in it, read. None if they have side
+    effects.'''
+    found = scans.get(top, False)
+    if found is not False:
+        return found
+
+    names = set()
+    attributes = set()
+    result = (names, attributes)
+
+    codes = [top]
+    while codes:
+        code = codes.pop()
+        codes.extend([const for const in code.co_consts if isinstance(const, types.CodeType)])
+
+        instructions = code.co_code
+        i = 0
+        while i < len(instructions):
+            op = ord(instructions[i])
+            if op in side_effect_opcodes:
+                result = None
+                break
+            if op >= opcode.HAVE_ARGUMENT:
+                argument = ord(instructions[i + 1]) + 256 * ord(instructions[i + 2])
+                if op in global_opcodes:
+                    names.add(code.co_names[argument])
+                elif op == attribute_opcode:
+                    attributes.add(code.co_names[argument])
+                i += 3
+            else:
+                i += 1
+
+        if result is None:
+            break
+
+    if len(scans) >= max_scans:
+        scans.clear()
+    scans[top] = result
+    return result
+
+
+def pure_code(code, namespace, seen=None):
+    """True if running code with namespace as its globals calls nothing but pure functions (including
+    functions defined in namespace that are pure themselves) and has no side effects"""
+    if seen is None:
+        seen = set()
+
+    found = scan(code)
+    if found is None:
+        return False
+    names, attributes = found
+
+    if attributes - pure_attributes:
+        return False
+
+    builtins = namespace.get('__builtins__', {})
+    if isinstance(builtins, types.ModuleType):
+        builtins = builtins.__dict__
+
+    for name in names:
+        if name in impure_functions:
+            return False
+
+        if name in namespace:
+            value = namespace[name]
+        else:
+            value = builtins.get(name)
+
+        #Functions defined on the worksheet (or by the equations' programs) are looked into
+        if isinstance(value, types.FunctionType) and value.func_globals is namespace:
+            if value.func_code not in seen:
+                seen.add(value.func_code)
+                if not pure_code(value.func_code, namespace, seen):
+                    return False
+
+        elif callable(value) and name not in pure_functions and not isinstance(value, scipy.ufunc):
+            return False
+
+    return True
+
+
+def pure(function):
+    '''True if calling function more than once does no harm, see pure_code'''
+    if isinstance(function, types.FunctionType):
+        return pure_code(function.func_code, function.func_globals)
+    return isinstance(function, scipy.ufunc)
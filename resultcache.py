@@ -0,0 +1,130 @@
+#------------------------------------------------------------------------------
+#   Copyright (c) 2008
+#       Roger Hale    roger314159@hotmail.com
+#
+#   This file is part of MiraMath.
+#
+#   MiraMath is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   MiraMath is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with MiraMath.  If not, see <http://www.gnu.org/licenses/>.
+#------------------------------------------------------------------------------
+
+'''Cache of equation results, keyed by the program and the values it read'''
+
+import sys
+import hashlib
+import threading
+import collections
+import cPickle as pickle
+
+import scipy
+
+
+def fingerprint(value):
+    '''Digest of value, None if it can not be worked out'''
+    if isinstance(value, scipy.ndarray) and not value.dtype.hasobject:
+        #Hash the data itself, pickling a big array would copy it
+        array = scipy.ascontiguousarray(value)
+        digest = hashlib.md5(array.data)
+        return '%s %s %s %s' % (type(value).__name__, value.dtype.str, value.shape, digest.hexdigest())
+
+    try:
+        return hashlib.md5(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).hexdigest()
+    except:
+        return None
+
+
+def sizeof(value):
+    '''Rough number of bytes held by value'''
+    if isinstance(value, scipy.ndarray):
+        return value.nbytes + sys.getsizeof(value)
+    return sys.getsizeof(value)
+
+
+class ResultCache(object):
+    """Results of equation programs keyed by a digest of the program and the values it read (see
+    Executor.result_key). Least recently used results are thrown out first once the results held take
+    up more than max_bytes.
+
+    Entries are looked up and stored by whichever thread runs the program, but never while the program
+    is running, so the lock can not be left held by a stop or time out."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()    # key -> (entry, size)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        '''Returns the entry stored under key, or None'''
+        self.lock.acquire()
+        try:
+            item = self.entries.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+
+            #Most recently used go at the end
+            self.hits += 1
+            self.entries[key] = item
+            return item[0]
+        finally:
+            self.lock.release()
+
+    def put(self, key, entry, size):
+        self.lock.acquire()
+        try:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            #Anything bigger than the whole cache is not kept
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (entry, size)
+            self.size += size
+            self.shrink()
+        finally:
+            self.lock.release()
+
+    def resize(self, max_bytes):
+        self.lock.acquire()
+        try:
+            self.max_bytes = max_bytes
+            self.shrink()
+        finally:
+            self.lock.release()
+
+    def shrink(self):
+        while self.size > self.max_bytes and self.entries:
+            key, (entry, size) = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.size = 0
+        finally:
+            self.lock.release()
+
+    def statistics(self):
+        return {'size'      : len(self.entries),
+                'bytes'     : self.size,
+                'hits'      : self.hits,
+                'misses'    : self.misses,
+                'evictions' : self.evictions}
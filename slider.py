@@ -31,6 +31,7 @@ from plotequation import *
 from equation import *
 from colorbutton import ColorButton
 from equationwidgets import EquationChar
+import dependencygraph
 
 
 class Slider(QGraphicsRectItem):
@@ -71,7 +72,7 @@ class Slider(QGraphicsRectItem):
         self.bottom = 0
         self.character_clicked = False
         self.currentEquation = None
-        self.object_id = id(self)  # Unique ID for instance
+        self.object_id = dependencygraph.new_object_id()  # Unique ID for instance
         self.shadowBox = ShadowBox(self)
         self.shadowBox.setColor(Slider.cursor_over_equation_color)
         self.activeBox = ActiveBox('slider', self)
@@ -375,8 +376,9 @@ class Slider(QGraphicsRectItem):
         t3 = self.max_value_eqn.tryToExecuteEquation()
 
         if t1 != None:
+            #The slider assigns its value to the variable, so the variable is an output and not an input
             variable_program = t1[0] + ' = %s' % self.slider_value
-            new_t1 = (variable_program, t1[1], t1[2], t1[3], t1[4])
+            new_t1 = (variable_program, set([]), t1[2], t1[3], t1[4], set(t1[1]))
             programs.append(new_t1)
         else:
             self.variable_equation.setColor(QColor('red'))
@@ -78,6 +78,15 @@ def Re(z):
 def Im(z):
     return sympy.im(z)
 
+#Rational class
+#Creates an instance of Rational suitably initialized
+class rational(sympy.Rational):
+    def __new__(cls, p, q=1):
+        r = sympy.Rational
+        num = r(str(p))
+        denom = r(str(q))
+        return num/denom
+
 def series(expr, var, num=5):
     return sympy.Basic.removeO(sympy.series(expr, var, n=num))
 
@@ -90,6 +99,14 @@ __sqrt          = sympy.sqrt
 __conjugate     = sympy.conjugate
 __absolute      = sympy.abs
 
+#Symbolic values are never worked out a block at a time, see elementwise.py
+def __elementwise(text, values, expression):
+    return expression()
+
+#Nor are vectorized functions called with whole arrays
+def __vectorize(function, *args):
+    return scipy.vectorize(function)(*args)
+
 def __zeros(dimensions, dtype=object):
     return scipy.zeros(dimensions, dtype)
 
@@ -166,4 +183,8 @@ def __summation(func, from_val, to_val, var_name_str):
     __dummy = locals()[var_name_str]
     return sympy.Sum(func(__dummy), (__dummy, from_val, to_val)).doit()
 
+def __product(func, from_val, to_val, var_name_str):
+    __dummy = sympy.Symbol(var_name_str)
+    return sympy.Product(func(__dummy), (__dummy, from_val, to_val)).doit()
+
 
@@ -23,19 +23,18 @@ from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 from PyQt4.QtOpenGL import *
 import time
-import copy
+import Queue
 import execthread
+import parsethread
+import parsecache
+import dependencygraph
+import profiler
 import cPickle as pickle
 
 from worksheetcursor import *
 import equation
 import image
 import equationwidgets as EquationWidgets
-import plot2d
-import plot3d
-import contourplot
-import polarplot
-import slider
 import comment
 import activebox
 
@@ -44,6 +43,15 @@ class WorkSheet(QGraphicsView):
     #Class variable definitions
     backgroundColor = QColor(205, 254, 255)
     clipboard = []
+    executionBackend = 'thread'     # 'thread' or 'process', see executor.py
+    timeLimit = 0                   # Wall clock seconds each equation may run for, 0 for no limit
+    parallelWorkers = 0             # Threads running independent equations side by side, 0 for one per core
+    elementwiseThreads = 1          # Threads sharing out the blocks of long array expressions, 0 for one per core
+    resultCacheSize = 0             # Megabytes of equation results kept for reuse, 0 turns the cache off
+    viewportPriority = False        # Run what is on screen, and what it depends on, before the rest
+    parseCacheOnDisk = False        # Keep the parse cache between sessions, see parsecache.py
+    resultFrameInterval = 16        # Milliseconds between collecting results off the results Q
+    resultFrameBudget = 0.05        # Seconds spent showing results before the GUI gets a look in
 
     def __init__(self, parent, runtime_status_message, num_equations_status_message, current_equation_status_message):
         QGraphicsView.__init__(self, parent)
@@ -91,9 +99,42 @@ class WorkSheet(QGraphicsView):
         self.selectedChars = set([])
 
         #Create a seperate thread in which equations will be evaluated and connect signal indicating a result is available
-        self.execution_thread = execthread.ExecThread(self)
+        self.execution_thread = execthread.ExecThread(self, self.executionBackend)
         self.execution_thread.show_results_signal.connect(self.update_results_handler, type=Qt.QueuedConnection)
 
+        #Create a thread that parses equations, so large worksheets do not hold up the GUI
+        self.parse_thread = parsethread.ParseThread(self)
+        self.parse_thread.parsed_signal.connect(self.equationsParsed, type=Qt.QueuedConnection)
+        self.parse_run_id = None
+        self.parse_pending = {}     # object_id -> [(equation, equation string), ...] waiting to be parsed
+        self.parse_order = []       # Equations/plots of the run in execution order
+        self.parse_position = 0     # How far through parse_order the run has got
+        self.parse_work = []
+        self.parse_streaming = False
+
+        #Results are collected once per frame and shown in one go, see deliverResults()
+        self.results_timer = QTimer(self)
+        self.results_timer.setSingleShot(True)
+        self.results_timer.setInterval(self.resultFrameInterval)
+        self.connect(self.results_timer, SIGNAL('timeout()'), self.deliverResults)
+
+        #Equations/plots sent to the thread, by object_id
+        self.equation_registry = {}
+
+        #Keeps track of what each equation reads and writes so that only edited equations and the ones
+        #that depend on them get re-run
+        self.dependency_graph = dependencygraph.DependencyGraph()
+        self.last_object_id = None
+        self.last_result_in = False     # Set once the results of last_object_id have been shown
+
+        #Set while a run is going. Slider moves during a run only ask for another run once it is done,
+        #using the slider value at that time, see quickExecuteEquations()
+        self.run_active = False
+        self.slider_run_pending = False
+
+        #Where the time went for each equation/plot, shown in its tooltip and the slowest equations panel
+        self.profiler = profiler.Profiler()
+
         #Pointers to status messages in parent main window
         self.runtime_status_message = runtime_status_message
         self.num_equations_status_message = num_equations_status_message
@@ -159,6 +200,17 @@ class WorkSheet(QGraphicsView):
         brush = QBrush(self.backgroundColor)
         self.scene.setBackgroundBrush(brush)
 
+        #Switching backend throws away the worksheet namespace so everything has to be run again
+        if self.execution_thread.backend != self.executionBackend:
+            self.execution_thread.set_backend(self.executionBackend)
+            self.dependency_graph.reset()
+
+        self.execution_thread.set_time_limit(self.timeLimit)
+        self.execution_thread.set_parallel_workers(self.parallelWorkers)
+        self.execution_thread.set_elementwise_threads(self.elementwiseThreads)
+        self.execution_thread.set_result_cache(self.resultCacheSize)
+        parsecache.cache.setPersistent(self.parseCacheOnDisk)
+
     #*****************************************************************************************************
     #* Event handling methods
     #*****************************************************************************************************
@@ -596,6 +648,9 @@ class WorkSheet(QGraphicsView):
         self.updateEquationStatusMessage()
 
     def addNew2dPlot(self):
+        #Plotting modules are only imported once a plot is added to a worksheet
+        import plot2d
+
         self.cursor.hide()
         position = self.cursor.pos() #Location for new equation if one is created
         new_plot = plot2d.Plot2d(None, position, self.font)
@@ -614,6 +669,8 @@ class WorkSheet(QGraphicsView):
         self.updateEquationStatusMessage()
 
     def addNewContourPlot(self):
+        import contourplot
+
         self.cursor.hide()
         position = self.cursor.pos() #Location for new equation if one is created
         new_plot = contourplot.Plot2dContour(None, position, self.font)
@@ -632,6 +689,8 @@ class WorkSheet(QGraphicsView):
         self.updateEquationStatusMessage()
 
     def addNewPolarPlot(self):
+        import polarplot
+
         self.cursor.hide()
         position = self.cursor.pos() #Location for new equation if one is created
         new_plot = polarplot.PolarPlot(None, position, self.font)
@@ -650,6 +709,9 @@ class WorkSheet(QGraphicsView):
         self.updateEquationStatusMessage()
 
     def addNew3dPlot(self):
+        #Pulls in the OpenGL 3D plotting stack, which only worksheets with a 3D plot need
+        import plot3d
+
         self.cursor.hide()
         position = self.cursor.pos() #Location for new equation if one is created
         new_plot = plot3d.Plot3d(None, position, self.font)
@@ -668,6 +730,8 @@ class WorkSheet(QGraphicsView):
         self.updateEquationStatusMessage()
 
     def addNewSlider(self):
+        import slider
+
         self.cursor.hide()
         position = self.cursor.pos() #Location for new equation if one is created
         new_slider = slider.Slider(None, position, self.font, self)
@@ -1009,6 +1073,9 @@ class WorkSheet(QGraphicsView):
         pickle.dump(l, f)
         f.close()
 
+        #Parse results of the worksheet are there for when it is opened again
+        parsecache.cache.save()
+
         #Reset some flags
         self.hasChanged = False
 
@@ -1045,99 +1112,277 @@ class WorkSheet(QGraphicsView):
         self.runtime = 'Run Time: ---  '
         self.updateEquationStatusMessage()
 
-        #Wait for previous execution to complete. User will have to click mouse again!
-        if self.execution_thread.program_q.qsize() == 0 and self.equation_list:
-
-            #Reset working dictionary in thread to {}
-            self.execution_thread.reset()
+        if self.equation_list:
 
             #Execute equations in the order they appear on screen
             self.sortEquationPositions()
 
             self.start_time = time.time()
-
-            #Perform two passes. First run through all global definitions then run all equations
-            for eqn in self.equation_list:
-                if eqn.isGlobalDefinition:
-                    t = eqn.tryToExecuteEquation()
-
-                    #Ship data over to execution thread if valid
-                    if t:
-                        self.execution_thread.do_computation(t)
-
-            for eqn in self.equation_list:
-                t = eqn.tryToExecuteEquation()
-
-                #Ship data over to execution thread if valid
-                if t:
-                    self.execution_thread.do_computation(t)
-
-            #Remember ID of last equation sent to thread
-            self.last_object_id = self.equation_list[-1].object_id
-
-        else:
-            print 'No equations or work Q full, wait!'
+            self.sendEquationsToThread()
 
     def quickExecuteEquations(self):
-        #Wait for previous execution to complete. User will have to click mouse again!
-        if self.execution_thread.program_q.qsize() == 0 and self.equation_list:
-
-            #Reset working dictionary in thread to {}
-            self.execution_thread.reset()
+        """Run what depends on a changed slider. Moves made while a run is going are folded into a
+        single run started when it finishes, so the last position always gets run."""
+        if self.run_active:
+            self.slider_run_pending = True
 
+        elif self.equation_list:
+            self.slider_run_pending = False
             self.start_time = time.time()
+            self.sendEquationsToThread()
+
+    def runFinished(self):
+        """Called once the results of the last equation of a run are in, or there was nothing to run"""
+        self.run_active = False
+        self.showRunTime()
+        self.parentWindow.profileChanged(self)
+
+        #A slider was moved during the run
+        if self.slider_run_pending:
+            QTimer.singleShot(0, self.quickExecuteEquations)
+
+    def stopComputations(self):
+        """Stop the equation being run and throw away the rest of the queued work"""
+        self.parse_thread.cancel()
+        self.parse_order = []
+        self.run_active = False
+        self.slider_run_pending = False
+        self.execution_thread.stop_computations()
+
+    def sendEquationsToThread(self):
+        """Parse all equations and ship the ones affected by edits since the last run to the execution thread.
+        Equations that have to be parsed are parsed by the parse thread, the run carries on in equationsParsed()."""
+
+        #Work still queued from the last run is out of date. Throw it away, anything it contained that is
+        #still needed gets scheduled again below. Same goes for equations that were stopped or timed out.
+        self.parse_thread.cancel()
+        self.dependency_graph.invalidate([q_item[-1] for q_item in self.execution_thread.drain()])
+        self.dependency_graph.invalidate(self.execution_thread.take_interrupted())
+
+        #A hung worker process was killed, the namespace it held is gone
+        if self.execution_thread.namespace_lost():
+            self.dependency_graph.reset()
+
+        self.equation_registry = dict([(eqn.object_id, eqn) for eqn in self.equation_list])
+        self.profiler.forget(self.equation_registry)
+        self.run_active = True
+
+        #Perform two passes. First run through all global definitions then run all equations
+        order = [eqn for eqn in self.equation_list if eqn.isGlobalDefinition]
+        order.extend(self.equation_list)
+
+        #Find the equations that have to be parsed, one job for each equation/plot in execution order
+        jobs = []
+        self.parse_pending = {}
+        for item in order:
+            if item.object_id in self.parse_pending:
+                continue
+
+            requests = []
+            for eqn in self.equationsOf(item):
+                s = eqn.parseRequest()
+                if s is not None:
+                    requests.append((eqn, s))
+
+            if requests:
+                jobs.append((item.object_id, [s for eqn, s in requests]))
+                self.parse_pending[item.object_id] = requests
+
+        self.parse_order = order
+        self.parse_position = 0
+        self.parse_work = []
+
+        #A full run does not depend on what the equations hold, so each equation can be shipped as soon as
+        #it and everything above it are parsed. Otherwise the whole worksheet must be parsed before the
+        #dependency graph can tell what has to be run. Same if equations on screen are to be run first.
+        self.parse_streaming = bool(jobs) and not self.viewportPriority and \
+                               self.dependency_graph.needsFullRun([item.object_id for item in order])
+        if self.parse_streaming:
+            #Until the run is complete the namespace only holds part of the worksheet
+            self.dependency_graph.reset()
+            self.execution_thread.reset()
+            self.last_object_id = None
+
+        if jobs:
+            self.parse_run_id = self.parse_thread.do_parsing(jobs)
+
+        self.shipParsed()
+
+    def equationsOf(self, item):
+        """The equations that get parsed when item is run, plots and sliders hold several"""
+        if isinstance(item, equation.Equation):
+            return [item]
+
+        return [c for c in item.childItems() if isinstance(c, equation.Equation)]
+
+    def equationsParsed(self, run_id):
+        """Handles the parse thread's signal. Parse results are handed to their equations and the run
+        moves on as far as it can."""
+        self.parse_thread.results_delivered()
+        while(1):
+            try:
+                run_id, object_id, results, times = self.parse_thread.results_q.get_nowait()
+            except Queue.Empty:
+                break
+
+            #Results of a run that was cancelled
+            if run_id != self.parse_run_id or object_id not in self.parse_pending:
+                continue
+
+            for (eqn, s), result, parse_time in zip(self.parse_pending.pop(object_id), results, times):
+                eqn.parsedElsewhere(s, result, parse_time)
+
+        self.shipParsed()
+
+    def shipParsed(self):
+        """Go through the run in execution order as far as the parse thread has got"""
+        order = self.parse_order
+        while self.parse_position < len(order):
+            item = order[self.parse_position]
+            if item.object_id in self.parse_pending:
+                return
+
+            t = item.tryToExecuteEquation()
+            self.parse_work.append((item.object_id, t))
+            self.parse_position += 1
+
+            if self.parse_streaming and t is not None:
+                #Remember ID of last equation sent to thread. Must be done before the thread gets hold of it.
+                self.last_object_id = t[-1]
+                self.last_result_in = False
+                self.execution_thread.do_computation(t)
+
+        if order:
+            self.parse_order = []
+            self.scheduleRun(self.parse_work)
+
+    def scheduleRun(self, work):
+        """Work out what has to be run once every equation is parsed. work is a list of (object_id, t)
+        tuples in execution order, t being what tryToExecuteEquation returned."""
+
+        #Find edited equations and everything downstream of them
+        full_run, programs = self.dependency_graph.schedule(work)
+
+        #Everything has been shipped as it was parsed
+        if self.parse_streaming:
+            if self.last_object_id is None or self.last_result_in:
+                self.runFinished()
+            return
+
+        #Reset working dictionary in thread to {} if the worksheet has to be run from scratch
+        if full_run:
+            self.execution_thread.reset()
 
-            #Perform two passes. First run through all global definitions then run all equations
-            for eqn in self.equation_list:
-                if eqn.isGlobalDefinition:
-                    t = eqn.tryToExecuteEquation()
-
-                    #Ship data over to execution thread if valid
-                    if t:
-                        self.execution_thread.do_computation(t)
-
-            for eqn in self.equation_list:
-                t = eqn.tryToExecuteEquation()
+        if programs:
+            if self.viewportPriority:
+                programs = self.dependency_graph.prioritize(programs, self.visibleObjectIds())
 
-                #Ship data over to execution thread if valid
-                if t:
-                    self.execution_thread.do_computation(t)
+            #Remember ID of last equation sent to thread. Must be done before the thread gets hold of the list.
+            self.last_object_id = programs[-1][-1]
+            self.last_result_in = False
 
-            #Remember ID of last equation sent to thread
-            self.last_object_id = self.equation_list[-1].object_id
+            #Ship data over to execution thread
+            self.execution_thread.do_computations(programs)
 
         else:
-            print 'No equations or work Q full, wait!'
+            #Nothing changed, so nothing to run
+            self.last_object_id = None
+            self.runFinished()
+
+    def visibleObjectIds(self):
+        """IDs of the equations/plots that can be seen in the view"""
+        rect = self.mapToScene(self.viewport().rect()).boundingRect()
+        return set([item.object_id for item in self.equation_list if item.sceneBoundingRect().intersects(rect)])
 
     #This handles asynchronous Qt signals from equation execution thread.
-    #Thread fire out signals when it has a result to show
+    #Thread fires a signal when results are waiting, they are collected at the next frame
     def update_results_handler(self, n):
-        #Get equation results off Q. q_item should hold a list of tuples, except the last element=object_id
-        q_item = self.execution_thread.results_q.get()
-
-        #Get hash ID of equation associated with the results. Calculate index of equation based on hash value.
-        object_id = q_item.pop()
-        m = map(id, self.equation_list)
-
-        #Go and draw equation results on screen. Pass a list of tuples to equation/plot
-        if object_id in m:
-            i = m.index(object_id)
-            self.equation_list[i].show_result(q_item)
-
-        if object_id == self.last_object_id:
-            end_time = time.time()
-            diff = end_time - self.start_time
-            seconds = int(diff)
-            milliseconds = int((diff - seconds) * 1000)
-            if seconds:
-                runtime = 'Run Time: %.1f s  ' % diff
+        if not self.results_timer.isActive():
+            self.results_timer.start()
+
+    def deliverResults(self):
+        '''Show the results waiting on the results Q with updates to the view held back until the end'''
+        self.execution_thread.results_delivered()
+        results_q = self.execution_thread.results_q
+        registry = self.equation_registry
+        end_time = time.time() + self.resultFrameBudget
+
+        viewport = self.viewport()
+        viewport.setUpdatesEnabled(False)
+        try:
+            while time.time() < end_time:
+                #Get equation results off Q. q_item should hold a list of tuples, except the last element=object_id
+                try:
+                    q_item = results_q.get_nowait()
+                except Queue.Empty:
+                    break
+
+                #Go and draw equation results on screen. Pass a list of tuples to equation/plot.
+                #Equations deleted since they were sent are no longer in the scene.
+                object_id = q_item.pop()
+                timing = self.execution_thread.take_timing(object_id)
+                eqn = registry.get(object_id)
+                if eqn is not None and eqn.scene() is not None:
+                    show_time = time.time()
+                    eqn.show_result(q_item)
+                    if timing is not None:
+                        self.recordProfile(eqn, timing, show_time, time.time())
+
+                #The run is over unless the parse thread is still feeding it
+                if object_id == self.last_object_id and not self.last_result_in:
+                    self.last_result_in = True
+                    if not self.parse_order:
+                        self.runFinished()
+
             else:
-                runtime = 'Run Time: %s ms  ' % milliseconds
+                #Out of time, show the rest next frame
+                self.results_timer.start()
+
+        finally:
+            viewport.setUpdatesEnabled(True)
+            viewport.update()
+
+    def recordProfile(self, item, timing, show_start, show_end):
+        """Keep the times of an equation/plot whose results have just been shown, timing being as returned
+        by ExecThread.take_timing, and list them in its tooltip"""
+        queue_time, run_time, posted_time = timing
+        parse_time = sum([eqn.parseTime for eqn in self.equationsOf(item)])
+        profile = profiler.EquationProfile(item.object_id, self.profileLabel(item), parse_time, queue_time,
+                                           run_time, max(show_start - posted_time, 0.0), show_end - show_start)
+        self.profiler.record(profile)
+
+        #Replace the times of the previous run
+        text = unicode(item.toolTip()).split(profiler.tooltip_separator)[0]
+        item.setToolTip(text + profiler.tooltip_separator + profile.describe())
+
+    def profileLabel(self, item):
+        """Name of an equation/plot in the slowest equations panel"""
+        if isinstance(item, equation.Equation):
+            name = 'Equation'
+        else:
+            name = item.__class__.__name__
+        return '%s %d' % (name, item.equationIndex + 1)
+
+    def showItem(self, object_id):
+        """Scroll the equation/plot with the given ID into view"""
+        item = self.equation_registry.get(object_id)
+        if item is not None and item.scene() is not None:
+            self.ensureVisible(item)
+
+    def showRunTime(self):
+        end_time = time.time()
+        diff = end_time - self.start_time
+        seconds = int(diff)
+        milliseconds = int((diff - seconds) * 1000)
+        if seconds:
+            runtime = 'Run Time: %.1f s  ' % diff
+        else:
+            runtime = 'Run Time: %s ms  ' % milliseconds
 
-            if self.is_current_tab:
-                self.runtime_status_message.setText(runtime)
+        if self.is_current_tab:
+            self.runtime_status_message.setText(runtime)
 
-            self.runtime = runtime
+        self.runtime = runtime
 
     def sortEquationPositions(self):
         eqnlist = self.equation_list